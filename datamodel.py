@@ -1,96 +1,679 @@
 from __future__ import division
 
+import binascii
+import bisect
+import collections
 import datetime
 import logging
+import os
+import threading
+import time
 
 from google.appengine.ext import db
+import itertools
 from itertools import izip
 
+import readings
+from util import rpcstats
+from util.dates import DateDelta
+from util import spans
+from util.rangetree import SegmentTree
+from trend import MODELS as TREND_MODELS, DEFAULT_MODEL as DEFAULT_TREND_MODEL
+from trend import make as make_trend_model
+
 DEFAULT_QUERY_SIZE=35
 DEFAULT_QUERY_DAYS=14
 DECAY_SETUP_DAYS = 14
 
-_BLOCK_SIZE=35  # never change this!
+# Date ranges spanning up to this many blocks are fetched by key, in batches of
+# FETCH_CHUNK_BLOCKS keys that are all in flight at once.  Wider ranges are
+# fetched with a query.
+MAX_KEYED_FETCH_BLOCKS = 48
+FETCH_CHUNK_BLOCKS = 8
+
+# batch_update writes this many blocks per transaction (each block is about
+# half a kilobyte), and retries a transaction that fails because of contention
+# up to BATCH_UPDATE_RETRIES times, waiting twice as long each time.
+BATCH_UPDATE_BLOCKS = 100
+BATCH_UPDATE_RETRIES = 4
+BATCH_UPDATE_BACKOFF_SECONDS = 0.1
+
+# add_readings writes the readings of up to this many ReadingBlocks per
+# transaction.
+READINGS_BATCH_BLOCKS = 10
+
+# read_users fetches blocks with batch gets of up to MULTI_USER_FETCH_KEYS keys
+# (or, for wide ranges, a query per user), with at most MULTI_USER_FETCHES of
+# them in flight at once.
+MULTI_USER_FETCH_KEYS = 100
+MULTI_USER_FETCHES = 4
+
+# Most blocks returned by one call of WeightData.changed_blocks.  All blocks
+# written by one transaction (and so with the same version) are returned
+# together, and while a user's blocks are being migrated to another layout a
+# transaction can write up to BATCH_UPDATE_BLOCKS (plus one at either end) in
+# each of the two layouts.
+MAX_CHANGED_BLOCKS = 2 * BATCH_UPDATE_BLOCKS + 4
+
+# How long DataVersion remembers the days written other than by write-behind
+# flushes, which must not be overwritten by entries buffered before them.
+# Comfortably longer than a buffered entry can wait to be flushed.
+RECENT_WRITE_SECONDS = 2 * 24 * 3600
+
+class BlockLayout(object):
+  """How a user's entries are split into WeightBlocks.
+
+  Each block holds `days` consecutive days, starting with a day_zero that is
+  a multiple of `days`, and is named with the layout's prefix and its
+  day_zero, so that blocks of different layouts can sit side by side while a
+  user's data moves from one layout to another (see DataVersion).
+  """
+  def __init__(self, number, days, prefix):
+    self.number = number
+    self.days = days
+    self.prefix = prefix
+
+  def __repr__(self):
+    return 'BlockLayout(%d, %d, %r)' % (self.number, self.days, self.prefix)
+
+  def day_zero(self, day):
+    return day - (day % self.days)
+
+  def day_zeros(self, first_day, last_day):
+    """Returns the day_zeros of the blocks from first_day to last_day.
+
+    >>> LAYOUTS[1].day_zeros(734503, 734600)
+    xrange(734475, 734615, 35)
+    """
+    return xrange(self.day_zero(first_day), self.day_zero(last_day) + 1,
+                  self.days)
+
+  def key_name(self, day_zero):
+    """
+    >>> LAYOUTS[1].key_name(734475), LAYOUTS[2].key_name(734345)
+    ('d:0734475', 'y:0734345')
+    """
+    return '%s:%07d' % (self.prefix, day_zero)
+
+  def key(self, user_key, day_zero):
+    return db.Key.from_path('WeightBlock', self.key_name(day_zero),
+                            parent=user_key)
+
+  def holds(self, block):
+    """Returns whether a WeightBlock belongs to this layout."""
+    return block.key().name().startswith(self.prefix + ':')
+
+  def group(self, entries):
+    """Returns {day_zero: [(rel_day, weight), ...]} for day,weight entries
+    (days being ordinals).
+
+    >>> LAYOUTS[1].group([(734503, 180.0), (734504, 179.5), (734510, 179.0)])
+    {734475: [(28, 180.0), (29, 179.5)], 734510: [(0, 179.0)]}
+    """
+    by_block = {}
+    for day, weight in entries:
+      day_zero = self.day_zero(day)
+      by_block.setdefault(day_zero, []).append((day - day_zero, weight))
+    return by_block
+
+# The block layouts, by number.  Layout 1 is the original one, which every
+# user starts with; its block size and key names must never change, nor may
+# those of any other layout once users have been moved to it.
+LAYOUTS = {
+  1: BlockLayout(1, 35, 'd'),
+  2: BlockLayout(2, 365, 'y'),
+}
+DEFAULT_LAYOUT = 1
+_MIN_BLOCK_DAYS = min(layout.days for layout in LAYOUTS.itervalues())
+_LAYOUTS_BY_PREFIX = dict((layout.prefix, layout)
+                          for layout in LAYOUTS.itervalues())
+
+def layout_of(block):
+  """Returns the BlockLayout that a WeightBlock belongs to."""
+  return _LAYOUTS_BY_PREFIX[block.key().name().split(':', 1)[0]]
+
+# A block is stored sparse (see WeightBlock) when fewer than this fraction of
+# its days have entries.  A sparse block stores two numbers per entry and a
+# dense one a number per day, so this keeps every block at its smaller size.
+SPARSE_MAX_FILL = 0.5
 
 class UserInfo(db.Expando):
   user = db.UserProperty(required=True)
   scale_resolution = db.FloatProperty(required=True, default=0.5)
   gamma = db.FloatProperty(required=True, default=0.9)
   xsrf_secret = db.StringProperty()
+  # Bumped whenever the settings above change, so that copies of them kept
+  # elsewhere (e.g., in a settings cookie) can tell that they are stale.
+  settings_version = db.IntegerProperty(required=True, default=0)
+  # How the trend is computed, one of trend.MODELS.
+  trend_model = db.StringProperty(default=DEFAULT_TREND_MODEL,
+                                  choices=sorted(TREND_MODELS))
+  # The weight the user is aiming for, if any (see projection.py).
+  goal_weight = db.FloatProperty()
+  # The BlockLayout to read the user's weights with.  A copy of
+  # DataVersion.layout for readers, which have the user's settings but not
+  # their DataVersion; see DataVersion.
+  block_layout = db.IntegerProperty(default=DEFAULT_LAYOUT)
+  # Which of the day's readings is its weight, if the user records several a
+  # day (one of readings.MODES); None if they don't.
+  intraday_mode = db.StringProperty(choices=readings.MODES)
+
+class AppSecret(db.Model):
+  """An application-wide secret, keyed by what it is used for.
+
+  Created with a random value the first time it is asked for.
+  """
+  secret = db.StringProperty(required=True)
+
+_app_secrets = {}
+_app_secrets_lock = threading.Lock()
+
+def get_app_secret(name):
+  """Returns the named application secret, loading it once per instance."""
+  secret = _app_secrets.get(name)
+  if secret is None:
+    with _app_secrets_lock:
+      secret = _app_secrets.get(name)
+      if secret is None:
+        with rpcstats.operation('AppSecret.get_or_insert', name):
+          entity = AppSecret.get_or_insert(
+              name, secret=binascii.hexlify(os.urandom(16)))
+        secret = _app_secrets[name] = str(entity.secret)
+  return secret
 
 class WeightBlock(db.Model):
   """Contains a block of weight entries, starting with day_zero (in Proleptic
   Gregorian ordinal days (Jan 1 of AD 1 = 1: you can get this by calling
-  date.toordinal()) and containing 35 days (5 weeks)
-  of weight entries.
+  date.toordinal()) and containing as many days of weight entries as the
+  block's layout says (35 days, or 5 weeks, for the original layout; see
+  BlockLayout).
+
+  A block is stored either dense, with weight_entries holding a weight for
+  every day (-1.0 for days without one) and no offsets, or sparse, with
+  weight_entries holding only the weights there are and offsets the days
+  (relative to day_zero) they are for.  Which one is chosen by how full the
+  block is (see SPARSE_MAX_FILL) every time it is written, so that weekly or
+  monthly weigh-ins don't pay for the days in between.  Use slots() to read
+  the entries and set_entries() to change them.
   """
   user_info = db.ReferenceProperty(UserInfo, required=True)
   day_zero = db.IntegerProperty()  # in days since the Epoch
   weight_entries = db.ListProperty(float)
+  offsets = db.ListProperty(int, indexed=False)
+  # The user's DataVersion.version as of the last write to this block.  Blocks
+  # last written before versions were kept don't have one.
+  version = db.IntegerProperty()
+
+  def is_sparse(self):
+    # A dense block always has a weight for every day, even if they are all
+    # empty, so a block without any is an empty sparse one.
+    return bool(self.offsets) or not self.weight_entries
+
+  def slots(self):
+    """Returns an iterator of rel_day,weight pairs in day order: for every day
+    of a dense block, including the empty ones (with negative weights), but
+    only for the entries of a sparse one."""
+    if self.is_sparse():
+      return izip(self.offsets, self.weight_entries)
+    return enumerate(self.weight_entries)
+
+  def dense_entries(self):
+    """Returns a list with the weight for every day, -1.0 where there is none.
+    """
+    if not self.is_sparse():
+      return list(self.weight_entries)
+    values = [-1.0] * layout_of(self).days
+    for rel_day, weight in izip(self.offsets, self.weight_entries):
+      values[rel_day] = weight
+    return values
+
+  def set_entries(self, values):
+    """Replaces the entries with values, a weight for every day (negative for
+    none), stored sparse or dense, whichever is smaller."""
+    offsets = [rel_day for rel_day, weight in enumerate(values)
+               if weight >= 0.0]
+    if len(offsets) < SPARSE_MAX_FILL * len(values):
+      self.offsets = offsets
+      self.weight_entries = [values[rel_day] for rel_day in offsets]
+    else:
+      self.offsets = []
+      self.weight_entries = list(values)
+
+  def summary(self, first=0, last=None):
+    """Returns block_summary of the entries from rel_day first to last."""
+    if not self.is_sparse():
+      return block_summary(self.weight_entries, first, last)
+    return block_summary([weight for rel_day, weight in self.slots()
+                          if first <= rel_day and
+                             (last is None or rel_day <= last)])
+
+class ReadingBlock(db.Model):
+  """All of a user's weight readings for readings.READING_BLOCK_DAYS days,
+  starting with day_zero, packed as readings.pack does.
+
+  Only users who record several readings a day have these.  A child of the
+  user's UserInfo with the key name "r:" followed by the day_zero, so that it
+  is written in the same transaction as the WeightBlocks holding the
+  representatives of its days.
+  """
+  day_zero = db.IntegerProperty(indexed=False)
+  packed = db.BlobProperty()
 
   @staticmethod
-  def _WeightBlock_key(user_info, day_zero):
-    return db.Key.from_path(
-        'WeightBlock',
-        WeightBlock._WeightBlock_key_name(day_zero),
-        parent=user_info)
+  def day_zero_for(day):
+    return day - (day % readings.READING_BLOCK_DAYS)
+
+  @staticmethod
+  def key_for(user_key, day_zero):
+    return db.Key.from_path('ReadingBlock', 'r:%07d' % day_zero,
+                            parent=user_key)
+
+  def readings(self):
+    """Returns the rel_day, minute, weight readings, in time order."""
+    return readings.unpack(self.packed)
+
+class DataVersion(db.Model):
+  """Counts the writes to a user's weight data.
+
+  Every transaction that writes blocks increments this and stamps the blocks
+  it writes with the new value, so that clients can ask for what changed
+  since the version they last saw.  A child of the user's UserInfo (with the
+  key name "v"), so it is in the same entity group as the blocks, but kept
+  apart from UserInfo so that settings changes can't overwrite it.
+
+  It also remembers the days that were written in the last
+  RECENT_WRITE_SECONDS other than by write-behind flushes, and when, so that
+  a flush can leave out the entries that were buffered before one of them (see
+  writebehind.py).
+
+  It also records the user's BlockLayout, which every write reads in its
+  transaction.  While the user's blocks are being moved to another layout
+  (see migration.py), old_layout is the layout they are moving from, and
+  writes go to the blocks of both layouts, so that readers still using the old
+  one (with settings from before the move) see them too.
+  """
+  version = db.IntegerProperty(required=True, default=0)
+  layout = db.IntegerProperty(default=DEFAULT_LAYOUT)
+  old_layout = db.IntegerProperty()
+  # When layout last changed.
+  layout_changed = db.DateTimeProperty()
+  # Days (ordinals) written recently, and when (time.time()), in parallel.
+  written_days = db.ListProperty(int, indexed=False)
+  written_times = db.ListProperty(float, indexed=False)
+
+  def written(self):
+    """Returns {day: time} of the recently written days."""
+    return dict(izip(self.written_days, self.written_times))
+
+  def record_written(self, days, now):
+    """Remembers that days were written at now, forgetting the days written
+    more than RECENT_WRITE_SECONDS before it."""
+    written = dict((day, t) for day, t in self.written().iteritems()
+                   if t > now - RECENT_WRITE_SECONDS)
+    for day in days:
+      written[day] = now
+    self.written_days = sorted(written)
+    self.written_times = [written[day] for day in self.written_days]
+
+  def layouts(self):
+    """Returns the BlockLayouts that writes go to, the current one first."""
+    layouts = [LAYOUTS[self.layout or DEFAULT_LAYOUT]]
+    if self.old_layout is not None:
+      layouts.append(LAYOUTS[self.old_layout])
+    return layouts
 
   @staticmethod
-  def _WeightBlock_key_name(day_zero):
-    return "d:%07d" % day_zero
+  def key_for(user_key):
+    return db.Key.from_path('DataVersion', 'v', parent=user_key)
+
+def block_summary(weight_entries, first=0, last=None):
+  """Returns count, sum, min, max of the entries from index first to last.
+
+  min and max are None if there are no entries.
+
+  >>> block_summary([-1.0, 180.0, 181.0, -1.0, 179.5])
+  (3, 540.5, 179.5, 181.0)
+  >>> block_summary([-1.0, 180.0, 181.0, -1.0, 179.5], 3, 3)
+  (0, 0.0, None, None)
+  """
+  if last is None:
+    last = len(weight_entries) - 1
+  values = [w for w in weight_entries[first:last + 1] if w >= 0.0]
+  if not values:
+    return 0, 0.0, None, None
+  return len(values), sum(values), min(values), max(values)
+
+def combine_summaries(summaries):
+  """Combines count, sum, min, max summaries into one.
+
+  >>> combine_summaries([(3, 540.5, 179.5, 181.0), (0, 0.0, None, None),
+  ...                    (1, 178.0, 178.0, 178.0)])
+  (4, 718.5, 178.0, 181.0)
+  """
+  count = sum(s[0] for s in summaries)
+  total = sum(s[1] for s in summaries)
+  mins = [s[2] for s in summaries if s[0]]
+  maxs = [s[3] for s in summaries if s[0]]
+  return (count, total,
+          min(mins) if mins else None,
+          max(maxs) if maxs else None)
+
+def drop_overwritten(entries, buffered_at, written):
+  """Returns the day,weight entries buffered by write-behind that haven't been
+  written over since they were buffered.
+
+  Args:
+    entries: day,weight pairs (days being ordinals)
+    buffered_at: {day: time} when each entry was buffered
+    written: {day: time} when days were last written other than by a flush
+        (see DataVersion.written)
+
+  A weight buffered at 100, then a CSV import of the same day at 105:
+
+  >>> drop_overwritten([(734503, 180.0), (734504, 181.0)],
+  ...                  {734503: 100.0, 734504: 100.0}, {734503: 105.0})
+  [(734504, 181.0)]
+  >>> drop_overwritten([(734503, 180.0)], {734503: 110.0}, {734503: 105.0})
+  [(734503, 180.0)]
+  """
+  return [(day, weight) for day, weight in entries
+          if written.get(day, -1.0) < buffered_at[day]]
+
+# Called with the key of a user (as a string) and the dates of every write of
+# their data that isn't a write-behind flush, once it is committed.
+_direct_write_listeners = []
+
+def add_direct_write_listener(listener):
+  """Has listener(user_key, dates) called after every direct write (see
+  writebehind.py, which forgets the entries it buffered for those dates)."""
+  _direct_write_listeners.append(listener)
+
+BUCKETS = {
+  'week': DateDelta(weeks=1),
+  'month': DateDelta(months=1),
+  'year': DateDelta(years=1),
+}
+
+def aggregate_buckets(start, end, bucket):
+  """Returns the (first, last) dates of the calendar buckets from start to end.
+
+  Weeks start on Monday.  The first and last buckets are cut short to fit in
+  the range.
+
+  >>> for b in aggregate_buckets(datetime.date(2012, 1, 30),
+  ...                            datetime.date(2012, 3, 2), 'month'):
+  ...   print b[0], b[1]
+  2012-01-30 2012-01-31
+  2012-02-01 2012-02-29
+  2012-03-01 2012-03-02
+  >>> aggregate_buckets(datetime.date(2012, 1, 4),
+  ...                   datetime.date(2012, 1, 10), 'week')[1]
+  (datetime.date(2012, 1, 9), datetime.date(2012, 1, 10))
+  """
+  step = BUCKETS[bucket]
+  if bucket == 'week':
+    first = start - datetime.timedelta(days=start.weekday())
+  elif bucket == 'month':
+    first = start.replace(day=1)
+  else:
+    first = start.replace(month=1, day=1)
+
+  buckets = []
+  while first <= end:
+    following = step.add_to_date(first)
+    buckets.append((max(first, start),
+                    min(following - datetime.timedelta(days=1), end)))
+    first = following
+  return buckets
+
+def _bucket_result(first, last, summary):
+  count, total, low, high = summary
+  return {
+    'start': str(first),
+    'end': str(last),
+    'count': count,
+    'mean': total / count if count else None,
+    'min': low,
+    'max': high,
+  }
+
+class WeightSummaryIndex(db.Model):
+  """Summaries of every block of a user's weights, for range statistics.
+
+  Parallel lists with an element per block, in day_zero order: the number of
+  entries in the block, their sum, and their smallest and largest values (0
+  for blocks without entries).  Along with them, the running totals of the
+  counts and sums (with a leading 0, so one element longer), so that the
+  count and sum over any range of blocks is the difference of two of them.
+  The statistics for the blocks in any range are found without reading the
+  blocks.
+
+  A child of the user's UserInfo with the key name "s".  It is built the first
+  time statistics are asked for, and from then on updated by every
+  transaction that writes blocks.  It covers the blocks of one BlockLayout; an
+  index of another layout than the reader's is rebuilt.
+  """
+  layout = db.IntegerProperty(default=DEFAULT_LAYOUT)
+  day_zeros = db.ListProperty(int, indexed=False)
+  counts = db.ListProperty(int, indexed=False)
+  sums = db.ListProperty(float, indexed=False)
+  mins = db.ListProperty(float, indexed=False)
+  maxs = db.ListProperty(float, indexed=False)
+  prefix_counts = db.ListProperty(int, indexed=False)
+  prefix_sums = db.ListProperty(float, indexed=False)
+
+  @staticmethod
+  def key_for(user_key):
+    return db.Key.from_path('WeightSummaryIndex', 's', parent=user_key)
+
+  def _update_prefixes(self, i):
+    """Recomputes the running totals from block i on, the ones before it
+    being unchanged (or all of them, for an index written before they were
+    kept)."""
+    del self.prefix_counts[i + 1:]
+    del self.prefix_sums[i + 1:]
+    if len(self.prefix_counts) != i + 1:
+      i = 0
+      self.prefix_counts = [0]
+      self.prefix_sums = [0.0]
+    count = self.prefix_counts[-1]
+    total = self.prefix_sums[-1]
+    for n, block_total in izip(self.counts[i:], self.sums[i:]):
+      count += n
+      total += block_total
+      self.prefix_counts.append(count)
+      self.prefix_sums.append(total)
+
+  def set_block(self, day_zero, weight_entries):
+    """Records the current entries of a block (its weight_entries, whether
+    it is dense or sparse)."""
+    count, total, low, high = block_summary(weight_entries)
+    if not count:
+      low = high = 0.0
+    i = bisect.bisect_left(self.day_zeros, day_zero)
+    if i < len(self.day_zeros) and self.day_zeros[i] == day_zero:
+      self.counts[i] = count
+      self.sums[i] = total
+      self.mins[i] = low
+      self.maxs[i] = high
+    else:
+      self.day_zeros.insert(i, day_zero)
+      self.counts.insert(i, count)
+      self.sums.insert(i, total)
+      self.mins.insert(i, low)
+      self.maxs.insert(i, high)
+    self._update_prefixes(i)
+    self._trees = None
+
+  def summary(self, first_day_zero, last_day_zero, reuse=False):
+    """Returns count, sum, min, max over the blocks from first_day_zero to
+    last_day_zero (inclusive).
+
+    The count and sum come from the running totals.  The min and max are
+    found by scanning the blocks' mins and maxs, unless reuse is true (the
+    index is about to be asked for many ranges), in which case trees are
+    built over them once and queried from then on.
+    """
+    if len(self.prefix_counts) != len(self.day_zeros) + 1:
+      self._update_prefixes(0)
+    i = bisect.bisect_left(self.day_zeros, first_day_zero)
+    j = bisect.bisect_right(self.day_zeros, last_day_zero)
+    if j <= i:
+      return 0, 0.0, None, None
+    count = self.prefix_counts[j] - self.prefix_counts[i]
+    if not count:
+      return 0, 0.0, None, None
+    total = self.prefix_sums[j] - self.prefix_sums[i]
+
+    trees = getattr(self, '_trees', None)
+    if trees is None and reuse:
+      inf = float('inf')
+      trees = self._trees = (
+        SegmentTree([low if n else inf
+                     for n, low in izip(self.counts, self.mins)], min, inf),
+        SegmentTree([high if n else -inf
+                     for n, high in izip(self.counts, self.maxs)], max, -inf),
+      )
+    if trees is not None:
+      mins, maxs = trees
+      return count, total, mins.query(i, j), maxs.query(i, j)
+    counts = self.counts[i:j]
+    return (count, total,
+            min(low for n, low in izip(counts, self.mins[i:j]) if n),
+            max(high for n, high in izip(counts, self.maxs[i:j]) if n))
+
+class ImportReceipt(db.Model):
+  """The response to a bulk import, kept under the idempotency key the client
+  sent with it, so that a retried import is answered without redoing it.
+
+  A child of the importing user's UserInfo; the key name is "i:" followed by
+  the idempotency key.
+  """
+  result = db.TextProperty(required=True)
+  created = db.DateTimeProperty(auto_now_add=True)
+
+  @staticmethod
+  def key_for(user_key, idempotency_key):
+    return db.Key.from_path('ImportReceipt', 'i:' + idempotency_key,
+                            parent=user_key)
+
+# Incremented for a user whenever this instance writes their weight data, so
+# that work started before a write is never mistaken for work started after it.
+_data_generations = {}
+_data_generations_lock = threading.Lock()
 
 class WeightData(object):
   """An abstraction to allow for easy, on-demand access to daily entries,
   supporting the somewhat weird underlying data model that we have to use to
   keep things sane in retrieval of large date ranges.
   """
-  def __init__(self, user_info):
+  def __init__(self, user_info, pending=None):
     """Create a WeightData object for the given user
 
     Args:
-      user_info: required UserInfo object, obtained from the datastore.
+      user_info: required UserInfo object, obtained from the datastore, or
+          anything else with its key() and block_layout (such as a
+          usercontext.UserSettings), or just its key (in which case blocks are
+          read with the default layout; writes always use the user's own).
+      pending: optional {date: weight} of writes that have been accepted but
+          may not be in the datastore yet (see writebehind.py).  They take the
+          place of the stored values in everything read.
     """
     self.user_info = user_info
+    self.pending = pending or {}
 
-  @staticmethod
-  def _day_zero(day):
-    return day - (day % _BLOCK_SIZE)
+  @property
+  def layout(self):
+    """The BlockLayout that the user's blocks are read with."""
+    return LAYOUTS[getattr(self.user_info, 'block_layout', None) or
+                   DEFAULT_LAYOUT]
 
-  def _get_block(self, day_zero):
-    return WeightBlock.get_or_insert(
-        key_name=WeightBlock._WeightBlock_key_name(day_zero),
-        parent=self.user_info,
-        user_info=self.user_info,
-        weight_entries=[-1.0] * _BLOCK_SIZE,
-        day_zero=day_zero)
+  def _day_zero(self, day):
+    return self.layout.day_zero(day)
 
-  def most_recent_entry(self):
-    """Queries the database for the most recent weight entry that it can find.
+  def user_key(self):
+    """Returns the key of the user's UserInfo."""
+    user_key = self.user_info
+    if not isinstance(user_key, db.Key):
+      user_key = user_key.key()
+    return user_key
 
-    If there isn't one, it returns None, otherwise it returns a date,weight
-    pair.
+  def _block_key(self, day_zero):
+    return self.layout.key(self.user_key(), day_zero)
+
+  def version_key(self):
+    """Returns a hashable value that changes when this instance writes data.
+
+    Writes made by other instances are not seen, so this is only good for
+    telling apart computations that overlap in time (see util.singleflight),
+    not for caching.
+    """
+    user_key = str(self.user_key())
+    return user_key, _data_generations.get(user_key, 0)
+
+  def data_changed(self):
+    """Records that this instance has changed the user's data."""
+    user_key = str(self.user_key())
+    with _data_generations_lock:
+      _data_generations[user_key] = _data_generations.get(user_key, 0) + 1
+
+  def most_recent_entry_async(self):
+    """Starts looking for the most recent weight entry.
+
+    Returns:
+      an object whose get_result() returns what most_recent_entry would
     """
     end_day = datetime.date.today().toordinal()
-    day_zero = self._day_zero(end_day)
 
+    # Any block that starts by today will do, whatever its layout: while the
+    # user's blocks are being migrated, both layouts hold the same entries.
     query = WeightBlock.gql(
         "WHERE user_info = :1 AND "
         "day_zero <= :2 "
         "ORDER BY day_zero DESC",
-        self.user_info, day_zero)
+        self.user_key(), end_day)
 
-    values = query.fetch(1)
-    if not values:
-      return None
-    else:
-      block = values[0]
-      for rel_day in range(_BLOCK_SIZE-1, -1, -1):
-        entry = block.weight_entries[rel_day]
-        if entry >= 0.0:
-          return datetime.date.fromordinal(block.day_zero + rel_day), entry
-      else:
-        # Nothing found in the block, it might as well not be there
-        return None
+    return _RecentEntryFetch(
+        query, rpcstats.operation('WeightData.most_recent_entry', end_day),
+        self.pending)
+
+  def most_recent_entry(self):
+    """Queries the database for the most recent weight entry that it can find.
+
+    If there isn't one, it returns None, otherwise it returns a date,weight
+    pair.
+    """
+    return self.most_recent_entry_async().get_result()
+
+  def _fetch_blocks(self, start_day_zero, end_day_zero, op, day_zeros=None):
+    """Starts fetching the blocks from start_day_zero to end_day_zero.
+
+    Narrow ranges are fetched by key, since the keys of all of their blocks
+    are known, as several batch gets that run in parallel.  Wide ranges are
+    mostly empty (think of "All" going back to 1900), so for them a query that
+    only returns the blocks that exist is cheaper.
+
+    If day_zeros is given, only those blocks (in order, and between
+    start_day_zero and end_day_zero) are wanted; the query may return others.
+    """
+    layout = self.layout
+    if day_zeros is None:
+      day_zeros = xrange(start_day_zero, end_day_zero + 1, layout.days)
+    num_blocks = len(day_zeros)
+    with op:
+      if num_blocks > MAX_KEYED_FETCH_BLOCKS:
+        query = WeightBlock.gql(
+            "WHERE user_info = :1 AND "
+            "day_zero >= :2 AND day_zero <= :3 "
+            "ORDER BY day_zero ASC",
+            self.user_key(), start_day_zero, end_day_zero)
+        return _BlockFetch(op, query_iter=query.run(batch_size=num_blocks),
+                           layout=layout)
+
+      keys = [self._block_key(day_zero) for day_zero in day_zeros]
+      rpcs = [db.get_async(keys[i:i + FETCH_CHUNK_BLOCKS])
+              for i in xrange(0, len(keys), FETCH_CHUNK_BLOCKS)]
+      return _BlockFetch(op, rpcs=rpcs)
 
   def query(self, start_date=None, end_date=None):
     """Query the datastore for weight values.
@@ -99,6 +682,9 @@ class WeightData(object):
     end_date.  If end_date is not specified, it defaults to "today".  If
     max_values is not specified, it defaults to DEFAULT_QUERY_SIZE.
 
+    The datastore fetch is started right away, so the caller can do other work
+    before iterating over the result.
+
     Args:
       start_date: first date of data that interests us.  Default end_date -
           DEFAULT_QUERY_DAYS
@@ -118,48 +704,385 @@ class WeightData(object):
 
     assert start_day < end_day
 
-    num_days = end_day - start_day
-
     logging.debug("start_day %s", start_day)
     logging.debug("end_day %s", end_day)
 
+    blocks = self._fetch_blocks(
+        self._day_zero(start_day), self._day_zero(end_day),
+        rpcstats.operation('WeightData.query',
+                           '%s..%s' % (start_date, end_date)))
+    entries = _block_entry_iter(blocks, start_day, end_day)
+    if self.pending:
+      entries = _pending_entry_iter(entries, self.pending, start_date, end_date)
+    return entries
+
+  def data_version(self):
+    """Returns the version of the user's data (see DataVersion)."""
+    with rpcstats.operation('DataVersion.get'):
+      data_version = db.get(DataVersion.key_for(self.user_key()))
+    if data_version is None:
+      return 0
+    return data_version.version
+
+  def changed_blocks(self, since):
+    """Returns the blocks written after the given version, oldest change first.
+
+    At most MAX_CHANGED_BLOCKS are read, and never only some of the blocks
+    with a given version, so the caller can safely continue from the version
+    returned.  Only the blocks of the layout the user's blocks are read with
+    are returned; while they are moving to another layout, the blocks read can
+    all be of the other one.
+
+    Returns:
+      (blocks, more, version) where more is true if not all changed blocks
+      were returned, and version is the highest version of the blocks read
+      (of either layout), or since if there were none
+    """
+    query = WeightBlock.all()
+    query.ancestor(self.user_key())
+    query.filter('version >', since)
+    query.order('version')
+    with spans.span('query'):
+      with rpcstats.operation('WeightData.changed_blocks', since):
+        blocks = query.fetch(MAX_CHANGED_BLOCKS + 1)
+    more = len(blocks) > MAX_CHANGED_BLOCKS
+    if more:
+      # Leave out the version that was cut off, it comes next time.
+      cut_version = blocks[-1].version
+      blocks = [b for b in blocks if b.version != cut_version]
+    version = max([since] + [b.version for b in blocks])
+    layout = self.layout
+    return [b for b in blocks if layout.holds(b)], more, version
+
+  def all_blocks(self, layout=None):
+    """Returns all of the user's blocks of a layout (by default, the one they
+    are read with), in date order."""
+    if layout is None:
+      layout = self.layout
+    query = WeightBlock.all().ancestor(self.user_key())
+    with spans.span('query'):
+      with rpcstats.operation('WeightData.all_blocks', layout.number):
+        blocks = [block for block in query if layout.holds(block)]
+    blocks.sort(key=lambda block: block.day_zero)
+    return blocks
+
+  def all_entries(self, layout=None):
+    """Returns all of the user's date,weight entries, in date order, as held
+    by the blocks of a layout (by default, the one they are read with)."""
+    return block_entries(self.all_blocks(layout))
+
+  def new_blocks(self, entries, version=None, layout=None):
+    """Returns new WeightBlocks holding the date,weight entries, in a layout
+    (by default, the one the user's blocks are read with).
+
+    This is for writing a user's data without going through update() (which
+    reads, versions and indexes each block in a transaction), e.g., when
+    restoring a backup into an empty datastore.  Nothing is put.
+    """
+    if layout is None:
+      layout = self.layout
+    by_block = layout.group((date.toordinal(), weight)
+                            for date, weight in entries)
+    blocks = []
+    for day_zero in sorted(by_block):
+      block = _new_block(self.user_key(), layout, day_zero)
+      block.version = version
+      values = [-1.0] * layout.days
+      for rel_day, weight in by_block[day_zero]:
+        values[rel_day] = weight
+      block.set_entries(values)
+      blocks.append(block)
+    return blocks
+
+  def _build_summary_index(self):
+    """Creates the user's WeightSummaryIndex from all of their blocks, unless
+    there already is one for the layout they are read with."""
+    user_key = self.user_key()
+    index_key = WeightSummaryIndex.key_for(user_key)
+    layout = self.layout
+
+    def txn():
+      index = db.get(index_key)
+      if index is None or index.layout != layout.number:
+        index = WeightSummaryIndex(key=index_key, layout=layout.number)
+        for block in WeightBlock.all().ancestor(user_key):
+          if layout.holds(block):
+            index.set_block(block.day_zero, block.weight_entries)
+        index.put()
+      return index
+
+    with rpcstats.operation('WeightData.build_summary_index'):
+      return db.run_in_transaction(txn)
+
+  def _range_summary(self, by_day_zero, index, start_day, end_day,
+                     reuse=False):
+    """Summarizes the entries from start_day to end_day (inclusive).
+
+    Args:
+      by_day_zero: {day_zero: block} holding the blocks at both ends of the
+          range, if they exist
+      index: the user's WeightSummaryIndex, used for the blocks in between;
+          built if it is None and needed
+      reuse: whether the index will be asked for many ranges (see
+          WeightSummaryIndex.summary)
+
+    Returns:
+      ((count, sum, min, max), index)
+    """
+    block_days = self.layout.days
     start_day_zero = self._day_zero(start_day)
     end_day_zero = self._day_zero(end_day)
 
-    # Now we run the query:
-    query = WeightBlock.gql(
-        "WHERE user_info = :1 AND "
-        "day_zero >= :2 AND day_zero <= :3 "
-        "ORDER BY day_zero ASC",
-        self.user_info, start_day_zero, end_day_zero)
-
-    # Iterate over all of the non-empty dates from start_day to end_day within
-    # the blocks:
-    for block in query:
-      for rel_day, weight in enumerate(block.weight_entries):
-        day = rel_day + block.day_zero
-        if start_day <= day <= end_day and weight >= 0.0:
-          yield datetime.date.fromordinal(day), weight
-
-  def smoothed_weight_iter(self, start, end, samples=None, gamma=0.9):
-    # Start a few days early so that we can get the smoothing primed
-    early_d1 = start - datetime.timedelta(days=DECAY_SETUP_DAYS)
-    early_d2 = start
-    early_smoothed = list(
-        decaying_average_iter(full_entry_iter(self.query(early_d1, early_d2))))
-    smooth_start = None
-    if early_smoothed:
-      smooth_start = early_smoothed[-1][-1]
-
-    # Get the sampled raw weights and smoothed function:
-    entry_iter = self.query(start, end)
-    if samples is not None:
-      entry_iter = sample_entries(entry_iter, start, end, samples)
-    smoothed_iter = decaying_average_iter(entry_iter,
-                                          gamma=gamma,
-                                          start=smooth_start)
-
-    return smoothed_iter
+    def edge(day_zero, first, last):
+      block = by_day_zero.get(day_zero)
+      if block is None:
+        return 0, 0.0, None, None
+      return block.summary(first, last)
+
+    if start_day_zero == end_day_zero:
+      parts = [edge(start_day_zero, start_day - start_day_zero,
+                    end_day - start_day_zero)]
+    else:
+      parts = [edge(start_day_zero, start_day - start_day_zero,
+                    block_days - 1),
+               edge(end_day_zero, 0, end_day - end_day_zero)]
+      if end_day_zero - start_day_zero > block_days:
+        if index is None or index.layout != self.layout.number:
+          index = self._build_summary_index()
+        parts.append(index.summary(start_day_zero + block_days,
+                                   end_day_zero - block_days, reuse))
+    return combine_summaries(parts), index
+
+  def _pending_day_zeros(self, start_day, end_day):
+    """Returns the day_zeros of the blocks with pending writes from start_day
+    to end_day, in order."""
+    return sorted(set(self._day_zero(date.toordinal())
+                      for date in self.pending
+                      if start_day <= date.toordinal() <= end_day))
+
+  def _overlaid_range_summary(self, by_day_zero, index, start_day, end_day,
+                              reuse=False):
+    """Does _range_summary with the pending writes in place of the stored
+    values.  by_day_zero must also hold the blocks with pending writes in the
+    range (see _pending_day_zeros), if they exist.
+    """
+    block_days = self.layout.days
+    parts = []
+    day = start_day
+    for day_zero in self._pending_day_zeros(start_day, end_day):
+      first = max(day_zero, start_day)
+      last = min(day_zero + block_days - 1, end_day)
+      if day < first:
+        summary, index = self._range_summary(by_day_zero, index, day,
+                                             first - 1, reuse)
+        parts.append(summary)
+      block = by_day_zero.get(day_zero)
+      if block is not None:
+        values = block.dense_entries()
+      else:
+        values = [-1.0] * block_days
+      for date, weight in self.pending.iteritems():
+        if 0 <= date.toordinal() - day_zero < block_days:
+          values[date.toordinal() - day_zero] = weight
+      parts.append(block_summary(values, first - day_zero, last - day_zero))
+      day = last + 1
+    if day <= end_day:
+      summary, index = self._range_summary(by_day_zero, index, day, end_day,
+                                           reuse)
+      parts.append(summary)
+    return combine_summaries(parts), index
+
+  def aggregate(self, start, end, bucket, trend=True, gamma=0.9, model=None):
+    """Summarizes the entries from start to end (inclusive) by calendar week,
+    month or year.
+
+    With trend, the entries are read in one pass through smoothed_weight_iter
+    so that each bucket can also report the trend at its last entry.  Without
+    it, only the blocks at the edges of the buckets are read, and the blocks
+    in between are summarized by the user's WeightSummaryIndex.
+
+    Args:
+      bucket: one of BUCKETS ('week', 'month' or 'year')
+
+    Returns:
+      a list with a dict per bucket: start, end, count, mean, min, max and,
+      with trend, the closing trend value (None where there are no entries)
+    """
+    buckets = aggregate_buckets(start, end, bucket)
+    results = []
+    if trend:
+      # smoothed_weight_iter needs at least two days.
+      query_start = min(start, end - datetime.timedelta(days=1))
+      rows = (row for row in self.smoothed_weight_iter(query_start, end,
+                                                       gamma=gamma,
+                                                       model=model)
+              if row[0] >= start)
+      row = next(rows, None)
+      for bucket_start, bucket_end in buckets:
+        weights = []
+        closing = None
+        while row is not None and row[0] <= bucket_end:
+          weights.append(row[1])
+          closing = row[2]
+          row = next(rows, None)
+        results.append(_bucket_result(
+            bucket_start, bucket_end,
+            (len(weights), sum(weights),
+             min(weights) if weights else None,
+             max(weights) if weights else None)))
+        results[-1]['trend'] = closing
+      return results
+
+    edges = set()
+    for bucket_start, bucket_end in buckets:
+      edges.add(self._day_zero(bucket_start.toordinal()))
+      edges.add(self._day_zero(bucket_end.toordinal()))
+    edges.update(self._pending_day_zeros(start.toordinal(), end.toordinal()))
+    edges = sorted(edges)
+    user_key = self.user_key()
+    with spans.span('query'):
+      with rpcstats.operation('WeightData.aggregate', '%s..%s by %s' % (
+          start, end, bucket)):
+        fetched = db.get([WeightSummaryIndex.key_for(user_key)] +
+                         [self._block_key(day_zero) for day_zero in edges])
+    index = fetched[0]
+    by_day_zero = dict((block.day_zero, block) for block in fetched[1:]
+                       if block is not None)
+    for bucket_start, bucket_end in buckets:
+      summary, index = self._overlaid_range_summary(
+          by_day_zero, index, bucket_start.toordinal(),
+          bucket_end.toordinal(), reuse=len(buckets) > 1)
+      results.append(_bucket_result(bucket_start, bucket_end, summary))
+    return results
+
+  def stats(self, start, end, gamma=0.9, model=None):
+    """Returns statistics for the entries from start to end (inclusive).
+
+    Only the blocks at the two ends of the range (and any with pending
+    writes) are read, along with the days before each end that the trend
+    there is computed from; the blocks in between are covered by the user's
+    WeightSummaryIndex.
+
+    Returns:
+      a dict with the count, mean, min and max of the entries (None if there
+      are none), the trend at the start and at the end of the range and the
+      change between them (None where there are no entries to compute them
+      from), and the trend's rate of change per day at the end of the range
+      if the model tracks one (see trend.py)
+    """
+    start_day = start.toordinal()
+    end_day = end.toordinal()
+    assert start_day <= end_day
+
+    # The trend at a day is the last value of smoothed_weight_iter over the
+    # trend_days up to it, which is primed over the DECAY_SETUP_DAYS before
+    # those.
+    trend_days = 2 * DECAY_SETUP_DAYS
+    read_days = trend_days + DECAY_SETUP_DAYS
+    layout = self.layout
+    wanted = set(layout.day_zeros(start_day - read_days, start_day))
+    wanted.update(layout.day_zeros(end_day - read_days, end_day))
+    wanted.update(self._pending_day_zeros(start_day, end_day))
+    wanted = sorted(wanted)
+
+    user_key = self.user_key()
+    with spans.span('query'):
+      with rpcstats.operation('WeightData.stats', '%s..%s' % (start, end)):
+        fetched = db.get([WeightSummaryIndex.key_for(user_key)] +
+                         [self._block_key(day_zero) for day_zero in wanted])
+    index = fetched[0]
+    blocks = [block for block in fetched[1:] if block is not None]
+    by_day_zero = dict((block.day_zero, block) for block in blocks)
+
+    (count, total, low, high), index = self._overlaid_range_summary(
+        by_day_zero, index, start_day, end_day)
+
+    def trend_at(day):
+      first = datetime.date.fromordinal(day - read_days)
+      last = datetime.date.fromordinal(day)
+      entries = _block_entry_iter(blocks, day - read_days, day)
+      if self.pending:
+        entries = _pending_entry_iter(entries, self.pending, first, last)
+      entries = list(entries)
+      split, trend = _primed_trend(
+          entries, datetime.date.fromordinal(day - trend_days), gamma, model)
+      for date, weight in entries[split:]:
+        trend.update(date, weight)
+      return trend
+
+    start_trend = trend_at(start_day).value
+    end_model = trend_at(end_day)
+    end_trend = end_model.value
+    trend_change = None
+    if start_trend is not None and end_trend is not None:
+      trend_change = end_trend - start_trend
+    return {
+      'count': count,
+      'mean': total / count if count else None,
+      'min': low,
+      'max': high,
+      'start_trend': start_trend,
+      'end_trend': end_trend,
+      'trend_change': trend_change,
+      'rate_per_day': end_model.rate,
+    }
+
+  def smoothed_weight_iter(self, start, end, samples=None, gamma=0.9,
+                           model=None):
+    # Start a few days early so that we can get the smoothing primed.  The
+    # early days are fetched along with the rest, in the same RPCs.
+    early_start = start - datetime.timedelta(days=DECAY_SETUP_DAYS)
+    assert start < end
+    entries = list(self.query(early_start, end))
+    return _smooth_entries(entries, start, end, samples, gamma, model)
+
+  def smoothed_weight_iters(self, ranges, samples=None, gamma=0.9,
+                            model=None):
+    """Does smoothed_weight_iter for several date ranges at once.
+
+    The blocks needed by all of the ranges (including their priming days) are
+    fetched together, once each, so that comparing several periods costs one
+    round trip to the datastore.
+
+    Args:
+      ranges: a list of start,end date pairs
+
+    Returns:
+      a list of what smoothed_weight_iter returns, one per range
+    """
+    windows = []
+    wanted = set()
+    for start, end in ranges:
+      assert start < end
+      early_start = start - datetime.timedelta(days=DECAY_SETUP_DAYS)
+      windows.append((early_start, start, end))
+      wanted.update(self.layout.day_zeros(early_start.toordinal(),
+                                          end.toordinal()))
+    wanted = sorted(wanted)
+    first_date = min(w[0] for w in windows)
+    last_date = max(w[2] for w in windows)
+
+    blocks = self._fetch_blocks(
+        wanted[0], wanted[-1],
+        rpcstats.operation('WeightData.smoothed_weight_iters',
+                           '%d ranges, %s..%s' % (len(ranges), first_date,
+                                                  last_date)),
+        wanted)
+    entries = _block_entry_iter(blocks, first_date.toordinal(),
+                                last_date.toordinal())
+    if self.pending:
+      entries = _pending_entry_iter(entries, self.pending, first_date,
+                                    last_date)
+    entries = list(entries)
+
+    results = []
+    for early_start, start, end in windows:
+      lo = bisect.bisect_left(entries, (early_start,))
+      hi = bisect.bisect_left(entries, (end + datetime.timedelta(days=1),))
+      results.append(_smooth_entries(entries[lo:hi], start, end, samples,
+                                     gamma, model))
+    return results
+
 
   def update(self, date, weight):
     """Update the weight for a given date
@@ -168,52 +1091,587 @@ class WeightData(object):
       date: the day to update
       weight: the weight to update
     """
-    day = date.toordinal()
-    day_zero = self._day_zero(day)
-
-    block = self._get_block(day_zero)
+    try:
+      with rpcstats.operation('WeightData.update', date):
+        self._update_blocks([(date.toordinal(), weight)])
+    finally:
+      self.data_changed()
 
-    block_index = day - day_zero
-    assert 0 <= block_index < _BLOCK_SIZE
-
-    block.weight_entries[block_index] = weight
-    block.put()
-
-  def batch_update(self, entries):
+  def batch_update(self, entries, skip_unchanged=False, buffered_at=None):
     """Update a batch of weights.
 
     This is much more efficient than just doing one at a time because it splits
-    things up into blocks and only updates each block once.
+    things up into blocks and only updates each block once.  All of a user's
+    blocks are in one entity group, which only sustains about one commit a
+    second, so the blocks are written BATCH_UPDATE_BLOCKS at a time (or, with
+    a layout of longer blocks, as many as cover the same days), each batch in a
+    single transaction that is retried (with backoff) if it collides with
+    another write.
 
     Args:
       entries: a list (not just an iterable) of date,weight pairs
+      skip_unchanged: if true, every block is read first and the ones that
+          already hold these weights are not written again
+      buffered_at: for a write-behind flush, {date: time} when each entry was
+          buffered; entries for dates written since are left out
+
+    Returns:
+      a dict describing the work done: entries, blocks, written (blocks),
+      transactions, retries, seconds and block_results, which has the start
+      date, number of entries and status ('created', 'updated', 'unchanged' or,
+      for blocks replaced without being read, 'written') of each block
     """
     assert len(entries) > 0
     entries.sort()  # sort by date
 
-    # Fill up blocks.  Note that we don't have to make any queries if we have
-    # data enough to completely fill a block, since that means the whole block
-    # will be overwritten.  TODO: take advantage of this fact.
-    #
-    # TODO: If we have a block full of nothing, delete it altogether.
+    layout = self.layout
+    by_block = layout.group((date.toordinal(), weight)
+                            for date, weight in entries)
+    day_zeros = sorted(by_block)
+    if buffered_at is not None:
+      buffered_at = dict((date.toordinal(), t)
+                         for date, t in buffered_at.iteritems())
+    # No transaction may write more than about BATCH_UPDATE_BLOCKS blocks of
+    # any layout, in case the blocks turn out to be in another layout than
+    # the one they are read with.
+    chunk_blocks = max(1, BATCH_UPDATE_BLOCKS * _MIN_BLOCK_DAYS // layout.days)
+
+    report = {
+      'entries': len(entries),
+      'written': 0,
+      'transactions': 0,
+      'retries': 0,
+    }
+    statuses = {}
+    start = time.time()
+    try:
+      with rpcstats.operation('WeightData.batch_update',
+                              '%s..%s' % (entries[0][0], entries[-1][0])):
+        for i in xrange(0, len(day_zeros), chunk_blocks):
+          chunk = [(day_zero + rel_day, weight)
+                   for day_zero in day_zeros[i:i + chunk_blocks]
+                   for rel_day, weight in by_block[day_zero]]
+          retries, chunk_statuses = self._update_blocks(
+              chunk, skip_unchanged, buffered_at=buffered_at)
+          report['retries'] += retries
+          report['transactions'] += 1
+          statuses.update(chunk_statuses)
+    finally:
+      self.data_changed()
+
+    report['seconds'] = round(time.time() - start, 3)
+    report['blocks'] = len(statuses)
+    report['written'] = sum(1 for status, count in statuses.itervalues()
+                            if status != 'unchanged')
+    report['block_results'] = [
+      {
+        'start': datetime.date.fromordinal(day_zero).isoformat(),
+        'entries': statuses[day_zero][1],
+        'status': statuses[day_zero][0],
+      } for day_zero in sorted(statuses)]
+    logging.info("batch_update wrote %d entries in %d of %d blocks with %d "
+                 "transactions (%d retries) in %.3fs",
+                 report['entries'], report['written'], report['blocks'],
+                 report['transactions'], report['retries'], report['seconds'])
+    return report
+
+  def add_readings(self, changes, mode):
+    """Records intraday readings, and sets the weight of every day they are on
+    to the representative of all of that day's readings (see readings.py).
+
+    The readings of READINGS_BATCH_BLOCKS ReadingBlocks at a time are written
+    in one transaction along with the days' weights.
 
-    block = None
-    for date, weight in entries:
-      day = date.toordinal()
-      day_zero = self._day_zero(day)
-      # If we don't have this block yet, get_or_insert it
-      if block is None or day_zero != block.day_zero:
-        # When we see a new block, commit the last one and then overwrite it.
+    Args:
+      changes: datetime,weight pairs; a negative weight removes the reading
+          taken at that minute
+      mode: one of readings.MODES
+
+    Returns:
+      a dict with the number of readings, days and transactions, and the
+      retries they took
+    """
+    assert mode in readings.MODES
+    user_key = self.user_key()
+    by_block = {}
+    for when, weight in changes:
+      day = when.toordinal()
+      day_zero = ReadingBlock.day_zero_for(day)
+      by_block.setdefault(day_zero, []).append(
+          (day - day_zero, when.hour * 60 + when.minute, weight))
+    day_zeros = sorted(by_block)
+
+    report = {
+      'readings': len(changes),
+      'days': 0,
+      'transactions': 0,
+      'retries': 0,
+    }
+    try:
+      with rpcstats.operation('WeightData.add_readings', len(changes)):
+        for i in xrange(0, len(day_zeros), READINGS_BATCH_BLOCKS):
+          chunk = day_zeros[i:i + READINGS_BATCH_BLOCKS]
+
+          def prepare(chunk=chunk):
+            reading_blocks = db.get([ReadingBlock.key_for(user_key, day_zero)
+                                     for day_zero in chunk])
+            entries = []
+            for i, (day_zero, block) in enumerate(zip(chunk, reading_blocks)):
+              if block is None:
+                block = ReadingBlock(key=ReadingBlock.key_for(user_key,
+                                                              day_zero),
+                                     day_zero=day_zero)
+              block_changes = by_block[day_zero]
+              merged = readings.merge(block.readings(), block_changes)
+              block.packed = db.Blob(readings.pack(merged))
+              reading_blocks[i] = block
+              days = set(rel_day for rel_day, minute, w in block_changes)
+              entries.extend(
+                  (day_zero + rel_day, weight) for rel_day, weight
+                  in readings.daily(merged, days, mode).iteritems())
+            return entries, reading_blocks
+
+          # A reading that leaves its day's weight as it was (a later one,
+          # say, when the first counts) writes only its ReadingBlock.
+          retries, statuses = self._update_blocks([], skip_unchanged=True,
+                                                  prepare=prepare)
+          report['retries'] += retries
+          report['transactions'] += 1
+          report['days'] += len(set(
+              (day_zero, rel_day) for day_zero in chunk
+              for rel_day, minute, w in by_block[day_zero]))
+    finally:
+      self.data_changed()
+    return report
+
+  def readings_between(self, start, end):
+    """Returns the user's intraday readings from start to end (dates,
+    inclusive) as datetime,weight pairs in time order."""
+    start_day = start.toordinal()
+    end_day = end.toordinal()
+    user_key = self.user_key()
+    day_zeros = xrange(ReadingBlock.day_zero_for(start_day),
+                       ReadingBlock.day_zero_for(end_day) + 1,
+                       readings.READING_BLOCK_DAYS)
+    with spans.span('query'):
+      with rpcstats.operation('WeightData.readings_between',
+                              '%s..%s' % (start, end)):
+        if len(day_zeros) <= MAX_KEYED_FETCH_BLOCKS:
+          blocks = db.get([ReadingBlock.key_for(user_key, day_zero)
+                           for day_zero in day_zeros])
+        else:
+          # Wide ranges are mostly empty; only readers of readings have any.
+          blocks = sorted(ReadingBlock.all().ancestor(user_key),
+                          key=lambda block: block.day_zero)
+    results = []
+    for block in blocks:
+      if block is None:
+        continue
+      for rel_day, minute, weight in block.readings():
+        day = block.day_zero + rel_day
+        if start_day <= day <= end_day:
+          results.append((datetime.datetime.fromordinal(day) +
+                          datetime.timedelta(minutes=minute), weight))
+    return results
+
+  def recompute_readings(self, mode):
+    """Sets the weight of every day with intraday readings to their
+    representative in the given mode (e.g., after the user changes it).
+
+    Returns:
+      the number of days set
+    """
+    assert mode in readings.MODES
+    with rpcstats.operation('WeightData.recompute_readings', mode):
+      blocks = list(ReadingBlock.all().ancestor(self.user_key()))
+    entries = []
+    for block in blocks:
+      block_readings = block.readings()
+      days = set(rel_day for rel_day, minute, w in block_readings)
+      entries.extend(
+          (datetime.date.fromordinal(block.day_zero + rel_day), weight)
+          for rel_day, weight
+          in readings.daily(block_readings, days, mode).iteritems())
+    if entries:
+      self.batch_update(entries, skip_unchanged=True)
+    return len(entries)
+
+  def _direct_write(self, days):
+    """Tells the direct write listeners (and this WeightData's pending
+    entries) that days have been written."""
+    dates = set(datetime.date.fromordinal(day) for day in days)
+    for date in dates:
+      self.pending.pop(date, None)
+    for listener in _direct_write_listeners:
+      listener(str(self.user_key()), dates)
+
+  def _update_blocks(self, entries, skip_unchanged=False, prepare=None,
+                     buffered_at=None):
+    """Writes day,weight entries (days being ordinals) in one transaction.
+
+    The entries go to the blocks of the layouts the user's DataVersion names
+    (see DataVersion.layouts), which are usually just the one they are read
+    with.
+
+    prepare, if given, is called at the start of the transaction (every time
+    it is tried), and returns more day,weight entries to write along with
+    other entities of the user's to put in the same transaction.
+
+    buffered_at, for the entries of a write-behind flush, is {day: time} when
+    each was buffered; the ones whose day has been written since are left
+    out (see drop_overwritten).  The days of every other write are recorded
+    in the user's DataVersion for this.
+
+    Returns:
+      (how many times the transaction had to be retried,
+       {day_zero: (status, number of entries)} for the blocks of the user's
+       current layout, see batch_update)
+    """
+    user_key = self.user_key()
+    read_layout = self.layout
+    statuses = {}
+    written_days = []
+
+    def apply(layout, by_block, to_read, fetched):
+      """Applies {day_zero: rows} to the blocks of a layout that were read
+      (fetched), returning the blocks that changed and their statuses."""
+      existing = dict((block.day_zero, block) for block in fetched
+                      if block is not None)
+      blocks = []
+      layout_statuses = {}
+      for day_zero, rows in by_block.iteritems():
+        block = existing.get(day_zero)
         if block is not None:
-          block.put()
-        # Get the new block for the current date
-        block = self._get_block(day_zero)
-      block.weight_entries[day - day_zero] = weight
+          status = 'updated'
+        elif day_zero in to_read:
+          status = 'created'
+        else:
+          status = 'written'
+        if block is None:
+          block = _new_block(user_key, layout, day_zero)
+        old_entries = block.dense_entries()
+        values = list(old_entries)
+        for rel_day, weight in rows:
+          values[rel_day] = weight
+        if (skip_unchanged and status == 'updated' and
+            values == old_entries):
+          status = 'unchanged'
+        else:
+          block.set_entries(values)
+          blocks.append(block)
+        layout_statuses[day_zero] = (status, len(rows))
+      return blocks, layout_statuses
+
+    def blocks_to_read(layout, by_block):
+      # Blocks that are being completely overwritten don't need to be read,
+      # unless we have to know whether they are changing, or some of the
+      # entries may be left out.
+      return set(day_zero for day_zero, rows in by_block.iteritems()
+                 if skip_unchanged or buffered_at is not None or
+                    len(set(rel_day for rel_day, w in rows)) < layout.days)
+
+    def txn():
+      statuses.clear()
+      del written_days[:]
+      txn_entries = entries
+      more_entities = []
+      if prepare is not None:
+        more_entries, more_entities = prepare()
+        txn_entries = list(entries) + more_entries
+      # The blocks of the layout the user's blocks are read with are fetched
+      # along with the DataVersion that says whether that is the right one.
+      by_block = read_layout.group(txn_entries)
+      to_read = blocks_to_read(read_layout, by_block)
+      version_key = DataVersion.key_for(user_key)
+      index_key = WeightSummaryIndex.key_for(user_key)
+      fetched = db.get([version_key, index_key] +
+                       [read_layout.key(user_key, day_zero)
+                        for day_zero in to_read])
+      data_version, index = fetched[:2]
+      if data_version is None:
+        data_version = DataVersion(key=version_key)
+      record = buffered_at is None and len(txn_entries) > 0
+      if record:
+        written_days.extend(day for day, weight in txn_entries)
+        data_version.record_written(written_days, time.time())
+      elif buffered_at is not None:
+        txn_entries = drop_overwritten(txn_entries, buffered_at,
+                                       data_version.written())
+        by_block = read_layout.group(txn_entries)
+      blocks = []
+      layouts = data_version.layouts()
+      for layout in layouts:
+        if layout is read_layout:
+          layout_blocks, layout_statuses = apply(layout, by_block, to_read,
+                                                 fetched[2:])
+        else:
+          layout_by_block = layout.group(txn_entries)
+          layout_to_read = blocks_to_read(layout, layout_by_block)
+          layout_blocks, layout_statuses = apply(
+              layout, layout_by_block, layout_to_read,
+              db.get([layout.key(user_key, day_zero)
+                      for day_zero in layout_to_read]))
+        if layout is layouts[0]:
+          statuses.update(layout_statuses)
+        blocks.extend(layout_blocks)
+      entities = list(more_entities)
+      if blocks or record:
+        # Even a write that changes nothing replaces what was buffered before
+        # it.
+        entities.append(data_version)
+      if blocks:
+        data_version.version += 1
+        for block in blocks:
+          block.version = data_version.version
+        entities += blocks
+        # The index only exists once someone has asked for statistics.
+        if index is not None:
+          index_layout = LAYOUTS[index.layout or DEFAULT_LAYOUT]
+          indexed = [block for block in blocks if index_layout.holds(block)]
+          for block in indexed:
+            index.set_block(block.day_zero, block.weight_entries)
+          if indexed:
+            entities.append(index)
+      if entities:
+        db.put(entities)
+
+    for attempt in xrange(BATCH_UPDATE_RETRIES + 1):
+      try:
+        # Retries are done here, rather than by the datastore library, so that
+        # they back off and are counted.
+        db.run_in_transaction_custom_retries(0, txn)
+        if written_days:
+          self._direct_write(written_days)
+        return attempt, statuses
+      except db.TransactionFailedError:
+        if attempt == BATCH_UPDATE_RETRIES:
+          raise
+        delay = BATCH_UPDATE_BACKOFF_SECONDS * (2 ** attempt)
+        logging.warning("batch_update collided on %d entries, retrying in "
+                        "%.2fs", len(entries), delay)
+        time.sleep(delay)
+
+def block_entries(blocks):
+  """Returns all of the date,weight entries in blocks, which are in date order.
+  """
+  return list(_block_entry_iter(blocks, 1, datetime.date.max.toordinal()))
+
+def _new_block(user_key, layout, day_zero):
+  """Returns a new, empty WeightBlock of a layout."""
+  return WeightBlock(key_name=layout.key_name(day_zero),
+                     parent=user_key,
+                     user_info=user_key,
+                     day_zero=day_zero)
+
+def read_users(user_infos, start, end, samples=None):
+  """Reads, smooths and samples the same date range for many users.
+
+  The blocks of all of the users are fetched together, in batches that span
+  users, so that the number of round trips depends on the number of blocks
+  rather than the number of users.
+
+  Args:
+    user_infos: UserInfo entities; each user's gamma and trend model are used
+    start, end: the date range, as for WeightData.smoothed_weight_iter
+    samples: the most entries to return per user, or None for all of them
+
+  Returns:
+    a list with a dict per user, holding the columns 'dates', 'weights' and
+    'smoothed'
+  """
+  assert start < end
+  early_start = start - datetime.timedelta(days=DECAY_SETUP_DAYS)
+  first_day = early_start.toordinal()
+  end_day = end.toordinal()
+
+  # Each job starts a fetch and returns something to wait on for its blocks.
+  jobs = []
+  keys = []
+  for user_info in user_infos:
+    layout = WeightData(user_info).layout
+    day_zeros = layout.day_zeros(first_day, end_day)
+    if len(day_zeros) <= MAX_KEYED_FETCH_BLOCKS:
+      keys.extend(layout.key(user_info.key(), day_zero)
+                  for day_zero in day_zeros)
     else:
-      # We've got one hanging out there that needs to be committed.
-      # Note that because we assert that we have at least one entry, we will
-      # always have a final block to put, so there is no need to test for None.
-      block.put()
+      query = WeightBlock.all()
+      query.filter('user_info =', user_info.key())
+      query.filter('day_zero >=', day_zeros[0])
+      query.filter('day_zero <=', day_zeros[-1])
+      jobs.append(lambda query=query, layout=layout:
+                  (block for block in query.run() if layout.holds(block)))
+  for i in xrange(0, len(keys), MULTI_USER_FETCH_KEYS):
+    jobs.insert(i // MULTI_USER_FETCH_KEYS,
+                lambda chunk=keys[i:i + MULTI_USER_FETCH_KEYS]:
+                db.get_async(chunk))
+
+  blocks_by_user = {}
+  op = rpcstats.operation('read_users', '%d users, %s..%s' % (
+      len(user_infos), start, end))
+  with op:
+    jobs = iter(jobs)
+    in_flight = collections.deque(job() for job in
+                                  itertools.islice(jobs, MULTI_USER_FETCHES))
+    while in_flight:
+      fetch = in_flight.popleft()
+      # Keep the pipeline full while waiting for the oldest fetch.
+      job = next(jobs, None)
+      if job is not None:
+        in_flight.append(job())
+      with spans.span('query'):
+        if hasattr(fetch, 'get_result'):
+          blocks = fetch.get_result()
+        else:
+          blocks = list(fetch)
+      for block in blocks:
+        if block is not None:
+          blocks_by_user.setdefault(block.parent_key(), []).append(block)
+
+  results = []
+  for user_info in user_infos:
+    blocks = sorted(blocks_by_user.get(user_info.key(), ()),
+                    key=lambda block: block.day_zero)
+    entries = list(_block_entry_iter(blocks, first_day, end_day))
+    rows = list(_smooth_entries(entries, start, end, samples,
+                                user_info.gamma, user_info.trend_model))
+    results.append({
+      'dates': [d for d, w, s in rows],
+      'weights': [w for d, w, s in rows],
+      'smoothed': [s for d, w, s in rows],
+    })
+  return results
+
+class _BlockFetch(object):
+  """WeightBlocks that are being fetched, in day_zero order.
+
+  Iterating waits for each batch of blocks in turn, so the first ones can be
+  used while the rest are still on their way.
+  """
+  def __init__(self, op, rpcs=None, query_iter=None, layout=None):
+    """The blocks come from either rpcs, a list of batch gets, or query_iter,
+    whose blocks are kept only if they belong to layout."""
+    self._op = op
+    self._rpcs = rpcs
+    self._query_iter = query_iter
+    self._layout = layout
+
+  def __iter__(self):
+    if self._query_iter is not None:
+      while True:
+        with spans.span('query'):
+          with self._op:
+            block = next(self._query_iter, None)
+        if block is None:
+          return
+        if self._layout.holds(block):
+          yield block
+    else:
+      for rpc in self._rpcs:
+        with spans.span('query'):
+          with self._op:
+            blocks = rpc.get_result()
+        for block in blocks:
+          # Blocks that were never written come back as None.
+          if block is not None:
+            yield block
+
+class _RecentEntryFetch(object):
+  """The most recent weight entry, being looked for.  See get_result()."""
+  def __init__(self, query, op, pending=None):
+    self._op = op
+    self._pending = pending
+    with op:
+      self._results = query.run(limit=1)
+
+  @spans.timed('most_recent_entry')
+  def get_result(self):
+    """Returns the most recent date,weight pair, or None if there isn't one."""
+    with self._op:
+      values = list(self._results)
+    entry = None
+    if values:
+      block = values[0]
+      for rel_day, weight in reversed(list(block.slots())):
+        if weight >= 0.0:
+          entry = datetime.date.fromordinal(block.day_zero + rel_day), weight
+          break
+      # If nothing was found in the block, it might as well not be there.
+    if self._pending:
+      today = datetime.date.today()
+      pending = [item for item in self._pending.iteritems() if item[0] <= today]
+      if pending:
+        latest = max(pending)
+        if entry is None or latest[0] >= entry[0]:
+          entry = latest
+    return entry
+
+def _block_entry_iter(blocks, start_day, end_day):
+  """Yields the non-empty date,weight pairs from start_day to end_day."""
+  for block in blocks:
+    day_zero = block.day_zero
+    for rel_day, weight in block.slots():
+      day = rel_day + day_zero
+      if start_day <= day <= end_day and weight >= 0.0:
+        yield datetime.date.fromordinal(day), weight
+
+def _primed_trend(entries, start, gamma, model):
+  """Primes a trend model with the entries before start, as _smooth_entries
+  does.
+
+  Returns:
+    (split, trend) where split is the index of the first entry from start on,
+    and trend is the model to continue through the entries from there
+  """
+  split = bisect.bisect_left(entries, (start,))
+
+  if model not in (None, 'ewma'):
+    # The other models keep their state, so they are simply run through the
+    # early days and then on through the range.
+    trend = make_trend_model(model, gamma)
+    for date, weight in entries[:split]:
+      trend.update(date, weight)
+    return split, trend
+
+  # The priming range ends with (and so includes) the start date.
+  early_entries = entries[:split]
+  if split < len(entries) and entries[split][0] == start:
+    early_entries.append(entries[split])
+  early_smoothed = list(
+      decaying_average_iter(full_entry_iter(iter(early_entries))))
+  smooth_start = None
+  if early_smoothed:
+    smooth_start = early_smoothed[-1][-1]
+  return split, make_trend_model('ewma', gamma, smooth_start)
+
+def _smooth_entries(entries, start, end, samples, gamma, model):
+  """Smooths entries from DECAY_SETUP_DAYS before start through end, returning
+  the sampled and smoothed entries from start on (see smoothed_weight_iter).
+  """
+  split, trend = _primed_trend(entries, start, gamma, model)
+
+  # Get the sampled raw weights and smoothed function:
+  entry_iter = iter(entries[split:])
+  if samples is not None:
+    entry_iter = sample_entries(entry_iter, start, end, samples)
+  if model not in (None, 'ewma'):
+    return trend.iter(entry_iter)
+  smoothed_iter = decaying_average_iter(entry_iter,
+                                        gamma=gamma,
+                                        start=trend.value)
+
+  return smoothed_iter
+
+def _pending_entry_iter(entries, pending, start_date, end_date):
+  """Yields entries with the pending {date: weight} values from start_date to
+  end_date in place of the stored ones, in date order.  A negative pending
+  weight clears the stored one."""
+  merged = dict(entries)
+  for date, weight in pending.iteritems():
+    if start_date <= date <= end_date:
+      merged[date] = weight
+  for date in sorted(merged):
+    if merged[date] >= 0.0:
+      yield date, merged[date]
 
 def full_entry_iter(entries):
   """Take entries from the datastore, which may have gaps, and return an
@@ -106,6 +106,44 @@ def date_labels(dates):
 
   return [d.strftime(format) for d in dates]
 
+_SIMPLE_CHARS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+_EXTENDED_CHARS = _SIMPLE_CHARS + '-.'
+# Every two-character extended value, indexed by the quantized value.
+_EXTENDED_PAIRS = [a + b for a in _EXTENDED_CHARS for b in _EXTENDED_CHARS]
+
+def _encode_simple_column(values, mn, rng):
+  S = _SIMPLE_CHARS
+  N = len(S)
+  return "".join(['_' if v is None else S[int((N - 1) * (v - mn) / rng)]
+                  for v in values])
+
+def _encode_extended_column(values, mn, mx, rng):
+  if len(values) <= 1:
+    return ''
+  pairs = _EXTENDED_PAIRS
+  N = len(pairs)
+  enc = []
+  append = enc.append
+  for v in values:
+    if v is None or not (mn <= v <= mx):
+      append('__')
+    else:
+      append(pairs[int((N - 1) * (v - mn) / rng)])
+  return "".join(enc)
+
+def _encode_text_column(values, mn, mx, rng):
+  N = 100
+  enc = []
+  append = enc.append
+  for v in values:
+    if v is None or not (mn <= v <= mx):
+      append('-1')
+    else:
+      scaled = N * (v - mn) / rng
+      assert 0.0 <= scaled <= N
+      append("%0.1f" % scaled)
+  return ",".join(enc)
+
 def chartserver_data_params(entries, width, height, showindex=None):
   """Create chartserver url data parameters
 
@@ -130,34 +168,92 @@ def chartserver_data_params(entries, width, height, showindex=None):
     A list of chartserver url parameters (what will be separated by & in the
     final URL)
 
+  The encoding is picked from the range of the values: simple, extended or
+  text, in that order of preference.
+
+  >>> d = [datetime.date(2012, 1, i) for i in range(1, 6)]
+  >>> chartserver_data_params(zip(d, [150.0, 150.2, 150.4, 150.6, 150.7],
+  ...                                [150.5, None, 151.0, 149.5, 150.9]),
+  ...                         300, 200, showindex=1)
+  ['chd=s1:Ucksw,o_9A4', 'chxt=x,y', 'chxl=1:|149.5|150.2|151.0|0:|01|03|05']
+  >>> chartserver_data_params(zip(d, [150.0, 160.0, 175.0, 170.0],
+  ...                                [150.0, None, 200.0, 165.0]),
+  ...                         300, 200, showindex=1)
+  ['chd=e1:AAMzf.Zm,AA__..TM', 'chxt=x,y', 'chxl=1:|150.0|175.0|200.0|0:|01|02|04']
+  >>> chartserver_data_params(zip(d, [100.0, 250.0, 300.0],
+  ...                                [100.0, 400.0, None]),
+  ...                         300, 200, showindex=1)
+  ['chd=t1:0.0,50.0,66.7|0.0,100.0,-1', 'chxt=x,y', 'chxl=1:|100.0|250.0|400.0|0:|01|02|03']
+  >>> chartserver_data_params([(d[0], 150.0, 190.0)], 300, 200, showindex=1)
+  ['chd=e1:,', 'chxt=x,y', 'chxl=1:|150.0|170.0|190.0|0:|01|01']
+  >>> chartserver_data_params([(d[0], 150.0, 150.0)], 300, 200, showindex=1)
+  ['chd=s1:e,e', 'chxt=x,y', 'chxl=1:|149.9|150.0|150.1|0:|01|01']
+  >>> chartserver_data_params(zip(d, [None, None], [None, None]), 300, 200)
+  []
   """
   data = list(entries)
   if not data:
     return []
+  columns = zip(*data)
+  return chartserver_columns_params(list(columns[0]),
+                                    [list(c) for c in columns[1:]],
+                                    width,
+                                    height,
+                                    showindex)
 
-  earliest = min(x[0] for x in data)
-  latest = max(x[0] for x in data)
+def chartserver_columns_params(dates, columns, width, height, showindex=None,
+                               bounds=None):
+  """Create chartserver url data parameters from columns of values.
+
+  This is chartserver_data_params for data that is already split into columns,
+  which is cheaper to produce and to encode.  A column that appears more than
+  once in columns (the same list object) is only encoded once.
+
+  Args:
+    dates: list of dates, one per row
+    columns: list of lists of values (or None), each as long as dates
+    width: actual chartserver image width in pixels
+    height: actual chartserver image height in pixels
+    showindex: as for chartserver_data_params
+    bounds: (min, max) over all of the non-None values, if the caller already
+        knows them; otherwise they are computed here
+
+  Returns:
+    the same list of parameters as chartserver_data_params
+  """
+  if not dates:
+    return []
+
+  earliest = min(dates)
+  latest = max(dates)
 
   typeindex = ''
   if showindex is not None:
     typeindex = str(showindex)
-  
-  # min and max are usually pretty easy to calculate, but in this case it is a
-  # little harder since we can have None values sprinkled throughout the whole
-  # set of data.
-  mn = None
-  mx = None
-  for row in data:
-    non_none = [x for x in row[1:] if x is not None]
-    if len(non_none) > 0:
-      if mx is None:
-        mx = max(non_none)
-      else:
-        mx = max(mx, *non_none)
-      if mn is None:
-        mn = min(non_none)
-      else:
-        mn = min(mn, *non_none)
+
+  # Duplicated columns only need to be looked at once.
+  distinct = []
+  seen = set()
+  for column in columns:
+    if id(column) not in seen:
+      seen.add(id(column))
+      distinct.append(column)
+
+  if bounds is not None:
+    mn, mx = bounds
+  else:
+    # We can have None values sprinkled throughout the whole set of data.
+    mn = None
+    mx = None
+    for column in distinct:
+      non_none = [x for x in column if x is not None]
+      if non_none:
+        cmn = min(non_none)
+        cmx = max(non_none)
+        if mn is None or cmn < mn:
+          mn = cmn
+        if mx is None or cmx > mx:
+          mx = cmx
 
   if mn is None or mx is None:
     return []
@@ -166,35 +262,30 @@ def chartserver_data_params(entries, width, height, showindex=None):
     mn = mn - 0.1
     mx = mx + 0.1
 
-  num_days = latest.toordinal() - earliest.toordinal()
+  rng = mx - mn
 
   # maximum resolution of 0.05 lbs (1/20 lb) is plenty (handles 0.25 and 0.1,
   # but probably overkill)
   max_unique_values = 20 * (mx - mn) + 1
   logging.info("max unique: %d", max_unique_values)
 
-  data_param = 'chd='
-  num_columns = len(data[0])
-
   if max_unique_values <= 62:
     logging.info("using simple encoding")
     # We can use simple encoding
-    e = []
-    for i in range(1, num_columns):
-      e.append(chartserver_simple_encode([x[i] for x in data], mn=mn, mx=mx))
-    data_param += "s%s:%s" % (typeindex, ",".join(e))
+    encoding, separator = 's', ','
+    encode = lambda values: _encode_simple_column(values, mn, rng)
   elif max_unique_values <= 4096:
     # We can use extended encoding
-    e = []
-    for i in range(1, num_columns):
-      e.append(chartserver_extended_encode([x[i] for x in data], mn=mn, mx=mx))
-    data_param += "e%s:%s" % (typeindex, ",".join(e))
+    encoding, separator = 'e', ','
+    encode = lambda values: _encode_extended_column(values, mn, mx, rng)
   else:
     # We have to use text encoding
-    e = []
-    for i in range(1, num_columns):
-      e.append(chartserver_text_encode([x[i] for x in data], mn=mn, mx=mx))
-    data_param += "t%s:%s" % (typeindex, "|".join(e))
+    encoding, separator = 't', '|'
+    encode = lambda values: _encode_text_column(values, mn, mx, rng)
+
+  encoded = dict((id(column), encode(column)) for column in distinct)
+  data_param = 'chd=%s%s:%s' % (
+      encoding, typeindex, separator.join(encoded[id(c)] for c in columns))
 
   params = [data_param]
 
@@ -239,7 +330,13 @@ def chartserver_weight_url(width, height, smoothed_iter):
   Args:
     width: chart width in pixels
     height: chart height in pixels
-    smoothed_iter: iterator over raw,smoothed weight pairs
+    smoothed_iter: iterator over date,raw,smoothed weight triples
+
+  >>> d = [datetime.date(2012, 1, i) for i in range(1, 6)]
+  >>> chartserver_weight_url(300, 200, zip(
+  ...     d, [150.0, 151.0, None, 149.0, 152.5],
+  ...        [150.0, 150.1, 150.1, 149.99, 150.24]))
+  'http://chart.apis.google.com/chart?chs=300x200&cht=lc&chm=F,4488ff,0,-1,3|D,ccddff,0,0,3&chd=e1:SSUGUGSGWq,SSkk__AA..,SSkk__AA..,SSkk__AA..&chxt=x,y&chxl=1:|149.0|150.8|152.5|0:|01|03|05'
   """
   logging.debug("w=%d h=%d", width, height)
   params = [
@@ -247,15 +344,36 @@ def chartserver_weight_url(width, height, smoothed_iter):
       "cht=lc",
       "chm=F,4488ff,0,-1,3|D,ccddff,0,0,3",
       ]
-  # The smoothed_iter pairs are reversed so that the smooth line is first.
-  # This means that the raw dataset will be repeated three times, which is what
-  # we want for financial markers to do the right thing.
+  # Split the rows into columns, finding the value bounds along the way.
+  dates = []
+  raws = []
+  smooths = []
+  mn = None
+  mx = None
+  for date, raw, smooth in smoothed_iter:
+    dates.append(date)
+    raws.append(raw)
+    smooths.append(smooth)
+    for v in (raw, smooth):
+      if v is not None:
+        if mn is None or v < mn:
+          mn = v
+        if mx is None or v > mx:
+          mx = v
+  # The smooth line is first.  The raw dataset is repeated three times, which
+  # is what we want for financial markers to do the right thing; being the same
+  # list, it is only encoded once.
   params.extend(
-      chartserver_data_params(
-        ((date, smooth,
-          raw, raw, raw) for date, raw, smooth in smoothed_iter),
+      chartserver_columns_params(
+        dates,
+        [smooths, raws, raws, raws],
         width=width,
         height=height,
-        showindex=1)
+        showindex=1,
+        bounds=(mn, mx))
       )
   return "http://chart.apis.google.com/chart?" + "&".join(params)
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
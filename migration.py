@@ -0,0 +1,225 @@
+"""Online migration of users' weights from one BlockLayout to another.
+
+Each user is moved in two steps, each a transaction on the user's entity
+group:
+
+  copy - all of the user's blocks of their current layout are read and written
+         again as blocks of the new layout, which are checked against them
+         (the number of entries and a checksum of them must match).  The
+         user's DataVersion then names the new layout, with the old one as
+         old_layout, so that from then on every write goes to the blocks of
+         both.  UserInfo.block_layout is changed too, so that readers move to
+         the new layout as their settings are refreshed, and the summary index
+         is dropped, to be rebuilt for the new layout.
+  drop - once every settings cookie that could still name the old layout has
+         expired (GRACE_SECONDS after the copy), the blocks of the two layouts
+         are checked against each other again and the old ones are deleted.
+
+Readers never see a user's data missing or half moved: until the drop, the
+blocks of both layouts hold the same entries.
+
+Users are visited by a chain of walk tasks on QUEUE, each of which reads the
+next USERS_PER_WALK UserInfo keys from a query cursor and adds a task for
+each of them.  The queue's rate and max_concurrent_requests (see queue.yaml)
+limit how fast and how many users are moved at once.  Every step is safe to
+repeat, and tasks are named after the run, so a walk task that is retried, or
+a run that is started again with the same name, only moves the users it
+hasn't yet.
+
+Start a run as an administrator with
+
+  POST /tasks/migrate_layout?step=walk&layout=2&min_blocks=50
+
+which moves every user with at least min_blocks blocks to layout 2.
+"""
+
+import datetime
+import hashlib
+import logging
+import time
+import zlib
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+from datamodel import DataVersion, UserInfo, WeightBlock, WeightData
+from datamodel import WeightSummaryIndex, LAYOUTS, DEFAULT_LAYOUT
+from datamodel import BATCH_UPDATE_BLOCKS, block_entries
+from usercontext import SETTINGS_COOKIE_MAX_AGE
+
+QUEUE = 'layout-migration'
+URL = '/tasks/migrate_layout'
+
+USERS_PER_WALK = 100
+
+# How long after the copy the old blocks are kept, so that readers still
+# using settings from before it find their data.
+GRACE_SECONDS = SETTINGS_COOKIE_MAX_AGE + 600
+
+def entries_checksum(entries):
+  """Returns the number of date,weight entries and a CRC-32 of them.
+
+  >>> entries_checksum([(datetime.date(2012, 1, 1), 180.0),
+  ...                   (datetime.date(2012, 1, 3), 179.5)])
+  (2, 3836360754)
+  """
+  crc = 0
+  for date, weight in entries:
+    crc = zlib.crc32('%d:%r;' % (date.toordinal(), weight), crc)
+  return len(entries), crc & 0xffffffff
+
+def _task_name(run, *parts):
+  return '-'.join(['layout', run] + [str(part) for part in parts])
+
+def _user_task_name(run, user_key, step):
+  return _task_name(run, hashlib.sha1(str(user_key)).hexdigest()[:20], step)
+
+def _add(task):
+  try:
+    taskqueue.Queue(QUEUE).add(task)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    # Added by an earlier try of the same step.
+    pass
+
+def walk(run, layout, min_blocks, page=0, cursor=None):
+  """Adds a copy task for each of the next USERS_PER_WALK users, and a walk
+  task for the ones after them."""
+  query = UserInfo.all(keys_only=True)
+  query.order('__key__')
+  if cursor:
+    query.with_cursor(cursor)
+  user_keys = query.fetch(USERS_PER_WALK)
+  for user_key in user_keys:
+    _add(taskqueue.Task(url=URL,
+                        params={'step': 'user', 'user': str(user_key),
+                                'run': run, 'layout': layout,
+                                'min_blocks': min_blocks},
+                        name=_user_task_name(run, user_key, 'copy')))
+  if len(user_keys) == USERS_PER_WALK:
+    _add(taskqueue.Task(url=URL,
+                        params={'step': 'walk', 'run': run, 'layout': layout,
+                                'min_blocks': min_blocks, 'page': page + 1,
+                                'cursor': query.cursor()},
+                        name=_task_name(run, 'walk', page + 1)))
+  logging.info("Layout migration %s: page %d queued %d users", run, page,
+               len(user_keys))
+  return len(user_keys)
+
+def migrate_user(run, user_key, layout, min_blocks=0):
+  """Does the next step of moving a user to a layout, if there is one.
+
+  Returns:
+    what was done: 'copied', 'waiting' (to drop the old blocks), 'dropped',
+    'skipped' (the user has fewer than min_blocks blocks, or too many to
+    copy in one transaction), 'current' (nothing to do) or 'mismatch' (the
+    layouts' entries differ, so the old blocks are kept; see the logs)
+  """
+  layout = LAYOUTS[layout]
+  data_version = db.get(DataVersion.key_for(user_key))
+  if data_version is not None and data_version.old_layout is not None:
+    result = _drop(user_key)
+  elif (data_version is not None and
+        (data_version.layout or DEFAULT_LAYOUT) == layout.number):
+    result = 'current'
+  elif (min_blocks and
+        WeightBlock.all(keys_only=True).ancestor(user_key).count(
+            limit=min_blocks) < min_blocks):
+    result = 'skipped'
+  else:
+    result = _copy(user_key, layout)
+
+  if result in ('copied', 'waiting'):
+    _add(taskqueue.Task(url=URL,
+                        params={'step': 'user', 'user': str(user_key),
+                                'run': run, 'layout': layout.number},
+                        countdown=GRACE_SECONDS))
+  logging.info("Layout migration %s: %s %s", run, user_key, result)
+  return result
+
+def _copy(user_key, layout):
+  weight_data = WeightData(user_key)
+
+  def txn():
+    version_key = DataVersion.key_for(user_key)
+    user_info, data_version = db.get([user_key, version_key])
+    if data_version is None:
+      data_version = DataVersion(key=version_key)
+    if (data_version.old_layout is not None or
+        (data_version.layout or DEFAULT_LAYOUT) == layout.number):
+      return 'current'
+    old_layout = data_version.layouts()[0]
+    entries = weight_data.all_entries(old_layout)
+    blocks = weight_data.new_blocks(entries, layout=layout)
+    if len(blocks) > BATCH_UPDATE_BLOCKS:
+      # A write must stay within the limits of changed_blocks.
+      logging.warning("%s has %d blocks in layout %d, too many to copy",
+                      user_key, len(blocks), layout.number)
+      return 'skipped'
+    if entries_checksum(block_entries(blocks)) != entries_checksum(entries):
+      logging.error("%s: the copy to layout %d doesn't match", user_key,
+                    layout.number)
+      return 'mismatch'
+
+    data_version.version += 1
+    for block in blocks:
+      block.version = data_version.version
+    data_version.layout = layout.number
+    data_version.old_layout = old_layout.number
+    data_version.layout_changed = datetime.datetime.utcnow()
+    user_info.block_layout = layout.number
+    db.put(blocks + [data_version, user_info])
+    db.delete(WeightSummaryIndex.key_for(user_key))
+    return 'copied'
+
+  return db.run_in_transaction(txn)
+
+def _drop(user_key):
+  weight_data = WeightData(user_key)
+
+  def txn():
+    version_key = DataVersion.key_for(user_key)
+    user_info, data_version = db.get([user_key, version_key])
+    if data_version is None or data_version.old_layout is None:
+      return 'current'
+    now = datetime.datetime.utcnow()
+    if now - data_version.layout_changed < datetime.timedelta(
+        seconds=GRACE_SECONDS):
+      return 'waiting'
+    layout, old_layout = data_version.layouts()
+    if user_info.block_layout != layout.number:
+      # A settings change made while the blocks were being copied wrote back
+      # the old layout, so readers may still be using it.
+      user_info.block_layout = layout.number
+      data_version.layout_changed = now
+      db.put([user_info, data_version])
+      return 'waiting'
+
+    old_blocks = weight_data.all_blocks(old_layout)
+    entries = block_entries(old_blocks)
+    if (entries_checksum(weight_data.all_entries(layout)) !=
+        entries_checksum(entries)):
+      logging.error("%s: layouts %d and %d don't match", user_key,
+                    layout.number, old_layout.number)
+      return 'mismatch'
+    data_version.old_layout = None
+    data_version.put()
+    db.delete(old_blocks)
+    index = db.get(WeightSummaryIndex.key_for(user_key))
+    if index is not None and index.layout == old_layout.number:
+      index.delete()
+    return 'dropped'
+
+  return db.run_in_transaction(txn)
+
+def start(layout, min_blocks=0, run=None):
+  """Starts moving users with at least min_blocks blocks to a layout.
+
+  Returns:
+    the name of the run
+  """
+  if layout not in LAYOUTS:
+    raise ValueError("No block layout %r" % layout)
+  if run is None:
+    run = '%d-%d' % (layout, int(time.time()))
+  walk(run, layout, min_blocks)
+  return run
@@ -0,0 +1,178 @@
+"""Projections of the trend toward a goal weight.
+
+The trend over a recent window of days is fit with a least-squares line, whose
+slope is the current rate of loss or gain.  Extending the line gives the date
+the goal should be reached, and the uncertainty of the fit gives a range of
+dates around it.
+
+Fits are computed in closed form from running sums (see LineFits), so that
+after a single pass over the trend, the fit over any window of it costs the
+same small constant time.
+"""
+
+from __future__ import division
+
+import datetime
+import math
+
+# Two-sided 95% normal quantile, used for the confidence bands.
+Z_95 = 1.96
+
+class Fit(object):
+  """A least-squares line y = intercept + slope * x, with its uncertainty."""
+  def __init__(self, n, slope, intercept, residual_se, slope_se, mean_x,
+               sxx):
+    self.n = n
+    self.slope = slope
+    self.intercept = intercept
+    self.residual_se = residual_se
+    self.slope_se = slope_se
+    self.mean_x = mean_x
+    self.sxx = sxx
+
+  def at(self, x):
+    return self.intercept + self.slope * x
+
+  def band(self, x, z=Z_95):
+    """Returns the low and high ends of the confidence band for the line at x.
+    """
+    if self.residual_se is None:
+      return None, None
+    half = z * self.residual_se * math.sqrt(
+        1 / self.n + (x - self.mean_x) ** 2 / self.sxx)
+    y = self.at(x)
+    return y - half, y + half
+
+class LineFits(object):
+  """Least-squares line fits over any run of points, in constant time each.
+
+  >>> fits = LineFits([0, 1, 2, 3, 4], [10.0, 9.5, 9.0, 8.5, 8.0])
+  >>> fit = fits.fit(1, 5)
+  >>> round(fit.slope, 6), round(fit.intercept, 6), round(fit.residual_se, 6)
+  (-0.5, 10.0, 0.0)
+  >>> fits.fit(2, 3) is None
+  True
+  """
+  def __init__(self, xs, ys):
+    self.xs = list(xs)
+    self._sx = [0.0]
+    self._sy = [0.0]
+    self._sxx = [0.0]
+    self._sxy = [0.0]
+    self._syy = [0.0]
+    for x, y in zip(self.xs, ys):
+      self._sx.append(self._sx[-1] + x)
+      self._sy.append(self._sy[-1] + y)
+      self._sxx.append(self._sxx[-1] + x * x)
+      self._sxy.append(self._sxy[-1] + x * y)
+      self._syy.append(self._syy[-1] + y * y)
+
+  def __len__(self):
+    return len(self.xs)
+
+  def fit(self, i, j):
+    """Returns the Fit of points[i:j], or None if there are fewer than two
+    distinct x values."""
+    n = j - i
+    if n < 2:
+      return None
+    sx = self._sx[j] - self._sx[i]
+    sy = self._sy[j] - self._sy[i]
+    mean_x = sx / n
+    mean_y = sy / n
+    sxx = (self._sxx[j] - self._sxx[i]) - sx * mean_x
+    sxy = (self._sxy[j] - self._sxy[i]) - sx * mean_y
+    syy = (self._syy[j] - self._syy[i]) - sy * mean_y
+    if sxx <= 0:
+      return None
+    slope = sxy / sxx
+    intercept = mean_y - slope * mean_x
+    residual_se = slope_se = None
+    if n > 2:
+      # Rounding can leave a tiny negative sum of squares for a perfect fit.
+      residual = max(0.0, syy - slope * sxy)
+      residual_se = math.sqrt(residual / (n - 2))
+      slope_se = residual_se / math.sqrt(sxx)
+    return Fit(n, slope, intercept, residual_se, slope_se, mean_x, sxx)
+
+  def fit_last_days(self, days):
+    """Returns the Fit of the points within days of the last one."""
+    if not self.xs:
+      return None
+    first_x = self.xs[-1] - days
+    i = len(self.xs)
+    while i > 0 and self.xs[i - 1] > first_x:
+      i -= 1
+    return self.fit(i, len(self.xs))
+
+def _date_reaching(goal, today, current, slope):
+  """Returns the date that a line through current today with the given slope
+  per day reaches goal, or None if it never does."""
+  if goal == current:
+    return today
+  if not slope or (goal - current) / slope <= 0:
+    return None
+  days = (goal - current) / slope
+  try:
+    return today + datetime.timedelta(days=int(math.ceil(days)))
+  except (OverflowError, ValueError):
+    # Too far off for a date, or not a number at all (an infinite or nan
+    # goal).
+    return None
+
+def project(trend, goal, windows, today=None):
+  """Projects the trend to the goal weight, for each window of recent days.
+
+  Args:
+    trend: date,trend value pairs in date order
+    goal: the goal weight, or None
+    windows: window lengths in days, e.g., (14, 28, 56)
+    today: the date to project from (default: today)
+
+  Returns:
+    a list with a dict for each window that has enough points, holding: the
+    window, the rate of change per day and per week, the trend today
+    according to the fit, and, with a goal, the date the goal is reached at
+    the fitted rate and at the slowest and fastest rates within the 95%
+    confidence interval of the fit (None when the goal is never reached at
+    that rate)
+  """
+  if today is None:
+    today = datetime.date.today()
+  origin = today.toordinal()
+  fits = LineFits([d.toordinal() - origin for d, v in trend],
+                  [v for d, v in trend])
+  results = []
+  for days in windows:
+    fit = fits.fit_last_days(days)
+    if fit is None:
+      continue
+    current = fit.at(0)
+    low, high = fit.band(0)
+    result = {
+      'window_days': days,
+      'points': fit.n,
+      'rate_per_day': fit.slope,
+      'rate_per_week': fit.slope * 7,
+      'current': current,
+      'current_low': low,
+      'current_high': high,
+    }
+    if goal is not None:
+      result['goal_date'] = _date_reaching(goal, today, current, fit.slope)
+      dates = [None, None]
+      if fit.slope_se is not None:
+        spread = Z_95 * fit.slope_se
+        dates = [_date_reaching(goal, today, current, fit.slope - spread),
+                 _date_reaching(goal, today, current, fit.slope + spread)]
+      # Whichever rate gets there sooner gives the earliest date.
+      reached = sorted(d for d in dates if d is not None)
+      result['goal_date_earliest'] = reached[0] if reached else None
+      result['goal_date_latest'] = (reached[-1] if len(reached) == 2
+                                    else None)
+    results.append(result)
+  return results
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
@@ -0,0 +1,113 @@
+"""Several weight readings a day, packed compactly.
+
+Users who turn on intraday readings (UserInfo.intraday_mode) can record any
+number of readings a day, each with the minute it was taken at.  All of the
+readings for READING_BLOCK_DAYS days are kept together in one ReadingBlock
+(see datamodel.py), packed into a string of fixed-size records of the day
+within the block, the minute of the day and the weight in hundredths, so that
+a reading costs RECORD_SIZE bytes.
+
+The rest of the application still works with one weight a day: whenever a
+day's readings change, the day's weight is set to their representative, which
+is the first, the lowest or the mean reading of the day (MODES), as the user
+chooses.  Users who don't record readings never read or write any of this.
+"""
+
+from __future__ import division
+
+import struct
+
+# Days per ReadingBlock.  Never change this: it is part of the key names.
+READING_BLOCK_DAYS = 35
+
+# Day within the block, minute of the day, weight in hundredths.
+_RECORD = struct.Struct('<BHI')
+RECORD_SIZE = _RECORD.size
+
+MODES = ('first', 'min', 'mean')
+
+# For the settings form, in the order they are offered.
+CHOICES = (
+  ('', 'Off (one weight a day)'),
+  ('first', 'First reading of the day'),
+  ('min', 'Lowest reading of the day'),
+  ('mean', 'Average of the day\'s readings'),
+)
+
+def pack(readings):
+  """Packs rel_day, minute, weight readings into a string.
+
+  >>> data = pack([(0, 430, 180.2), (0, 1290, 181.65), (3, 0, 179.0)])
+  >>> len(data) == 3 * RECORD_SIZE
+  True
+  >>> unpack(data)
+  [(0, 430, 180.2), (0, 1290, 181.65), (3, 0, 179.0)]
+  """
+  return ''.join(_RECORD.pack(rel_day, minute, int(round(weight * 100)))
+                 for rel_day, minute, weight in readings)
+
+def unpack(data):
+  """Returns the rel_day, minute, weight readings packed in data."""
+  if not data:
+    return []
+  return [(rel_day, minute, hundredths / 100)
+          for rel_day, minute, hundredths
+          in (_RECORD.unpack_from(data, offset)
+              for offset in xrange(0, len(data), RECORD_SIZE))]
+
+def merge(readings, changes):
+  """Returns readings with changes applied, in order.
+
+  A change replaces the reading for the same day and minute, if there is one;
+  a change with a negative weight removes it.
+
+  >>> merge([(0, 430, 180.2), (1, 420, 180.0)],
+  ...       [(0, 430, 180.4), (0, 420, 179.9), (1, 420, -1.0)])
+  [(0, 420, 179.9), (0, 430, 180.4)]
+  """
+  by_time = dict(((rel_day, minute), weight)
+                 for rel_day, minute, weight in readings)
+  for rel_day, minute, weight in changes:
+    if weight >= 0.0:
+      by_time[rel_day, minute] = weight
+    else:
+      by_time.pop((rel_day, minute), None)
+  return [(rel_day, minute, weight)
+          for (rel_day, minute), weight in sorted(by_time.iteritems())]
+
+def representative(weights, mode):
+  """Returns the representative of a day's weights, in time order.
+
+  >>> representative([180.4, 179.8, 180.0], 'first')
+  180.4
+  >>> representative([180.4, 179.8, 180.0], 'min')
+  179.8
+  >>> representative([180.4, 179.8, 180.0], 'mean')
+  180.07
+  """
+  if mode == 'first':
+    return weights[0]
+  if mode == 'min':
+    return min(weights)
+  if mode == 'mean':
+    return round(sum(weights) / len(weights), 2)
+  raise ValueError("Unknown intraday mode %r" % mode)
+
+def daily(readings, days, mode):
+  """Returns {rel_day: weight} for the given days, with the representative of
+  each day's readings, or -1.0 (no entry) for a day without any.
+
+  >>> daily([(0, 420, 179.9), (0, 430, 180.4), (2, 400, 179.0)], [0, 1, 2],
+  ...       'mean')
+  {0: 180.15, 1: -1.0, 2: 179.0}
+  """
+  by_day = dict((rel_day, []) for rel_day in days)
+  for rel_day, minute, weight in readings:
+    if rel_day in by_day:
+      by_day[rel_day].append(weight)
+  return dict((rel_day, representative(weights, mode) if weights else -1.0)
+              for rel_day, weights in by_day.iteritems())
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
@@ -0,0 +1,390 @@
+"""Microbenchmarks for the application's pure code paths.
+
+The benchmarks run over a synthetic multi-year weight history made by tiling
+and perturbing testdata/weight.csv, with a configurable fraction of days left
+empty.
+
+Usage (from the application directory):
+
+  python -m tools.benchmark [options]                 # print results
+  python -m tools.benchmark --save baseline.json      # record a baseline
+  python -m tools.benchmark --compare baseline.json   # check for regressions
+
+Results are printed as JSON: the parameters used to generate the data and,
+for every benchmark, the best time per call in microseconds.  In comparison
+mode every benchmark is reported with its change relative to the baseline, and
+the exit status is 1 if any of them got slower by more than --threshold.
+
+Benchmarks whose modules can't be imported (e.g., those that need Django when
+it isn't installed) are listed as skipped rather than failing the run.  The
+App Engine SDK is put on the path if it can be found (see tools/sdk.py).
+"""
+
+import csv
+import datetime
+import json
+import logging
+import optparse
+import os.path
+import random
+import sys
+import time
+
+from tools import sdk
+
+RESULTS_FORMAT = 1
+
+BENCHMARKS = []
+
+def benchmark(name):
+  """Registers a benchmark.
+
+  The decorated function takes the synthetic series (a list of date,weight
+  pairs), does any setup and returns the callable to be timed.
+  """
+  def register(setup):
+    BENCHMARKS.append((name, setup))
+    return setup
+  return register
+
+def measure(f, repeat=5, min_time=0.1):
+  """Returns the best time for one call of f, in seconds."""
+  # Find a number of calls that takes long enough to time accurately.
+  number = 1
+  while True:
+    start = time.time()
+    for i in xrange(number):
+      f()
+    elapsed = time.time() - start
+    if elapsed >= min_time:
+      break
+    number *= 2
+
+  best = elapsed / number
+  for i in xrange(repeat - 1):
+    start = time.time()
+    for j in xrange(number):
+      f()
+    best = min(best, (time.time() - start) / number)
+  return best
+
+##############################################################################
+# Synthetic data
+##############################################################################
+def load_history(path=None):
+  """Returns the date,weight pairs in testdata/weight.csv."""
+  if path is None:
+    path = os.path.join(sdk.APP_DIR, 'testdata', 'weight.csv')
+  history = []
+  with open(path) as f:
+    for row in csv.reader(f):
+      if len(row) >= 2:
+        date = datetime.datetime.strptime(row[0], '%Y-%m-%d').date()
+        history.append((date, float(row[1])))
+  return history
+
+def synthetic_series(years=5, gap_density=0.2, seed=0, history=None):
+  """Makes a weight history of the given length.
+
+  The day-to-day changes of the real history are replayed over and over, with
+  some noise added, starting where the real history starts.  Each day is left
+  out with probability gap_density.
+
+  Returns:
+    a list of date,weight pairs in date order
+  """
+  if history is None:
+    history = load_history()
+  rnd = random.Random(seed)
+  deltas = [b[1] - a[1] for a, b in zip(history, history[1:])]
+
+  day = history[0][0]
+  weight = history[0][1]
+  series = []
+  for i in xrange(int(years * 365.25)):
+    weight += deltas[i % len(deltas)] + rnd.gauss(0, 0.3)
+    # Keep the walk from drifting off somewhere unrealistic.
+    weight += (history[0][1] - weight) * 0.001
+    if rnd.random() >= gap_density:
+      series.append((day, round(weight * 10) / 10))
+    day += datetime.timedelta(days=1)
+  return series
+
+def smoothed_rows(series, gamma=0.9):
+  """Returns date,raw,smoothed rows for the series, with gaps filled in.
+
+  This is what WeightData.smoothed_weight_iter produces, computed here so that
+  the chart benchmarks don't depend on the datastore modules.
+  """
+  rows = []
+  day = series[0][0]
+  smoothed = series[0][1]
+  for date, weight in series:
+    while day < date:
+      rows.append((day, None, smoothed))
+      day += datetime.timedelta(days=1)
+    smoothed = gamma * smoothed + (1 - gamma) * weight
+    rows.append((date, weight, smoothed))
+    day = date + datetime.timedelta(days=1)
+  return rows
+
+##############################################################################
+# datamodel
+##############################################################################
+@benchmark('datamodel.full_entry_iter')
+def bench_full_entry_iter(series):
+  from datamodel import full_entry_iter
+  return lambda: list(full_entry_iter(iter(series)))
+
+@benchmark('datamodel.sample_entries')
+def bench_sample_entries(series):
+  from datamodel import sample_entries
+  start, end = series[0][0], series[-1][0]
+  return lambda: list(sample_entries(iter(series), start, end, 200))
+
+@benchmark('datamodel.scan_convert_line')
+def bench_scan_convert_line(series):
+  from datamodel import scan_convert_line
+  days = (series[-1][0] - series[0][0]).days
+  return lambda: list(scan_convert_line(0, 0, days, 199))
+
+@benchmark('datamodel.decaying_average_iter')
+def bench_decaying_average_iter(series):
+  from datamodel import decaying_average_iter
+  return lambda: list(decaying_average_iter(iter(series)))
+
+##############################################################################
+# trend
+##############################################################################
+def _bench_trend_model(name):
+  @benchmark('trend.%s' % name)
+  def bench(series):
+    import trend
+    return lambda: list(trend.make(name, 0.9).iter(iter(series)))
+  return bench
+
+for _name in ('ewma', 'ewma_days', 'holt', 'kalman'):
+  _bench_trend_model(_name)
+
+@benchmark('projection.project')
+def bench_project(series):
+  from projection import project
+  trend = [(d, s) for d, w, s in smoothed_rows(series)[-56:]]
+  today = trend[-1][0]
+  return lambda: project(trend, trend[-1][1] - 10, (14, 28, 56), today)
+
+##############################################################################
+# graph
+##############################################################################
+def _chart_columns(series):
+  rows = smoothed_rows(series)[-200:]
+  values = [r[1] for r in rows]
+  non_none = [v for v in values if v is not None]
+  return values, min(non_none), max(non_none)
+
+@benchmark('graph.chartserver_simple_encode')
+def bench_chartserver_simple_encode(series):
+  from graph import chartserver_simple_encode
+  values, mn, mx = _chart_columns(series)
+  return lambda: chartserver_simple_encode(values, mn, mx)
+
+@benchmark('graph.chartserver_extended_encode')
+def bench_chartserver_extended_encode(series):
+  from graph import chartserver_extended_encode
+  values, mn, mx = _chart_columns(series)
+  return lambda: chartserver_extended_encode(values, mn, mx)
+
+@benchmark('graph.chartserver_text_encode')
+def bench_chartserver_text_encode(series):
+  from graph import chartserver_text_encode
+  values, mn, mx = _chart_columns(series)
+  return lambda: chartserver_text_encode(values, mn, mx)
+
+@benchmark('graph.chartserver_data_params')
+def bench_chartserver_data_params(series):
+  from graph import chartserver_data_params
+  rows = [(d, s, w, w, w) for d, w, s in smoothed_rows(series)[-200:]]
+  return lambda: chartserver_data_params(rows, 600, 400, showindex=1)
+
+@benchmark('graph.chartserver_weight_url')
+def bench_chartserver_weight_url(series):
+  from graph import chartserver_weight_url
+  rows = smoothed_rows(series)[-200:]
+  return lambda: chartserver_weight_url(600, 400, iter(rows))
+
+@benchmark('graph.date_labels')
+def bench_date_labels(series):
+  from graph import date_labels
+  dates = [d for d, w in series[::30]]
+  return lambda: date_labels(dates)
+
+##############################################################################
+# util
+##############################################################################
+@benchmark('util.dates.DateDelta.fromstring')
+def bench_datedelta_fromstring(series):
+  from util.dates import DateDelta
+  specs = ('2w', '1y', '6m', '-10m-4dlast-monday', '+5y-2m_nearest_wed')
+  def run():
+    for spec in specs:
+      DateDelta.fromstring(spec)
+  return run
+
+@benchmark('util.dates.DateDelta.add_to_date')
+def bench_datedelta_add_to_date(series):
+  from util.dates import DateDelta
+  deltas = [DateDelta(months=-1), DateDelta(years=-6, months=-6),
+            DateDelta(4, 2, 1, -1), DateDelta(days=-3, to_weekday=1)]
+  dates = [d for d, w in series[::50]]
+  def run():
+    for delta in deltas:
+      for date in dates:
+        delta.add_to_date(date)
+  return run
+
+@benchmark('util.dates.dates_from_args')
+def bench_dates_from_args(series):
+  from util.dates import dates_from_args
+  today = series[-1][0]
+  args = [('All', ''), ('1y', ''), ('2w', ''), ('2008-08-04', '4w'),
+          ('4m', '2m'), ('2008-08-04', '2008-08-11')]
+  def run():
+    for start, end in args:
+      dates_from_args(start, end, today)
+  return run
+
+@benchmark('util.rangetree.SegmentTree.query')
+def bench_segment_tree_query(series):
+  from util.rangetree import SegmentTree
+  weights = [w for d, w in series]
+  tree = SegmentTree(weights, min, float('inf'))
+  n = len(weights)
+  ranges = [(i, n - i) for i in xrange(0, n // 2, max(1, n // 100))]
+  def run():
+    for i, j in ranges:
+      tree.query(i, j)
+  return run
+
+@benchmark('util.forms.csv_row_iter')
+def bench_csv_row_iter(series):
+  from util.forms import csv_row_iter
+  lines = ['%s,%.1f\n' % (d, w) for d, w in series]
+  return lambda: list(csv_row_iter(lines))
+
+##############################################################################
+# Running and comparing
+##############################################################################
+def run(series, name_filter='', repeat=5):
+  """Runs the matching benchmarks.
+
+  Returns:
+    ({name: microseconds per call}, {name: reason skipped})
+  """
+  results = {}
+  skipped = {}
+  for name, setup in BENCHMARKS:
+    if name_filter not in name:
+      continue
+    try:
+      f = setup(series)
+    except ImportError, e:
+      skipped[name] = str(e)
+      continue
+    results[name] = round(measure(f, repeat) * 1e6, 3)
+  return results, skipped
+
+def compare(baseline, current, threshold):
+  """Compares two sets of results.
+
+  Returns:
+    ({name: {'baseline', 'current', 'change'}}, [names that regressed])
+  """
+  report = {}
+  regressed = []
+  for name in sorted(set(baseline) & set(current)):
+    change = current[name] / baseline[name] - 1.0
+    report[name] = {
+      'baseline': baseline[name],
+      'current': current[name],
+      'change': round(change, 4),
+    }
+    if change > threshold:
+      regressed.append(name)
+  return report, regressed
+
+def main():
+  parser = optparse.OptionParser(usage=__doc__)
+  parser.add_option('--filter', default='',
+                    help='only run benchmarks whose names contain this')
+  parser.add_option('--repeat', type='int', default=5)
+  parser.add_option('--years', type='float', default=5,
+                    help='length of the synthetic history')
+  parser.add_option('--gap-density', type='float', default=0.2,
+                    help='fraction of days without an entry')
+  parser.add_option('--seed', type='int', default=0)
+  parser.add_option('--save', metavar='FILE',
+                    help='write the results to FILE as a baseline')
+  parser.add_option('--compare', metavar='FILE',
+                    help='compare the results against a saved baseline')
+  parser.add_option('--threshold', type='float', default=0.10,
+                    help='largest slowdown tolerated by --compare (0.10)')
+  options, args = parser.parse_args()
+
+  try:
+    import google.appengine
+  except ImportError:
+    try:
+      sdk.setup_sdk_path()
+    except RuntimeError, e:
+      sys.stderr.write("%s; only the pure modules can be run\n" % e)
+  if sdk.APP_DIR not in sys.path:
+    sys.path.insert(0, sdk.APP_DIR)
+
+  # Some of the code under test logs on every call.
+  logging.disable(logging.CRITICAL)
+
+  params = {
+    'years': options.years,
+    'gap_density': options.gap_density,
+    'seed': options.seed,
+  }
+  series = synthetic_series(**params)
+  results, skipped = run(series, options.filter, options.repeat)
+  output = {
+    'format': RESULTS_FORMAT,
+    'params': params,
+    'entries': len(series),
+    'results_us': results,
+    'skipped': skipped,
+  }
+
+  if options.save:
+    with open(options.save, 'w') as f:
+      json.dump(output, f, indent=2, sort_keys=True)
+
+  status = 0
+  if options.compare:
+    with open(options.compare) as f:
+      baseline = json.load(f)
+    if baseline.get('params') != params:
+      sys.stderr.write("warning: baseline was made with %r\n" %
+                       baseline.get('params'))
+    report, regressed = compare(baseline['results_us'], results,
+                                options.threshold)
+    output = {
+      'format': RESULTS_FORMAT,
+      'params': params,
+      'threshold': options.threshold,
+      'comparison': report,
+      'regressed': regressed,
+      'skipped': skipped,
+    }
+    if regressed:
+      status = 1
+
+  json.dump(output, sys.stdout, indent=2, sort_keys=True)
+  sys.stdout.write('\n')
+  sys.exit(status)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,402 @@
+"""Exports every user's settings and weights to a snapshot, and restores them.
+
+The snapshot is a directory holding a manifest (manifest.json) and shards of
+SHARD_USERS users each.  A shard is a gzipped file with one JSON line per
+user, holding the user's settings and their entries as two columns: the days
+(as date ordinals, each after the first stored as the difference from the
+one before) and the weights, and any intraday readings, as each
+ReadingBlock's day_zero and packed readings (in base64).  Every user's columns
+and readings carry a CRC-32, and the
+manifest records the SHA-1 of every shard file, both of which are checked
+when restoring.
+
+The datastore is reached either through remote_api (--remote, which needs the
+remote_api builtin in app.yaml and an administrator's credentials) or through
+a local datastore file, as written by the dev_appserver (--datastore-file).
+The App Engine SDK must be on the path (see tools/sdk.py).
+
+Usage (from the application directory):
+
+  python -m tools.export export DIR [--remote HOST | --datastore-file FILE]
+  python -m tools.export restore DIR [--remote HOST | --datastore-file FILE]
+
+Export splits the users into shards by key, then exports the shards with a
+pool of --workers processes.  The manifest is rewritten as each shard is
+finished, so an interrupted export can be resumed by running it again with
+the same DIR: shards whose files are complete are skipped.  Restore keeps
+track of the shards it has written in DIR/restored.json the same way, and
+writes each shard's entities with a few large batch puts.  Restoring is meant
+for an empty datastore.  Restored blocks are given versions from 1 up, one
+for every BATCH_UPDATE_BLOCKS of a user's blocks, as if they had been written
+by batch_update, so that /api/changes can hand them out a version at a time
+(see DataVersion and WeightData.changed_blocks).
+
+Both commands print a JSON report: users, entries and bytes processed,
+the elapsed time and the throughput.
+"""
+
+import base64
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import multiprocessing
+import optparse
+import os
+import os.path
+import sys
+import time
+import zlib
+
+from tools import sdk
+
+SNAPSHOT_FORMAT = 2
+# Snapshots restore can read.  Format 1 has no intraday readings.
+RESTORE_FORMATS = (1, 2)
+MANIFEST = 'manifest.json'
+RESTORED = 'restored.json'
+
+# Users per shard, and UserInfo keys fetched per batch when splitting them.
+SHARD_USERS = 200
+KEY_BATCH = 1000
+
+# Most entities written by one batch put.
+RESTORE_PUT_ENTITIES = 400
+
+# The UserInfo properties kept with each user, besides the user itself.
+SETTINGS = ('gamma', 'scale_resolution', 'settings_version', 'xsrf_secret',
+            'trend_model', 'goal_weight', 'block_layout', 'intraday_mode')
+
+def connect(options):
+  """Connects this process to the datastore chosen by the options."""
+  if options.remote:
+    from google.appengine.ext.remote_api import remote_api_stub
+    remote_api_stub.ConfigureRemoteApiForOAuth(options.remote,
+                                               '/_ah/remote_api')
+  else:
+    sdk.activate_testbed(options.datastore_file)
+
+def _init_worker(options):
+  sdk.setup_sdk_path()
+  connect(options)
+  logging.getLogger().setLevel(logging.WARNING)
+
+def columns_checksum(days, weights, readings=None):
+  """Returns the CRC-32 of a user's day and weight columns and their
+  [day_zero, packed readings] pairs, if they have any.
+
+  >>> columns_checksum([734503, 1, 1], [180.5, 180.0, 179.5])
+  1083212757
+  >>> columns_checksum([734503, 1, 1], [180.5, 180.0, 179.5], [])
+  1083212757
+  """
+  if not readings:
+    return zlib.crc32(json.dumps([days, weights])) & 0xffffffff
+  return zlib.crc32(json.dumps([days, weights, readings])) & 0xffffffff
+
+def encode_days(ordinals):
+  """Returns the ordinals with each one after the first made relative to the
+  one before.
+
+  >>> encode_days([734503, 734504, 734510])
+  [734503, 1, 6]
+  >>> decode_days(encode_days([734503, 734504, 734510]))
+  [734503, 734504, 734510]
+  """
+  return [day - previous for day, previous
+          in zip(ordinals, [0] + ordinals[:-1])]
+
+def decode_days(days):
+  ordinals = []
+  day = 0
+  for delta in days:
+    day += delta
+    ordinals.append(day)
+  return ordinals
+
+def file_sha1(path):
+  digest = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), ''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+def write_json(path, value):
+  """Replaces the file at path with value as JSON, all at once."""
+  temp = path + '.tmp'
+  with open(temp, 'w') as f:
+    json.dump(value, f, indent=1, sort_keys=True)
+  os.rename(temp, path)
+
+def read_json(path, default=None):
+  if not os.path.exists(path):
+    return default
+  with open(path) as f:
+    return json.load(f)
+
+def plan_shards():
+  """Splits the users into shards of SHARD_USERS by key.
+
+  Returns:
+    a list of dicts holding the name and the first and last UserInfo key (as
+    strings) of each shard
+  """
+  from datamodel import UserInfo
+
+  shards = []
+  first = last = None
+  count = 0
+  query = UserInfo.all(keys_only=True)
+  query.order('__key__')
+  for key in query.run(batch_size=KEY_BATCH):
+    if first is None:
+      first = key
+    last = key
+    count += 1
+    if count == SHARD_USERS:
+      shards.append((first, last))
+      first = None
+      count = 0
+  if first is not None:
+    shards.append((first, last))
+  return [{'name': 'shard-%05d.gz' % i, 'first': str(first),
+           'last': str(last)}
+          for i, (first, last) in enumerate(shards)]
+
+def export_shard(args):
+  """Writes one shard's users to its file (run in a worker process)."""
+  directory, shard = args
+  from google.appengine.ext import db
+  from datamodel import ReadingBlock, UserInfo, WeightData
+
+  query = UserInfo.all()
+  query.filter('__key__ >=', db.Key(shard['first']))
+  query.filter('__key__ <=', db.Key(shard['last']))
+  query.order('__key__')
+
+  path = os.path.join(directory, shard['name'])
+  users = entries = 0
+  temp = path + '.tmp'
+  with gzip.open(temp, 'wb') as f:
+    for user_info in query.run(batch_size=SHARD_USERS):
+      weight_data = WeightData(user_info)
+      rows = weight_data.all_entries()
+      days = encode_days([d.toordinal() for d, w in rows])
+      weights = [w for d, w in rows]
+      readings = sorted([block.day_zero, base64.b64encode(block.packed or '')]
+                        for block
+                        in ReadingBlock.all().ancestor(user_info.key()))
+      settings = dict((name, getattr(user_info, name, None))
+                      for name in SETTINGS)
+      f.write(json.dumps({
+          'key_name': user_info.key().name(),
+          'email': user_info.user.email(),
+          'user_id': user_info.user.user_id(),
+          'auth_domain': user_info.user.auth_domain(),
+          'settings': settings,
+          'days': days,
+          'weights': weights,
+          'readings': readings,
+          'crc': columns_checksum(days, weights, readings),
+        }, separators=(',', ':')))
+      f.write('\n')
+      users += 1
+      entries += len(rows)
+  os.rename(temp, path)
+  return dict(shard, users=users, entries=entries,
+              bytes=os.path.getsize(path), sha1=file_sha1(path))
+
+def restore_shard(args):
+  """Writes one shard's users back to the datastore (run in a worker
+  process)."""
+  directory, shard = args
+  from google.appengine.api import users as users_api
+  from google.appengine.ext import db
+  from datamodel import DataVersion, ReadingBlock, UserInfo, WeightData
+  from datamodel import BATCH_UPDATE_BLOCKS
+
+  path = os.path.join(directory, shard['name'])
+  if file_sha1(path) != shard['sha1']:
+    raise ValueError("%s doesn't match its checksum" % path)
+
+  users = entries = puts = 0
+  batch = []
+  with gzip.open(path, 'rb') as f:
+    for line in f:
+      record = json.loads(line)
+      readings = record.get('readings', [])
+      if (columns_checksum(record['days'], record['weights'], readings) !=
+          record['crc']):
+        raise ValueError("%s: %s doesn't match its checksum" %
+                         (path, record['key_name']))
+      user = users_api.User(record['email'],
+                            _auth_domain=record['auth_domain'],
+                            _user_id=record['user_id'])
+      settings = dict((name, value) for name, value
+                      in record['settings'].iteritems()
+                      if value is not None)
+      user_info = UserInfo(key_name=record['key_name'], user=user,
+                           **settings)
+      rows = [(datetime.date.fromordinal(day), weight) for day, weight
+              in zip(decode_days(record['days']), record['weights'])]
+      blocks = WeightData(user_info).new_blocks(rows)
+      for i, block in enumerate(blocks):
+        block.version = 1 + i // BATCH_UPDATE_BLOCKS
+      batch.append(user_info)
+      batch.append(DataVersion(key=DataVersion.key_for(user_info.key()),
+                               version=blocks[-1].version if blocks else 1,
+                               layout=user_info.block_layout))
+      batch.extend(blocks)
+      batch.extend(ReadingBlock(key=ReadingBlock.key_for(user_info.key(),
+                                                         day_zero),
+                                day_zero=day_zero,
+                                packed=db.Blob(base64.b64decode(packed)))
+                   for day_zero, packed in readings)
+      users += 1
+      entries += len(rows)
+      if len(batch) >= RESTORE_PUT_ENTITIES:
+        db.put(batch)
+        puts += 1
+        batch = []
+  if batch:
+    db.put(batch)
+    puts += 1
+  return dict(shard, users=users, entries=entries, puts=puts)
+
+def run_pool(function, directory, shards, workers, options, finished):
+  """Runs function over the shards with a pool of worker processes, calling
+  finished with each result as it arrives (in the order they finish)."""
+  if workers <= 1:
+    for shard in shards:
+      finished(function((directory, shard)))
+    return
+  pool = multiprocessing.Pool(workers, _init_worker, (options,))
+  try:
+    for result in pool.imap_unordered(function,
+                                      [(directory, shard)
+                                       for shard in shards]):
+      finished(result)
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+
+def report(results, skipped, elapsed):
+  users = sum(r['users'] for r in results)
+  entries = sum(r['entries'] for r in results)
+  size = sum(r.get('bytes', 0) for r in results)
+  return {
+    'shards': len(results),
+    'shards_skipped': skipped,
+    'users': users,
+    'entries': entries,
+    'bytes': size,
+    'seconds': round(elapsed, 3),
+    'users_per_second': round(users / elapsed, 1) if elapsed else None,
+    'entries_per_second': round(entries / elapsed, 1) if elapsed else None,
+  }
+
+def progress(result, done, total):
+  sys.stderr.write("%s: %d users, %d entries (%d/%d shards)\n" % (
+      result['name'], result['users'], result['entries'], done, total))
+
+def export(directory, options):
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  manifest_path = os.path.join(directory, MANIFEST)
+  manifest = read_json(manifest_path)
+  if manifest is None:
+    manifest = {
+      'format': SNAPSHOT_FORMAT,
+      'created': datetime.datetime.utcnow().isoformat(),
+      'shards': plan_shards(),
+    }
+    write_json(manifest_path, manifest)
+  elif manifest['format'] != SNAPSHOT_FORMAT:
+    raise ValueError("%s has snapshot format %s, not %s" % (
+        manifest_path, manifest['format'], SNAPSHOT_FORMAT))
+
+  by_name = dict((shard['name'], shard) for shard in manifest['shards'])
+  todo = [shard for shard in manifest['shards']
+          if not ('sha1' in shard and
+                  os.path.exists(os.path.join(directory, shard['name'])) and
+                  file_sha1(os.path.join(directory, shard['name'])) ==
+                      shard['sha1'])]
+  results = []
+
+  def finished(result):
+    by_name[result['name']].update(result)
+    write_json(manifest_path, manifest)
+    results.append(result)
+    progress(result, len(results), len(todo))
+
+  start = time.time()
+  run_pool(export_shard, directory, todo, options.workers, options, finished)
+  return report(results, len(manifest['shards']) - len(todo),
+                time.time() - start)
+
+def restore(directory, options):
+  manifest = read_json(os.path.join(directory, MANIFEST))
+  if manifest is None:
+    raise ValueError("%s has no %s" % (directory, MANIFEST))
+  if manifest['format'] not in RESTORE_FORMATS:
+    raise ValueError("%s has snapshot format %s, not one of %s" % (
+        directory, manifest['format'], RESTORE_FORMATS))
+  incomplete = [shard['name'] for shard in manifest['shards']
+                if 'sha1' not in shard]
+  if incomplete:
+    raise ValueError("The export is incomplete (%d shards left)" %
+                     len(incomplete))
+
+  restored_path = os.path.join(directory, RESTORED)
+  restored = set(read_json(restored_path, []))
+  todo = [shard for shard in manifest['shards']
+          if shard['name'] not in restored]
+  results = []
+
+  def finished(result):
+    restored.add(result['name'])
+    write_json(restored_path, sorted(restored))
+    results.append(result)
+    progress(result, len(results), len(todo))
+
+  # The datastore file stub rewrites the whole file on every put, so only one
+  # process can write to it.
+  workers = options.workers if options.remote else 1
+  start = time.time()
+  run_pool(restore_shard, directory, todo, workers, options, finished)
+  return report(results, len(manifest['shards']) - len(todo),
+                time.time() - start)
+
+def main():
+  parser = optparse.OptionParser(usage=__doc__)
+  parser.add_option('--remote', metavar='HOST',
+                    help='reach the datastore through remote_api on HOST')
+  parser.add_option('--datastore-file', metavar='FILE',
+                    help='use a local datastore file')
+  parser.add_option('--workers', type='int',
+                    default=multiprocessing.cpu_count(),
+                    help='worker processes (default: one per CPU)')
+  options, args = parser.parse_args()
+  if len(args) != 2 or args[0] not in ('export', 'restore'):
+    parser.error("give export or restore, and a directory")
+  if bool(options.remote) == bool(options.datastore_file):
+    parser.error("give one of --remote and --datastore-file")
+  command, directory = args
+
+  sdk.setup_sdk_path()
+  connect(options)
+  logging.getLogger().setLevel(logging.WARNING)
+
+  if command == 'export':
+    result = export(directory, options)
+  else:
+    result = restore(directory, options)
+  json.dump(result, sys.stdout, indent=2, sort_keys=True)
+  sys.stdout.write('\n')
+
+if __name__ == '__main__':
+  main()
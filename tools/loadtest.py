@@ -0,0 +1,288 @@
+"""Load test for the whole application, run in-process.
+
+The webapp2 application is driven directly (no HTTP server) with the App
+Engine SDK's local service stubs standing in for the datastore, users,
+memcache and task queue services.  Users are seeded with realistic weight
+histories (see tools/benchmark.py), then worker threads send a weighted mix of
+requests as randomly chosen users: page views, chart data, CSV downloads and
+CSV imports with valid XSRF tokens.  Each simulated browser keeps the cookies
+the application hands it.
+
+Usage (from the application directory):
+
+  python -m tools.loadtest [--users N] [--threads N] [--requests N] [--mix ...]
+
+The mix is a comma separated list of route=weight pairs using the route names
+in ROUTES, e.g., --mix graph=5,chartdata=5,import=1.
+
+Results are printed as JSON: per route, the request count, error count,
+latency percentiles in milliseconds and datastore RPCs per request, plus the
+overall throughput.
+"""
+
+import datetime
+import json
+import logging
+import optparse
+import os
+import random
+import sys
+import threading
+import time
+import urllib
+
+from tools import sdk
+from tools.benchmark import load_history, synthetic_series
+
+# name: (method, path)
+ROUTES = {
+  'graph': ('GET', '/graph'),
+  'mobile_graph': ('GET', '/m/graph'),
+  'chartdata': ('GET', '/api/chartdata?s=%(range)s&samples=200'),
+  'data': ('GET', '/data?s=%(range)s'),
+  'csv': ('GET', '/csv'),
+  'import': ('POST', '/data?cmd=add&type=text'),
+}
+DEFAULT_MIX = 'graph=4,mobile_graph=2,chartdata=6,data=2,csv=1,import=1'
+RANGES = ('1w', '2w', '1m', '3m', '6m', '1y', 'All')
+
+def email_for(i):
+  return 'user%05d@example.com' % i
+
+def parse_mix(mix):
+  """Parses name=weight pairs into a list of (route name, cumulative weight)."""
+  cumulative = []
+  total = 0
+  for part in mix.split(','):
+    name, weight = part.split('=')
+    if name not in ROUTES:
+      raise ValueError("Unknown route %r; choose from %s" %
+                       (name, ', '.join(sorted(ROUTES))))
+    total += int(weight)
+    cumulative.append((name, total))
+  return cumulative
+
+def choose(cumulative, rnd):
+  pick = rnd.uniform(0, cumulative[-1][1])
+  for name, bound in cumulative:
+    if pick <= bound:
+      return name
+  return cumulative[-1][0]
+
+def percentile(sorted_values, fraction):
+  if not sorted_values:
+    return None
+  index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+  return sorted_values[index]
+
+class RpcCounter(object):
+  """Counts datastore RPCs made by the current thread, by method."""
+  def __init__(self):
+    self._local = threading.local()
+
+  def install(self):
+    from google.appengine.api import apiproxy_stub_map
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'loadtest_rpc_counter', self._hook, 'datastore_v3')
+
+  def _hook(self, service, call, request, response):
+    counts = getattr(self._local, 'counts', None)
+    if counts is not None:
+      counts[call] = counts.get(call, 0) + 1
+
+  def start(self):
+    self._local.counts = {}
+
+  def stop(self):
+    counts, self._local.counts = self._local.counts, None
+    return counts
+
+class Browser(object):
+  """One simulated user, with their own cookies."""
+  def __init__(self, email):
+    self.email = email
+    self.cookies = {}
+
+  def environ(self, base_environ):
+    environ = dict(base_environ)
+    environ.update({
+      'USER_EMAIL': self.email,
+      'USER_ID': str(abs(hash(self.email))),
+      'USER_IS_ADMIN': '0',
+    })
+    return environ
+
+  def request(self, app, method, path, post=None):
+    import webapp2
+    request = webapp2.Request.blank(path)
+    request.method = method
+    if self.cookies:
+      request.headers['Cookie'] = '; '.join(
+          '%s=%s' % item for item in self.cookies.iteritems())
+    if post is not None:
+      request.body = urllib.urlencode(post)
+      request.content_type = 'application/x-www-form-urlencoded'
+    response = request.get_response(app)
+    for header in response.headers.getall('Set-Cookie'):
+      name, value = header.split(';', 1)[0].split('=', 1)
+      self.cookies[name] = value
+    return response
+
+def seed(num_users, max_years, gap_density, rnd, base_environ):
+  """Stores a history for each user, returns the number of entries stored."""
+  from google.appengine.runtime import request_environment
+  from usercontext import UserContext
+
+  history = load_history()
+  total = 0
+  for i in xrange(num_users):
+    request_environment.current_request.Init(
+        sys.stderr, Browser(email_for(i)).environ(base_environ))
+    context = UserContext()
+    series = synthetic_series(years=rnd.uniform(0.1, max_years),
+                              gap_density=gap_density,
+                              seed=i,
+                              history=history)
+    # Bring the history up to the present, which is what the pages show.
+    offset = datetime.date.today() - series[-1][0]
+    series = [(d + offset, w) for d, w in series]
+    context.weight_data.batch_update(series)
+    total += len(series)
+  return total
+
+def import_body(rnd):
+  today = datetime.date.today()
+  lines = ['%s,%.1f' % (today - datetime.timedelta(days=i),
+                        180 + rnd.gauss(0, 2))
+           for i in xrange(rnd.randint(1, 60))]
+  return '\n'.join(lines)
+
+def worker(app, counter, mix, num_requests, num_users, base_environ, rnd,
+           results, lock):
+  from google.appengine.runtime import request_environment
+  from datamodel import UserInfo
+  from util.xsrf import make_xsrf_token, TOKEN_NAME
+
+  browsers = {}
+  for i in xrange(num_requests):
+    user = rnd.randrange(num_users)
+    browser = browsers.get(user)
+    if browser is None:
+      browser = browsers[user] = Browser(email_for(user))
+    request_environment.current_request.Init(
+        sys.stderr, browser.environ(base_environ))
+
+    name = choose(mix, rnd)
+    method, path = ROUTES[name]
+    path = path % {'range': rnd.choice(RANGES)}
+    post = None
+    if method == 'POST':
+      user_info = UserInfo.get_by_key_name('u:' + browser.email)
+      post = {
+        TOKEN_NAME: make_xsrf_token(user_info, 'data'),
+        'csvdata': import_body(rnd),
+      }
+
+    counter.start()
+    start = time.time()
+    try:
+      status = browser.request(app, method, path, post).status_int
+    except Exception, e:
+      logging.exception("%s %s failed", method, path)
+      status = 599
+    elapsed = time.time() - start
+    rpcs = counter.stop()
+
+    with lock:
+      results.append((name, elapsed, status, rpcs))
+
+def summarize(results, wall_time):
+  by_route = {}
+  for name, elapsed, status, rpcs in results:
+    by_route.setdefault(name, []).append((elapsed, status, rpcs))
+
+  summary = {}
+  for name, rows in sorted(by_route.iteritems()):
+    latencies = sorted(r[0] * 1000 for r in rows)
+    rpc_totals = {}
+    for elapsed, status, rpcs in rows:
+      for call, count in rpcs.iteritems():
+        rpc_totals[call] = rpc_totals.get(call, 0) + count
+    summary[name] = {
+      'requests': len(rows),
+      'errors': sum(1 for r in rows if r[1] >= 500),
+      'p50_ms': round(percentile(latencies, 0.50), 3),
+      'p95_ms': round(percentile(latencies, 0.95), 3),
+      'p99_ms': round(percentile(latencies, 0.99), 3),
+      'datastore_rpcs_per_request': dict(
+          (call, round(count / float(len(rows)), 3))
+          for call, count in sorted(rpc_totals.iteritems())),
+    }
+  return {
+    'requests': len(results),
+    'wall_time_s': round(wall_time, 3),
+    'throughput_rps': round(len(results) / wall_time, 3),
+    'routes': summary,
+  }
+
+def main():
+  parser = optparse.OptionParser(usage=__doc__)
+  parser.add_option('--users', type='int', default=2000)
+  parser.add_option('--years', type='float', default=3,
+                    help='longest history to seed, in years')
+  parser.add_option('--gap-density', type='float', default=0.3)
+  parser.add_option('--threads', type='int', default=8)
+  parser.add_option('--requests', type='int', default=2000,
+                    help='total number of requests to send')
+  parser.add_option('--mix', default=DEFAULT_MIX)
+  parser.add_option('--seed', type='int', default=0)
+  options, args = parser.parse_args()
+
+  mix = parse_mix(options.mix)
+  rnd = random.Random(options.seed)
+
+  sdk.setup_sdk_path()
+  bed = sdk.activate_testbed()
+  logging.getLogger().setLevel(logging.WARNING)
+
+  # Give every thread its own os.environ, the way the runtime does, so that
+  # each one can be logged in as a different user.
+  from google.appengine.runtime import request_environment
+  base_environ = dict(os.environ)
+  request_environment.PatchOsEnviron(os)
+  request_environment.current_request.Init(sys.stderr, dict(base_environ))
+
+  import weightmeter
+
+  start = time.time()
+  entries = seed(options.users, options.years, options.gap_density, rnd,
+                 base_environ)
+  sys.stderr.write("seeded %d users with %d entries in %.1fs\n" % (
+      options.users, entries, time.time() - start))
+
+  counter = RpcCounter()
+  counter.install()
+
+  results = []
+  lock = threading.Lock()
+  per_thread = options.requests // options.threads
+  threads = [threading.Thread(target=worker,
+                              args=(weightmeter.app, counter, mix, per_thread,
+                                    options.users, base_environ,
+                                    random.Random(rnd.random()), results,
+                                    lock))
+             for i in xrange(options.threads)]
+  start = time.time()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  wall_time = time.time() - start
+
+  json.dump(summarize(results, wall_time), sys.stdout, indent=2,
+            sort_keys=True)
+  sys.stdout.write('\n')
+  bed.deactivate()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,84 @@
+"""Helpers for running the tools in this directory outside of App Engine.
+
+The tools import the application modules directly, so the App Engine SDK (and
+the Django version named in app.yaml) has to be on sys.path first.  The SDK is
+found through $APPENGINE_SDK, or by looking for dev_appserver.py on $PATH.
+"""
+
+import os
+import os.path
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DJANGO_VERSION = '1.2'
+
+def find_sdk():
+  """Returns the path to the App Engine SDK, or None if it can't be found."""
+  sdk_path = os.environ.get('APPENGINE_SDK')
+  if sdk_path:
+    return sdk_path
+  for directory in os.environ.get('PATH', '').split(os.pathsep):
+    dev_appserver = os.path.join(directory, 'dev_appserver.py')
+    if os.path.exists(dev_appserver):
+      sdk_path = os.path.dirname(os.path.realpath(dev_appserver))
+      # The Cloud SDK keeps the real thing in platform/google_appengine.
+      bundled = os.path.join(os.path.dirname(sdk_path),
+                             'platform', 'google_appengine')
+      if os.path.isdir(bundled):
+        return bundled
+      return sdk_path
+  return None
+
+def setup_sdk_path(sdk_path=None):
+  """Puts the SDK, its bundled libraries and the application on sys.path."""
+  if sdk_path is None:
+    sdk_path = find_sdk()
+  if sdk_path is None:
+    raise RuntimeError("Can't find the App Engine SDK: set APPENGINE_SDK")
+
+  if sdk_path not in sys.path:
+    sys.path.insert(0, sdk_path)
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+
+  django_path = os.path.join(sdk_path, 'lib', 'django-' + DJANGO_VERSION)
+  if os.path.isdir(django_path) and django_path not in sys.path:
+    sys.path.insert(0, django_path)
+
+  if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+  os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+
+  # Templates are looked up relative to the application directory.
+  os.chdir(APP_DIR)
+
+def activate_testbed(datastore_file=None):
+  """Activates local service stubs in place of the App Engine services.
+
+  Args:
+    datastore_file: where the datastore stub keeps its data.  Default is an
+        in-memory datastore that disappears when the process exits.
+
+  Returns:
+    the active testbed.Testbed; call deactivate() on it when finished.
+  """
+  from google.appengine.ext import testbed
+
+  bed = testbed.Testbed()
+  bed.activate()
+  if datastore_file is None:
+    bed.init_datastore_v3_stub()
+  else:
+    bed.init_datastore_v3_stub(datastore_file=datastore_file,
+                               save_changes=True)
+  bed.init_memcache_stub()
+  bed.init_user_stub()
+  bed.init_taskqueue_stub(root_path=APP_DIR)
+  return bed
+
+def login(bed, email, is_admin=False):
+  """Makes the users stub report email as the current user."""
+  bed.setup_env(user_email=email,
+                user_id=str(abs(hash(email))),
+                user_is_admin='1' if is_admin else '0',
+                overwrite=True)
@@ -0,0 +1,108 @@
+"""Measures instance cold-start cost.
+
+Each trial runs in a fresh Python process, so module imports, template
+compilation and everything else that happens once per instance are counted the
+way they are on App Engine.  A trial records how long it takes to import the
+application, how long the warmup request takes (if enabled), and the latency of
+the first and second request to each page.
+
+Usage (from the application directory):
+
+  python -m tools.startup_benchmark [--trials N] [--no-warmup]
+
+Results are printed as one JSON object, with the median over all trials for
+every measurement.
+"""
+
+import json
+import optparse
+import subprocess
+import sys
+import time
+
+from tools import sdk
+
+ROUTES = (
+    '/graph',
+    '/m/graph',
+    '/data',
+    '/m/data',
+    '/settings',
+    '/api/chartdata?s=1m',
+    '/csv',
+)
+
+def run_trial(warmup):
+  """Runs one cold start in this process and returns its timings in ms."""
+  timings = {}
+
+  start = time.time()
+  sdk.setup_sdk_path()
+  timings['sdk_setup'] = (time.time() - start) * 1000
+
+  bed = sdk.activate_testbed()
+  sdk.login(bed, 'benchmark@example.com')
+
+  start = time.time()
+  import webapp2
+  import weightmeter
+  timings['import'] = (time.time() - start) * 1000
+
+  if warmup:
+    sdk.login(bed, 'benchmark@example.com', is_admin=True)
+    start = time.time()
+    webapp2.Request.blank('/_ah/warmup').get_response(weightmeter.app)
+    timings['warmup'] = (time.time() - start) * 1000
+    sdk.login(bed, 'benchmark@example.com')
+
+  for attempt in ('first', 'second'):
+    for route in ROUTES:
+      start = time.time()
+      response = webapp2.Request.blank(route).get_response(weightmeter.app)
+      timings['%s %s' % (attempt, route)] = (time.time() - start) * 1000
+      if response.status_int >= 500:
+        raise RuntimeError("%s failed: %s" % (route, response.status))
+
+  bed.deactivate()
+  return timings
+
+def median(values):
+  values = sorted(values)
+  mid = len(values) // 2
+  if len(values) % 2:
+    return values[mid]
+  return (values[mid - 1] + values[mid]) / 2.0
+
+def main():
+  parser = optparse.OptionParser(usage=__doc__)
+  parser.add_option('--trials', type='int', default=5)
+  parser.add_option('--no-warmup', dest='warmup', action='store_false',
+                    default=True)
+  parser.add_option('--child', action='store_true', default=False,
+                    help=optparse.SUPPRESS_HELP)
+  options, args = parser.parse_args()
+
+  if options.child:
+    json.dump(run_trial(options.warmup), sys.stdout)
+    return
+
+  command = [sys.executable, '-m', 'tools.startup_benchmark', '--child']
+  if not options.warmup:
+    command.append('--no-warmup')
+
+  trials = []
+  for i in xrange(options.trials):
+    output = subprocess.check_output(command, cwd=sdk.APP_DIR)
+    trials.append(json.loads(output.splitlines()[-1]))
+
+  result = {
+    'trials': options.trials,
+    'warmup': options.warmup,
+    'median_ms': dict((name, round(median([t[name] for t in trials]), 3))
+                      for name in sorted(trials[0])),
+  }
+  json.dump(result, sys.stdout, indent=2, sort_keys=True)
+  sys.stdout.write('\n')
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,186 @@
+"""Trend models: the ways a series of weights can be smoothed into a trend.
+
+Every model is a TrendModel, which takes date,weight entries one at a time, in
+date order, and keeps the trend as of the last one.  Entries can be fed to it
+directly with update(), or through iter(), which behaves like
+datamodel.decaying_average_iter.  Because a model keeps its state between
+calls, it can be primed with the days before a range and then continued
+through the range itself.
+
+All of the models are tuned by the user's gamma, so that switching models
+keeps about the same amount of smoothing:
+
+  ewma       - the original per-entry decaying average: every entry moves the
+               trend by the same fraction, however long ago the last one was
+  ewma_days  - a decaying average that decays by gamma once per elapsed day,
+               so an entry after a week-long gap counts for as much as a week
+               of daily entries would
+  holt       - Holt's linear (double exponential) smoothing, per elapsed day,
+               which also tracks the rate of change in weight per day
+  kalman     - a one dimensional Kalman filter over a random walk, whose
+               steady state matches ewma_days for daily entries, but which
+               trusts entries after a gap more, since the weight is less
+               certain after a gap
+"""
+
+from __future__ import division
+
+DEFAULT_MODEL = 'ewma'
+
+# How strongly Holt's method follows changes in the rate.
+HOLT_BETA = 0.1
+
+class TrendModel(object):
+  """Smooths date,weight entries into a trend.  See the module docstring.
+
+  By itself, this is the original decaying average, which moves the trend by
+  the same fraction for every entry; the other models override _step.
+  """
+  def __init__(self, gamma=None, start=None):
+    """Create a model.
+
+    Args:
+      gamma: how much of the trend is kept for each entry or day (0.9)
+      start: the trend to start from, instead of the first entry
+    """
+    if gamma is None:
+      gamma = 0.9
+    self.gamma = gamma
+    self.value = start
+    self.last_date = None
+
+  @property
+  def rate(self):
+    """The trend's rate of change per day, if the model tracks it."""
+    return None
+
+  def update(self, date, weight):
+    """Adds an entry, returns the new trend."""
+    if weight is not None:
+      if self.value is None:
+        self._first(weight)
+      else:
+        days = 1
+        if self.last_date is not None:
+          days = max(1, (date - self.last_date).days)
+        self._step(days, weight)
+      self.last_date = date
+    return self.value
+
+  def iter(self, entries, propagate_missing=False):
+    """Yields date, weight, trend for each date,weight entry.
+
+    A None weight leaves the trend alone (or yields None for it, if
+    propagate_missing is set).
+    """
+    for date, weight in entries:
+      value = self.update(date, weight)
+      if weight is None and propagate_missing:
+        yield date, weight, None
+      else:
+        yield date, weight, value
+
+  def _first(self, weight):
+    self.value = weight
+
+  def _step(self, days, weight):
+    self.value = self.gamma * self.value + (1 - self.gamma) * weight
+
+class Ewma(TrendModel):
+  """The original decaying average, one step per entry."""
+
+class DailyEwma(TrendModel):
+  """A decaying average that decays once per elapsed day.
+
+  >>> import datetime
+  >>> m = DailyEwma(0.5)
+  >>> m.update(datetime.date(2012, 1, 1), 100.0)
+  100.0
+  >>> m.update(datetime.date(2012, 1, 2), 110.0)
+  105.0
+  >>> m.update(datetime.date(2012, 1, 4), 105.0)
+  105.0
+  >>> m.update(datetime.date(2012, 1, 6), 101.0)
+  102.0
+  """
+  def _step(self, days, weight):
+    keep = self.gamma ** days
+    self.value = keep * self.value + (1 - keep) * weight
+
+class Holt(TrendModel):
+  """Holt's linear smoothing, per elapsed day, with a rate of change.
+
+  >>> import datetime
+  >>> m = Holt(0.5)
+  >>> for day in range(120):
+  ...   value = m.update(datetime.date(2012, 1, 1) +
+  ...                    datetime.timedelta(days=day), 200.0 - day * 0.5)
+  >>> round(m.rate, 2), round(value, 1)
+  (-0.5, 140.5)
+  """
+  def __init__(self, gamma=None, start=None, beta=HOLT_BETA):
+    super(Holt, self).__init__(gamma, start)
+    self.beta = beta
+    self.slope = 0.0
+
+  @property
+  def rate(self):
+    return self.slope
+
+  def _step(self, days, weight):
+    alpha = 1 - self.gamma ** days
+    forecast = self.value + self.slope * days
+    level = alpha * weight + (1 - alpha) * forecast
+    self.slope = (self.beta * (level - self.value) / days +
+                  (1 - self.beta) * self.slope)
+    self.value = level
+
+class Kalman(TrendModel):
+  """A 1-D Kalman filter over a random walk, in units of the entry noise.
+
+  The process noise per day is chosen so that, with an entry every day, the
+  filter settles on a gain of 1 - gamma, like ewma_days.
+
+  >>> import datetime
+  >>> m = Kalman(0.9)
+  >>> for day in range(1, 200):
+  ...   value = m.update(datetime.date(2012, 1, 1) +
+  ...                    datetime.timedelta(days=day), 180.0)
+  >>> round(m.gain, 3)
+  0.1
+  """
+  def __init__(self, gamma=None, start=None):
+    super(Kalman, self).__init__(gamma, start)
+    gain = 1 - self.gamma
+    self.process_noise = gain * gain / self.gamma if self.gamma else 1.0
+    self.variance = 1.0
+    self.gain = None
+
+  def _step(self, days, weight):
+    predicted = self.variance + self.process_noise * days
+    self.gain = predicted / (predicted + 1.0)
+    self.value += self.gain * (weight - self.value)
+    self.variance = (1 - self.gain) * predicted
+
+MODELS = {
+  'ewma': Ewma,
+  'ewma_days': DailyEwma,
+  'holt': Holt,
+  'kalman': Kalman,
+}
+
+# For the settings form, in the order they are offered.
+CHOICES = (
+  ('ewma', 'Decaying average (per entry)'),
+  ('ewma_days', 'Decaying average (per day)'),
+  ('holt', 'Linear trend (Holt)'),
+  ('kalman', 'Kalman filter'),
+)
+
+def make(name=None, gamma=None, start=None):
+  """Returns a new model of the named kind (DEFAULT_MODEL if None)."""
+  return MODELS[name or DEFAULT_MODEL](gamma, start)
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
@@ -0,0 +1,183 @@
+"""Request-scoped access to the current user and their data.
+
+A single page can need the current user in several places: the XSRF decorator,
+the handler itself, the form factories and the template.  Looking the user up
+in each place costs a UserInfo.get_or_insert transaction every time, so
+handlers instead share one UserContext per request, which loads each piece the
+first time it is asked for and remembers it for the rest of the request.
+
+Most pages only need a few of the user's settings, not the whole UserInfo.
+Those are also kept in a signed cookie (see UserSettings), so a page view by a
+returning user can usually be served without reading UserInfo at all.
+"""
+
+from google.appengine.api import users
+from google.appengine.ext import db
+
+from datamodel import UserInfo, WeightData, get_app_secret
+from util import rpcstats
+from util import signedcookie
+from util import spans
+from util.xsrf import make_secret
+import writebehind
+
+SETTINGS_COOKIE_NAME = 'wms'
+# Bump this whenever the contents of the cookie change meaning.
+SETTINGS_COOKIE_FORMAT = 5
+# Settings changed from another browser are picked up after at most this long.
+SETTINGS_COOKIE_MAX_AGE = 3600
+
+def user_info_key_name(user):
+  return 'u:' + user.email()
+
+class UserSettings(object):
+  """The UserInfo values that most pages need, and nothing else.
+
+  Has the same interface as UserInfo for these values (including key()), so it
+  can stand in for one anywhere the entity is only read.
+  """
+  def __init__(self, key, gamma, scale_resolution, xsrf_secret,
+               settings_version, trend_model, goal_weight, block_layout,
+               intraday_mode):
+    self._key = key
+    self.gamma = gamma
+    self.trend_model = trend_model
+    self.goal_weight = goal_weight
+    self.scale_resolution = scale_resolution
+    self.xsrf_secret = xsrf_secret
+    self.settings_version = settings_version
+    self.block_layout = block_layout
+    self.intraday_mode = intraday_mode
+
+  def key(self):
+    return self._key
+
+  @classmethod
+  def from_user_info(cls, user_info):
+    return cls(user_info.key(),
+               user_info.gamma,
+               user_info.scale_resolution,
+               user_info.xsrf_secret,
+               user_info.settings_version,
+               user_info.trend_model,
+               user_info.goal_weight,
+               user_info.block_layout,
+               user_info.intraday_mode)
+
+  @classmethod
+  def from_cookie(cls, user, cookie):
+    """Returns the settings held in a cookie, or None if it can't be used."""
+    values = signedcookie.decode(cookie,
+                                 get_app_secret('settings_cookie'),
+                                 max_age=SETTINGS_COOKIE_MAX_AGE)
+    if not values:
+      return None
+    try:
+      if (values['f'] != SETTINGS_COOKIE_FORMAT or
+          values['e'] != user.email()):
+        return None
+      key = db.Key.from_path('UserInfo', user_info_key_name(user))
+      return cls(key, values['g'], values['r'], str(values['x']), values['v'],
+                 str(values['m']), values['o'], values['l'],
+                 values['i'])
+    except (KeyError, TypeError):
+      return None
+
+  def to_cookie(self, user):
+    return signedcookie.encode({
+        'f': SETTINGS_COOKIE_FORMAT,
+        'e': user.email(),
+        'v': self.settings_version,
+        'g': self.gamma,
+        'r': self.scale_resolution,
+        'x': self.xsrf_secret,
+        'm': self.trend_model,
+        'o': self.goal_weight,
+        'l': self.block_layout,
+        'i': self.intraday_mode,
+      }, get_app_secret('settings_cookie'))
+
+class UserContext(object):
+  """Lazily loads and memoizes the current user, UserInfo and WeightData.
+
+  Create one per request; never share one between requests, since users and
+  their settings change from one request to the next.
+  """
+  _UNSET = object()
+
+  def __init__(self, cookies=None):
+    """Create a context for one request.
+
+    Args:
+      cookies: the request's cookies, used to find the settings cookie
+    """
+    self._cookies = cookies or {}
+    self._user = self._UNSET
+    self._user_info = None
+    self._settings = None
+    self._settings_cookie = None
+    self._weight_data = None
+
+  @property
+  def user(self):
+    """The currently logged-in users.User, or None."""
+    if self._user is self._UNSET:
+      self._user = users.get_current_user()
+    return self._user
+
+  @property
+  def user_info(self):
+    """The UserInfo entity for the current user, created if necessary."""
+    if self._user_info is None:
+      user = self.user
+      assert user is not None
+      # The XSRF secret is only used if this creates the entity, so that it
+      # goes out in the same write as the rest of the new user.
+      with spans.span('user_info'):
+        with rpcstats.operation('UserInfo.get_or_insert'):
+          self._user_info = UserInfo.get_or_insert(user_info_key_name(user),
+                                                   user=user,
+                                                   xsrf_secret=make_secret())
+    return self._user_info
+
+  @property
+  def settings(self):
+    """The current user's UserSettings.
+
+    Taken from the settings cookie when it is present and valid, otherwise
+    from the UserInfo entity (in which case a fresh cookie is issued).
+    """
+    if self._settings is None:
+      cookie = self._cookies.get(SETTINGS_COOKIE_NAME)
+      self._settings = UserSettings.from_cookie(self.user, cookie)
+      if self._settings is None:
+        user_info = self.user_info
+        if not user_info.xsrf_secret:
+          # Only users created before secrets were made along with them.
+          user_info.xsrf_secret = make_secret()
+          user_info.put()
+        self.settings_changed(user_info)
+    return self._settings
+
+  def settings_changed(self, user_info):
+    """Records new settings, which will be sent out in a fresh cookie."""
+    self._user_info = user_info
+    self._settings = UserSettings.from_user_info(user_info)
+    self._settings_cookie = self._settings.to_cookie(self.user)
+
+  def settings_cookie(self):
+    """Returns a settings cookie to send, or None if the current one is good."""
+    return self._settings_cookie
+
+  @property
+  def weight_data(self):
+    """A WeightData object for the current user."""
+    if self._weight_data is None:
+      # Only the key and block layout are needed, so don't load the UserInfo
+      # just for this.
+      settings = self.settings
+      pending = None
+      if writebehind.enabled():
+        pending = writebehind.pending(settings.key())
+      self._weight_data = WeightData(settings, pending)
+    return self._weight_data
@@ -0,0 +1,65 @@
+"""Trees for answering range queries over a list of values.
+
+SegmentTree answers any associative combination (e.g., min or max) over any
+range in O(log n) time, and can have single values changed in O(log n) time.
+Ranges are half-open, like slices: (i, j) covers values[i:j].
+
+Sums over ranges don't need a tree: the running totals of the values answer
+them with one subtraction (see datamodel.WeightSummaryIndex).
+"""
+
+class SegmentTree(object):
+  """Combinations over ranges of a list of values.
+
+  combine must be associative, and identity must be a value that combine
+  leaves the other argument unchanged with.
+
+  >>> t = SegmentTree([3, 1, 4, 1, 5, 9, 2, 6], min, float('inf'))
+  >>> t.query(0, 8), t.query(4, 8), t.query(5, 5)
+  (1, 2, inf)
+  >>> t.set(6, 0)
+  >>> t.query(4, 8)
+  0
+  >>> SegmentTree([3, 1, 4], max, float('-inf')).query(0, 2)
+  3
+  """
+  def __init__(self, values, combine, identity):
+    self._combine = combine
+    self._identity = identity
+    self._n = len(values)
+    self._tree = [identity] * self._n + list(values)
+    for i in xrange(self._n - 1, 0, -1):
+      self._tree[i] = combine(self._tree[2 * i], self._tree[2 * i + 1])
+
+  def __len__(self):
+    return self._n
+
+  def query(self, i, j):
+    """Returns the combination of values[i:j], or identity if it is empty."""
+    combine = self._combine
+    left = right = self._identity
+    i += self._n
+    j += self._n
+    while i < j:
+      if i & 1:
+        left = combine(left, self._tree[i])
+        i += 1
+      if j & 1:
+        j -= 1
+        right = combine(self._tree[j], right)
+      i //= 2
+      j //= 2
+    return combine(left, right)
+
+  def set(self, i, value):
+    """Replaces values[i]."""
+    i += self._n
+    self._tree[i] = value
+    i //= 2
+    while i >= 1:
+      self._tree[i] = self._combine(self._tree[2 * i], self._tree[2 * i + 1])
+      i //= 2
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
@@ -0,0 +1,236 @@
+"""Per-request accounting of datastore RPCs.
+
+install() hooks every datastore RPC the instance makes.  Between
+begin_request and end_request, the RPCs made by the current thread are counted
+by kind (gets, puts, queries, ...) along with the number of entities and bytes
+they moved and the time spent waiting for them.  Code that touches the
+datastore labels what it is doing with
+
+  with rpcstats.operation('WeightData.query', '2012-01-01..2012-02-01'):
+    ...
+
+so that counts can be broken down by operation, and so that a slow RPC can be
+logged along with the handler and the operation (including its detail, e.g.,
+the date range) that caused it.  A request that goes over the RPC count or
+datastore time budget is logged as a warning.  Totals per route are kept for
+the life of the instance (see snapshot()).
+"""
+
+import logging
+import threading
+import time
+
+SERVICE = 'datastore_v3'
+
+# Datastore methods, by the kind of work they are counted as.
+_KINDS = {
+  'Get': 'gets',
+  'Put': 'puts',
+  'Delete': 'deletes',
+  'RunQuery': 'queries',
+  'Next': 'queries',
+  'BeginTransaction': 'transactions',
+  'Commit': 'commits',
+  'Rollback': 'rollbacks',
+}
+
+# Budgets, see configure().
+_max_rpcs = 20
+_max_datastore_ms = 250.0
+_slow_rpc_ms = 100.0
+
+_installed = False
+_local = threading.local()
+_lock = threading.Lock()
+_routes = {}
+
+def configure(max_rpcs=None, max_datastore_ms=None, slow_rpc_ms=None):
+  """Sets the budgets that trigger warnings.
+
+  Params:
+    max_rpcs - most datastore RPCs a request should make
+    max_datastore_ms - most time a request should spend waiting on them
+    slow_rpc_ms - any single RPC slower than this is logged
+  """
+  global _max_rpcs, _max_datastore_ms, _slow_rpc_ms
+  if max_rpcs is not None:
+    _max_rpcs = max_rpcs
+  if max_datastore_ms is not None:
+    _max_datastore_ms = max_datastore_ms
+  if slow_rpc_ms is not None:
+    _slow_rpc_ms = slow_rpc_ms
+
+class RequestStats(object):
+  """What one request asked of the datastore."""
+  def __init__(self, route):
+    self.route = route
+    self.rpcs = 0
+    self.kinds = {}
+    self.entities = 0
+    self.bytes = 0
+    self.datastore_ms = 0.0
+    self.operations = {}
+    self.pending = {}
+
+  def over_budget(self):
+    return self.rpcs > _max_rpcs or self.datastore_ms > _max_datastore_ms
+
+  def to_dict(self):
+    return {
+      'route': self.route,
+      'rpcs': self.rpcs,
+      'kinds': self.kinds,
+      'entities': self.entities,
+      'bytes': self.bytes,
+      'datastore_ms': round(self.datastore_ms, 3),
+      'operations': self.operations,
+    }
+
+class operation(object):
+  """Context manager labelling the datastore RPCs made inside of it.
+
+  Params:
+    name - what is being done, used to group counts (e.g., 'WeightData.query')
+    detail - anything that helps find the cause of a slow RPC, only logged
+  """
+  def __init__(self, name, detail=None):
+    self.name = name
+    self.detail = detail
+
+  def __enter__(self):
+    self.outer = getattr(_local, 'operation', None)
+    _local.operation = self
+    return self
+
+  def __exit__(self, *exc_info):
+    _local.operation = self.outer
+    return False
+
+def _entity_count(call, request, response):
+  if call == 'Get':
+    return request.key_size()
+  elif call == 'Put':
+    return request.entity_size()
+  elif call == 'Delete':
+    return request.key_size()
+  elif call in ('RunQuery', 'Next'):
+    return response.result_size()
+  return 0
+
+def _pre_call(service, call, request, response):
+  stats = getattr(_local, 'stats', None)
+  if stats is not None:
+    stats.pending[id(request)] = (time.time(),
+                                  getattr(_local, 'operation', None))
+
+def _post_call(service, call, request, response):
+  stats = getattr(_local, 'stats', None)
+  if stats is None:
+    return
+  start, op = stats.pending.pop(id(request), (None, None))
+  ms = 0.0
+  if start is not None:
+    ms = (time.time() - start) * 1000
+
+  stats.rpcs += 1
+  kind = _KINDS.get(call, 'other')
+  stats.kinds[kind] = stats.kinds.get(kind, 0) + 1
+  stats.datastore_ms += ms
+  try:
+    stats.entities += _entity_count(call, request, response)
+    stats.bytes += request.ByteSize() + response.ByteSize()
+  except AttributeError:
+    pass
+
+  name = op.name if op is not None else 'unlabelled'
+  stats.operations[name] = stats.operations.get(name, 0) + 1
+
+  if ms > _slow_rpc_ms:
+    logging.warning("Slow datastore %s (%.1fms) in %s: %s %s",
+                    call, ms, stats.route, name,
+                    op.detail if op is not None else '')
+
+def install():
+  """Hooks the datastore RPCs of this instance.  Safe to call repeatedly."""
+  global _installed
+  if _installed:
+    return
+  from google.appengine.api import apiproxy_stub_map
+  apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+      'rpcstats_pre', _pre_call, SERVICE)
+  apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+      'rpcstats_post', _post_call, SERVICE)
+  _installed = True
+
+def begin_request(route):
+  """Starts counting the datastore RPCs of a request on this thread."""
+  _local.stats = RequestStats(route)
+  _local.operation = None
+
+def current():
+  """Returns the RequestStats being collected on this thread, or None."""
+  return getattr(_local, 'stats', None)
+
+def end_request():
+  """Stops counting, warns if over budget and adds to the route totals.
+
+  Returns:
+    the request's RequestStats, or None if nothing was being counted
+  """
+  stats = getattr(_local, 'stats', None)
+  _local.stats = None
+  if stats is None:
+    return None
+
+  over = stats.over_budget()
+  if over:
+    logging.warning("Request to %s went over its datastore budget "
+                    "(%d RPCs, max %d; %.1fms, max %.1fms): %r",
+                    stats.route, stats.rpcs, _max_rpcs, stats.datastore_ms,
+                    _max_datastore_ms, stats.operations)
+
+  with _lock:
+    totals = _routes.get(stats.route)
+    if totals is None:
+      totals = _routes[stats.route] = {
+        'requests': 0,
+        'over_budget': 0,
+        'rpcs': 0,
+        'entities': 0,
+        'bytes': 0,
+        'datastore_ms': 0.0,
+        'kinds': {},
+        'operations': {},
+      }
+    totals['requests'] += 1
+    totals['over_budget'] += int(over)
+    totals['rpcs'] += stats.rpcs
+    totals['entities'] += stats.entities
+    totals['bytes'] += stats.bytes
+    totals['datastore_ms'] += stats.datastore_ms
+    for field in ('kinds', 'operations'):
+      for name, n in getattr(stats, field).iteritems():
+        totals[field][name] = totals[field].get(name, 0) + n
+  return stats
+
+def snapshot():
+  """Returns the totals per route, with per-request averages."""
+  with _lock:
+    routes = dict((route, dict(totals, kinds=dict(totals['kinds']),
+                               operations=dict(totals['operations'])))
+                  for route, totals in _routes.iteritems())
+  for totals in routes.itervalues():
+    n = float(totals['requests'])
+    totals['per_request'] = {
+      'rpcs': round(totals['rpcs'] / n, 3),
+      'entities': round(totals['entities'] / n, 3),
+      'bytes': round(totals['bytes'] / n, 3),
+      'datastore_ms': round(totals['datastore_ms'] / n, 3),
+    }
+    totals['datastore_ms'] = round(totals['datastore_ms'], 3)
+  return routes
+
+def reset():
+  """Forgets the route totals."""
+  with _lock:
+    _routes.clear()
@@ -0,0 +1,79 @@
+"""Tamper-evident cookie values.
+
+Values are serialized as JSON, timestamped and signed with an HMAC, so that a
+handler can trust what comes back from the browser without looking anything
+up.  The values are signed, not encrypted: never put anything in them that the
+user is not allowed to see.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import time
+
+_DELIM = '|'
+
+def _compare_digest(a, b):
+  """Compares two strings in time that does not depend on where they differ."""
+  if len(a) != len(b):
+    return False
+  result = 0
+  for x, y in zip(a, b):
+    result |= ord(x) ^ ord(y)
+  return result == 0
+
+# Python 2.7.7 and later have a C implementation of this.
+compare_digest = getattr(hmac, 'compare_digest', _compare_digest)
+
+def _signature(secret, body):
+  return hmac.new(secret, body, hashlib.sha1).hexdigest()
+
+def encode(values, secret, timestamp=None):
+  """Returns a signed cookie value holding a JSON-serializable object.
+
+  >>> encode({'a': 1}, 'secret', timestamp=10)
+  'eyJhIjoxfQ==|10|95d8ab0b38f11d596d3d1ec425015de23d7f4a05'
+  """
+  if timestamp is None:
+    timestamp = int(time.time())
+  payload = base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')))
+  body = "%s%s%d" % (payload, _DELIM, timestamp)
+  return "%s%s%s" % (body, _DELIM, _signature(secret, body))
+
+def decode(cookie, secret, max_age=None, now=None):
+  """Returns the object held by a signed cookie value.
+
+  Returns None if the value is malformed, was not signed with secret, or is
+  more than max_age seconds old.
+
+  >>> cookie = encode({'a': 1}, 'secret', timestamp=10)
+  >>> decode(cookie, 'secret', max_age=5, now=12)
+  {u'a': 1}
+  >>> decode(cookie, 'secret', max_age=5, now=16)
+  >>> decode(cookie, 'other secret')
+  >>> decode(cookie.replace('|10|', '|11|'), 'secret')
+  >>> decode('garbage', 'secret')
+  """
+  if not cookie:
+    return None
+  try:
+    body, signature = str(cookie).rsplit(_DELIM, 1)
+    payload, timestamp = body.split(_DELIM)
+    timestamp = int(timestamp)
+  except (UnicodeError, ValueError):
+    return None
+
+  if not compare_digest(signature, _signature(secret, body)):
+    return None
+
+  if max_age is not None:
+    if now is None:
+      now = time.time()
+    if now - timestamp > max_age:
+      return None
+
+  try:
+    return json.loads(base64.urlsafe_b64decode(payload))
+  except (TypeError, ValueError):
+    return None
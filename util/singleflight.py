@@ -0,0 +1,76 @@
+"""Coalescing of identical concurrent computations.
+
+With threadsafe: yes, one instance serves several requests at once, and it is
+common for a few of them to ask for exactly the same thing (say, the same
+chart for the same user from two open tabs).  A Group lets the first caller
+for a key do the work while the others wait for it and share its result:
+
+  rows = flights.do(key, lambda: compute_rows(...))
+
+Nothing is kept once the computation finishes, so this is not a cache: a
+caller only ever gets a result that was being computed while it waited.  The
+key must therefore include everything the result depends on, including some
+notion of the data's version, and the result must not be modified by any of
+the callers that share it.
+"""
+
+import sys
+import threading
+
+from util import spans
+
+class _Call(object):
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.exc_info = None
+
+class Group(object):
+  """A set of in-flight computations, keyed by what they compute."""
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._calls = {}
+    self.computed = 0
+    self.shared = 0
+
+  def do(self, key, compute):
+    """Returns compute(), or the result of a concurrent call for the same key.
+
+    If compute raises, every caller waiting on it gets the same exception.
+    """
+    with self._lock:
+      call = self._calls.get(key)
+      if call is not None:
+        self.shared += 1
+        leader = False
+      else:
+        call = self._calls[key] = _Call()
+        self.computed += 1
+        leader = True
+
+    if not leader:
+      with spans.span('singleflight_wait'):
+        call.done.wait()
+      if call.exc_info is not None:
+        raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+      return call.result
+
+    try:
+      call.result = compute()
+    except:
+      call.exc_info = sys.exc_info()
+      raise
+    finally:
+      with self._lock:
+        del self._calls[key]
+      call.done.set()
+    return call.result
+
+  def stats(self):
+    """Returns how many calls were computed and how many shared a result."""
+    with self._lock:
+      return {
+        'computed': self.computed,
+        'shared': self.shared,
+        'in_flight': len(self._calls),
+      }
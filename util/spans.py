@@ -0,0 +1,194 @@
+"""Lightweight per-request timing spans.
+
+A request handler calls begin_request when it starts and end_request when it
+is done; in between, any code can time a stage of its work with
+
+  with spans.span('query'):
+    ...
+
+Time spent in each stage is added up per request, and every finished request
+is folded into per-instance histograms keyed by route and stage (see
+snapshot()).  Optionally, each request is also logged as one line of JSON.
+
+When spans are disabled, or when no request is being recorded on the current
+thread, span() returns a shared do-nothing context manager, so instrumented
+code costs a function call and an attribute lookup.
+"""
+
+import bisect
+import json
+import logging
+import threading
+import time
+
+# Upper bounds of the histogram buckets, in milliseconds.  There is one more
+# bucket for everything slower than the last bound.
+BUCKET_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# The name of the stage that covers the whole request.
+TOTAL = 'total'
+
+_enabled = True
+_log_requests = False
+
+_local = threading.local()
+_lock = threading.Lock()
+_histograms = {}
+
+def configure(enabled=None, log_requests=None):
+  """Turns recording and per-request logging on or off for this instance."""
+  global _enabled, _log_requests
+  if enabled is not None:
+    _enabled = enabled
+  if log_requests is not None:
+    _log_requests = log_requests
+
+class Histogram(object):
+  """Counts of durations falling in each of the BUCKET_BOUNDS_MS buckets."""
+  def __init__(self):
+    self.buckets = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+    self.count = 0
+    self.total_ms = 0.0
+    self.max_ms = 0.0
+
+  def add(self, ms):
+    self.buckets[bisect.bisect_left(BUCKET_BOUNDS_MS, ms)] += 1
+    self.count += 1
+    self.total_ms += ms
+    if ms > self.max_ms:
+      self.max_ms = ms
+
+  def percentile(self, fraction):
+    """Returns the upper bound of the bucket holding the given percentile.
+
+    The bound is never more than the largest duration actually seen.
+
+    >>> h = Histogram()
+    >>> for ms in (0.5, 3, 3, 40, 700):
+    ...   h.add(ms)
+    >>> h.percentile(0.5), h.percentile(0.99)
+    (5, 700)
+    """
+    if not self.count:
+      return None
+    wanted = fraction * self.count
+    seen = 0
+    for i, n in enumerate(self.buckets):
+      seen += n
+      if seen >= wanted:
+        if i < len(BUCKET_BOUNDS_MS):
+          return min(BUCKET_BOUNDS_MS[i], self.max_ms)
+        break
+    return self.max_ms
+
+  def to_dict(self):
+    return {
+      'count': self.count,
+      'mean_ms': round(self.total_ms / self.count, 3) if self.count else None,
+      'max_ms': round(self.max_ms, 3),
+      'p50_ms': self.percentile(0.50),
+      'p95_ms': self.percentile(0.95),
+      'p99_ms': self.percentile(0.99),
+      'buckets': self.buckets,
+    }
+
+class _Recorder(object):
+  def __init__(self, route):
+    self.route = route
+    self.start = time.time()
+    self.stages = {}
+
+class _Span(object):
+  __slots__ = ('recorder', 'stage', 'start')
+
+  def __init__(self, recorder, stage):
+    self.recorder = recorder
+    self.stage = stage
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, *exc_info):
+    ms = (time.time() - self.start) * 1000
+    stages = self.recorder.stages
+    stages[self.stage] = stages.get(self.stage, 0.0) + ms
+    return False
+
+class _NullSpan(object):
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    return False
+
+_NULL_SPAN = _NullSpan()
+
+def span(stage):
+  """Returns a context manager that adds the time spent in it to stage."""
+  recorder = getattr(_local, 'recorder', None)
+  if recorder is None:
+    return _NULL_SPAN
+  return _Span(recorder, stage)
+
+def timed(stage):
+  """Decorator that records every call of a function under stage."""
+  def decorate(f):
+    def wrapper(*args, **kargs):
+      with span(stage):
+        return f(*args, **kargs)
+    wrapper.__name__ = f.__name__
+    wrapper.__doc__ = f.__doc__
+    return wrapper
+  return decorate
+
+def begin_request(route):
+  """Starts recording spans for a request on this thread."""
+  if _enabled:
+    _local.recorder = _Recorder(route)
+  else:
+    _local.recorder = None
+
+def end_request(status=None):
+  """Stops recording, adds the request to the histograms and maybe logs it.
+
+  Returns:
+    {stage: milliseconds} for the request, or None if it wasn't recorded
+  """
+  recorder = getattr(_local, 'recorder', None)
+  _local.recorder = None
+  if recorder is None:
+    return None
+
+  stages = recorder.stages
+  stages[TOTAL] = (time.time() - recorder.start) * 1000
+  with _lock:
+    for stage, ms in stages.iteritems():
+      key = (recorder.route, stage)
+      histogram = _histograms.get(key)
+      if histogram is None:
+        histogram = _histograms[key] = Histogram()
+      histogram.add(ms)
+
+  if _log_requests:
+    logging.info("spans %s", json.dumps({
+      'route': recorder.route,
+      'status': status,
+      'ms': dict((k, round(v, 3)) for k, v in stages.iteritems()),
+    }, sort_keys=True))
+  return stages
+
+def snapshot():
+  """Returns {route: {stage: histogram dict}} for every recorded request."""
+  with _lock:
+    items = [(route, stage, h.to_dict())
+             for (route, stage), h in _histograms.iteritems()]
+  result = {}
+  for route, stage, histogram in items:
+    result.setdefault(route, {})[stage] = histogram
+  return result
+
+def reset():
+  """Forgets everything recorded so far."""
+  with _lock:
+    _histograms.clear()
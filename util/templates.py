@@ -0,0 +1,54 @@
+"""A per-process registry of compiled Django templates.
+
+loader.get_template reads and parses a template (and everything it extends or
+includes) from disk every time it is called.  Templates never change during
+the lifetime of an instance, so we compile each one the first time it is asked
+for and hand the same Template object to every subsequent request.  Rendering a
+compiled template does not modify it, so the registry can be shared between
+the request threads of a threadsafe instance.
+"""
+
+import logging
+import threading
+
+from django.template import Context
+from django.template import loader
+
+_lock = threading.Lock()
+_compiled = {}
+
+def get_template(name):
+  """Returns the compiled template for name, compiling it on first use."""
+  template = _compiled.get(name)
+  if template is None:
+    with _lock:
+      # Another thread may have compiled it while we were waiting.
+      template = _compiled.get(name)
+      if template is None:
+        template = loader.get_template(name)
+        _compiled[name] = template
+  return template
+
+def render(name, values):
+  """Renders the named template with a dictionary of values.
+
+  Returns:
+    the rendered template as a str, ready to be written to a response
+  """
+  return str(get_template(name).render(Context(values)))
+
+def preload(names):
+  """Compiles every named template so that no request has to.
+
+  Returns:
+    the number of templates that were not already compiled
+  """
+  missing = [name for name in names if name not in _compiled]
+  for name in missing:
+    get_template(name)
+  logging.debug("preloaded %d templates", len(missing))
+  return len(missing)
+
+def loaded():
+  """Returns the names of the templates compiled so far."""
+  return sorted(_compiled)
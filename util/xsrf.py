@@ -1,53 +1,118 @@
 from __future__ import division
 
 import base64
+import binascii
 import hashlib
 import logging
-import random
+import os
+import threading
 import time
 import hmac
 
+from util.signedcookie import compare_digest
+
 _DELIM = '|'
 TOKEN_NAME = 'xsrftoken'
 DEFAULT_EXPIRE_MICROS = 24 * 3600 * 1000000  # 1 full day
+# Tokens are stamped with the start of the bucket they were made in, so every
+# request in the same bucket gets (and can reuse) the same token.
+TOKEN_BUCKET_MICROS = 3600 * 1000000  # 1 hour
 
-def make_secret():
-  """Returns a 16-byte number as a long hex string"""
-  r = random.Random()
-  return ''.join(hex(r.randrange(0, 256))[2:] for i in xrange(16))
-
-def make_xsrf_token(user_info, action, microseconds=None):
-  """Returns base64(hmac(user_email DELIM action DELIM time) DELIM time)
+# Bounds on the per-instance caches below.  They are simply emptied when full:
+# refilling them costs one HMAC per entry.
+_MAX_CACHED_KEYS = 1000
+_MAX_CACHED_TOKENS = 4000
 
-  If microseconds is not specified, uses the current time.
-
-  The secret is taken from user_info.  If no such secret exists, one is created
-  and stored.
-  """
-  if microseconds is None:
-    microseconds = int(time.time() * 1e6)
+_cache_lock = threading.Lock()
+_hmac_keys = {}
+_tokens = {}
 
+def make_secret():
+  """Returns 16 random bytes as a hex string"""
+  return binascii.hexlify(os.urandom(16))
+
+def _hmac_for(secret):
+  """Returns an HMAC object already keyed with secret, to be copied."""
+  h = _hmac_keys.get(secret)
+  if h is None:
+    h = hmac.new(secret.encode('ascii'), digestmod=hashlib.sha1)
+    with _cache_lock:
+      if len(_hmac_keys) >= _MAX_CACHED_KEYS:
+        _hmac_keys.clear()
+      _hmac_keys[secret] = h
+  return h
+
+def _digest(user_info, action, microseconds):
   interior = "%(email)s%(delim)s%(action)s%(delim)s%(time)s" % {
     'delim': _DELIM,
     'email': user_info.key(),
     'action': action,
     'time': str(microseconds),
   }
+  h = _hmac_for(user_info.xsrf_secret).copy()
+  h.update(interior)
+  return h.digest()
+
+def make_xsrf_token(user_info, action, microseconds=None):
+  """Returns base64(hmac(user_email DELIM action DELIM time) DELIM time)
+
+  If microseconds is not specified, uses the start of the current time bucket,
+  and reuses the token made earlier in the same bucket if there is one.
 
+  The secret is taken from user_info, which must already have one: secrets are
+  created along with the UserInfo entity, not here, so that making a token
+  never writes to the datastore.
+  """
   if not user_info.xsrf_secret:
-    user_info.xsrf_secret = make_secret()
-    user_info.put()
+    raise ValueError("No XSRF secret for %s" % user_info.key())
 
-  h = hmac.new(user_info.xsrf_secret.encode('ascii'),
-               interior, hashlib.sha1).digest()
-  h = base64.b64encode(h)
-  return base64.b64encode("%s%s%s" % (h, _DELIM, microseconds))
+  cache_key = None
+  if microseconds is None:
+    now = int(time.time() * 1e6)
+    microseconds = now - now % TOKEN_BUCKET_MICROS
+    cache_key = (user_info.xsrf_secret, str(user_info.key()), action,
+                 microseconds)
+    token = _tokens.get(cache_key)
+    if token is not None:
+      return token
+
+  h = base64.b64encode(_digest(user_info, action, microseconds))
+  token = base64.b64encode("%s%s%s" % (h, _DELIM, microseconds))
+
+  if cache_key is not None:
+    with _cache_lock:
+      if len(_tokens) >= _MAX_CACHED_TOKENS:
+        _tokens.clear()
+      _tokens[cache_key] = token
+  return token
 
 def parse_xsrf_token(token):
   """Decodes then splits an xsrf token into hmac and time components."""
   h, t = base64.b64decode(token).split(_DELIM)
   return base64.b64decode(h), int(t)
 
+def check_xsrf_token(user_info, action, token,
+                     expire_micros=DEFAULT_EXPIRE_MICROS, now=None):
+  """Raises ValueError unless token was issued to user_info for action.
+
+  The comparison takes the same time no matter where the tokens differ.
+  """
+  try:
+    h, t = parse_xsrf_token(token)
+  except (TypeError, ValueError):
+    raise ValueError("Malformed XSRF token")
+
+  if now is None:
+    now = int(time.time() * 1e6)
+  if now - expire_micros > t:
+    # TODO: make this nicer?
+    raise ValueError("XSRF token expired")
+
+  if not compare_digest(h, _digest(user_info, action, t)):
+    logging.error("Invalid token for %s: %r", user_info.key(), token)
+    # TODO: nicer than an exception?
+    raise ValueError("Invalid XSRF token")
+
 class xsrf_aware(object):
   def __init__(self,
                action,
@@ -57,7 +122,8 @@ class xsrf_aware(object):
 
     Params:
       action - the name of the action that is permitted
-      user_info_factory - a callable that returns a UserInfo object
+      user_info_factory - a callable that takes the request handler being
+          wrapped and returns its UserInfo object
       expire_micros - number of microseconds that elapse before expiration
     """
     self.action = action
@@ -70,30 +136,17 @@ class xsrf_aware(object):
                       f.__name__,))
 
     def xsrf_wrapper(f_self, *args, **kargs):
-      user_info = self.user_info_factory()
+      user_info = self.user_info_factory(f_self)
       if f.__name__ == 'post':
         # Look for the token in the self.request.POST, then validate it.
         token = f_self.request.POST.get(TOKEN_NAME)
         if not token:
           # TODO: make this nicer?
           raise ValueError("Failed to find XSRF token in form")
+        check_xsrf_token(user_info, self.action, token, self.expire_micros)
 
-        h, t = parse_xsrf_token(token)
-        cur_time = int(time.time() * 1e6)
-
-        if cur_time - self.expire_micros > t:
-          # TODO: make this nicer?
-          raise ValueError("XSRF token expired")
-
-        valid_token = make_xsrf_token(user_info, self.action, t)
-        if token != valid_token:
-          logging.error("Invalid token:\nexp %r\ngot %r",
-                        valid_token, token)
-          # TODO: nicer than an exception?
-          raise ValueError("Invalid XSRF token")
-
-      # Always create a new token in f_self so it can be injected into the
-      # output stream by the rendering code in the handler.
+      # Always give f_self a token so it can be injected into the output
+      # stream by the rendering code in the handler.
       f_self._xsrf_token = make_xsrf_token(user_info, self.action)
 
       return f(f_self, *args, **kargs)
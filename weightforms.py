@@ -0,0 +1,76 @@
+"""Django forms used by the HTML pages.
+
+These live outside of weightmeter.py so that Django's form machinery is only
+imported by the handlers that actually render or validate a form: the JSON and
+CSV routes never need it.
+"""
+
+# This has to be imported after the appengine includes, otherwise the
+# appropriate environment is not yet set up for Django and it barfs.
+try:
+  from django import newforms as forms
+except ImportError:
+  from django import forms
+
+from util.forms import FloatSelectField
+from util.forms import FloatRangeSelectField
+from util.forms import FloatField
+from util.forms import DateSelectField
+from util.forms import CSVWeightField
+
+import readings
+import trend
+
+ValidationError = forms.ValidationError
+
+def make_choice_form(resolution=0.5):
+  class WeightChoiceForm(forms.Form):
+    date = DateSelectField()
+    weight = FloatRangeSelectField(resolution=resolution, reversed=True)
+  return WeightChoiceForm
+
+class NumberInput(forms.TextInput):
+  input_type = 'number'
+
+def make_entry_form(resolution=0.5):
+  class WeightEntryForm(forms.Form):
+    date = DateSelectField()
+    weight = FloatField(
+        max_length=7,
+        widget=NumberInput(attrs={
+          'step': resolution}))
+  return WeightEntryForm
+
+class CSVFileForm(forms.Form):
+  csvdata = CSVWeightField(widget=forms.FileInput)
+
+class CSVTextForm(forms.Form):
+  csvdata = CSVWeightField(widget=forms.Textarea(attrs=dict(rows=8, cols=30)))
+
+class SettingsForm(forms.Form):
+  scale_resolution = FloatSelectField(
+    initial=.5,
+    floatfmt='%0.02f',
+    float_choices=[.1, .2, .25, .5, 1.],
+  )
+  gamma = FloatSelectField(
+    initial=.9,
+    floatfmt='%0.02f',
+    float_choices=(.7, .75, .8, .85, .9, .95, 1.),
+    label="Decay weight",
+  )
+  trend_model = forms.ChoiceField(
+    initial=trend.DEFAULT_MODEL,
+    choices=trend.CHOICES,
+    label="Trend",
+  )
+  goal_weight = forms.FloatField(
+    required=False,
+    min_value=0,
+    label="Goal weight",
+  )
+  intraday_mode = forms.ChoiceField(
+    required=False,
+    choices=readings.CHOICES,
+    label="Several readings a day",
+  )
@@ -1,32 +1,14 @@
 from __future__ import division
 
-import csv
 import datetime
 import json
 import logging
-import math
-import os
-import os.path
-import re
+import time
 import webapp2
 
-from StringIO import StringIO
-
 from google.appengine.api import users
 from google.appengine.ext import db
 
-# This has to come after the appengine includes, otherwise the appropriate
-# environment is not yet set up for Django and it barfs.
-try:
-  from django import newforms as forms
-except ImportError:
-  from django import forms
-
-from django.template import Context
-from django.template import loader
-
-from util import forms as my_forms
-
 # TODO
 # - fix non-mobile site and launch version 2.0
 # - implement clearing out of weight data
@@ -39,21 +21,23 @@ from util import forms as my_forms
 #   administrative tasks, and also allows for possible sharing in the future.
 
 from datamodel import UserInfo, WeightBlock, WeightData, DEFAULT_QUERY_DAYS
+from datamodel import ImportReceipt, BUCKETS, LAYOUTS, layout_of, read_users
 from datamodel import sample_entries, decaying_average_iter, full_entry_iter
 from graph import chartserver_bounded_size, chartserver_weight_url
-from urlparse import urlparse, urlunparse
+from projection import project
 from util.dates import DateDelta, dates_from_args
-from util.forms import FloatSelectField
-from util.forms import FloatRangeSelectField
-from util.forms import FloatField
-from util.forms import DateSelectField
-from util.forms import CSVWeightField
+from util import rpcstats
+from util import singleflight
+from util import spans
 from util.handlers import RequestHandler
 from util.xsrf import xsrf_aware
 from util.xsrf import TOKEN_NAME as XSRF_TOKEN_NAME
+from usercontext import UserContext, user_info_key_name
+from usercontext import SETTINGS_COOKIE_NAME, SETTINGS_COOKIE_MAX_AGE
 # TODO: get rid of this - make param sanitizer its own thing in the util
 # directory
 from wsgiutil import ParamSanitizer
+import writebehind
 
 # Set constants
 DEFAULT_SELECT_DAYS = 14
@@ -72,6 +56,61 @@ DEFAULT_GRAPH_HEIGHT = 400
 
 MAX_GRAPH_SAMPLES = 200
 
+# /api/changes returns the trend from the first changed day to this many days
+# after the last, by which point the change has decayed out of it.
+TREND_PATCH_DAYS = 70
+
+# Most ranges /api/compare will overlay in one request.
+MAX_COMPARE_RANGES = 8
+
+# /api/projection fits the trend over each of these many recent days.
+PROJECTION_WINDOWS = (14, 28, 56)
+
+# Limits on what a single bulk import through /api/entries may contain.
+MAX_API_ENTRIES = 10000
+MAX_IDEMPOTENCY_KEY_LENGTH = 200
+
+# Most users /admin/trends will read in one request.
+MAX_ADMIN_TREND_USERS = 100
+
+# Per-request timing spans, aggregated at /debug/stats.  Logging them puts one
+# line of JSON per request in the application log.
+SPANS_ENABLED = True
+LOG_REQUEST_SPANS = False
+spans.configure(enabled=SPANS_ENABLED, log_requests=LOG_REQUEST_SPANS)
+
+# Datastore budgets per request: requests that go over are logged, as is any
+# single RPC slower than SLOW_DATASTORE_RPC_MS.
+MAX_DATASTORE_RPCS = 12
+MAX_DATASTORE_MS = 250
+SLOW_DATASTORE_RPC_MS = 100
+rpcstats.configure(max_rpcs=MAX_DATASTORE_RPCS,
+                   max_datastore_ms=MAX_DATASTORE_MS,
+                   slow_rpc_ms=SLOW_DATASTORE_RPC_MS)
+rpcstats.install()
+
+# Identical chart computations running at the same time (e.g., the same user
+# with two tabs open) are done once and shared.
+_flights = singleflight.Group()
+
+# Single-entry updates can be buffered and written a few seconds later, so
+# that a burst of them for one user costs one block write (see writebehind.py).
+WRITE_BEHIND_ENABLED = False
+WRITE_BEHIND_FLUSH_SECONDS = 10
+writebehind.configure(enabled=WRITE_BEHIND_ENABLED,
+                      flush_delay_seconds=WRITE_BEHIND_FLUSH_SECONDS,
+                      overlay_seconds=WRITE_BEHIND_FLUSH_SECONDS + 50)
+
+# Every page template, compiled once per instance by the warmup handler.
+PAGE_TEMPLATES = (
+    'index.html',
+    'mobile_index.html',
+    'data.html',
+    'mobile_data.html',
+    'settings.html',
+    'mobile_settings.html',
+)
+
 ##############################################################################
 # Functions
 ##############################################################################
@@ -79,62 +118,130 @@ def template_path(name):
   return name
   #return os.path.join(os.path.dirname(__file__), 'templates', name)
 
-def get_current_user_info():
-  user = users.get_current_user()
-  assert user is not None
-  return UserInfo.get_or_insert('u:' + user.email(), user=user)
-
-def chart_url(weight_data, width, height, start, end, gamma):
+def render_template(name, values):
+  """Renders a template from the process-wide compiled template registry."""
+  # Django's template machinery is only loaded by the routes that render HTML.
+  from util import templates
+  with spans.span('render'):
+    return templates.render(name, values)
+
+def handler_settings(handler):
+  """Returns the UserSettings of the request being served by handler."""
+  return handler.context.settings
+
+def json_entries(rows):
+  """Validates [date, weight] pairs from a JSON document.
+
+  Dates are YYYY-MM-DD strings.  A null weight clears the entry.  If a date is
+  given more than once, the last weight given for it wins.
+
+  Returns:
+    a list of date,weight pairs
+
+  Raises:
+    ValueError: describing the first invalid row
+  """
+  by_date = {}
+  for i, row in enumerate(rows):
+    if not isinstance(row, (list, tuple)) or len(row) != 2:
+      raise ValueError("Entry %d is not a [date, weight] pair" % i)
+    datestr, weight = row
+    try:
+      date = datetime.datetime.strptime(datestr, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+      raise ValueError("Invalid date in entry %d: %r" % (i, datestr))
+    if weight is None:
+      weight = -1.0
+    elif (isinstance(weight, bool) or not isinstance(weight, (int, float)) or
+          not 0 < weight < float('inf')):
+      raise ValueError("Invalid weight in entry %d: %r" % (i, weight))
+    by_date[date] = float(weight)
+  return by_date.items()
+
+def json_readings(rows):
+  """Validates [time, weight] pairs of intraday readings from a JSON document.
+
+  Times are YYYY-MM-DDTHH:MM strings (seconds, if given, are dropped: readings
+  are kept to the minute).  A null weight removes the reading taken at that
+  minute.  If a minute is given more than once, the last weight given for it
+  wins.
+
+  Returns:
+    a list of datetime,weight pairs
+
+  Raises:
+    ValueError: describing the first invalid row
+  """
+  by_time = {}
+  for i, row in enumerate(rows):
+    if not isinstance(row, (list, tuple)) or len(row) != 2:
+      raise ValueError("Reading %d is not a [time, weight] pair" % i)
+    timestr, weight = row
+    when = None
+    for time_format in ('%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S'):
+      try:
+        when = datetime.datetime.strptime(timestr, time_format)
+        break
+      except (TypeError, ValueError):
+        pass
+    if when is None:
+      raise ValueError("Invalid time in reading %d: %r" % (i, timestr))
+    if weight is None:
+      weight = -1.0
+    elif (isinstance(weight, bool) or not isinstance(weight, (int, float)) or
+          not 0 < weight < 10000):
+      # Readings are packed in hundredths (see readings.py).
+      raise ValueError("Invalid weight in reading %d: %r" % (i, weight))
+    by_time[when.replace(second=0)] = float(weight)
+  return by_time.items()
+
+def chart_url(weight_data, width, height, start, end, gamma, model=None):
   cw, ch = chartserver_bounded_size(width, height)
   samples = min(MAX_GRAPH_SAMPLES, cw // 4)
-  smoothed_iter = weight_data.smoothed_weight_iter(start, end, samples, gamma)
-  return chartserver_weight_url(cw, ch, smoothed_iter)
-
-##############################################################################
-# Forms
-##############################################################################
-
-def make_choice_form(resolution=0.5):
-  class WeightChoiceForm(forms.Form):
-    date = DateSelectField()
-    weight = FloatRangeSelectField(resolution=resolution, reversed=True)
-  return WeightChoiceForm
-
-class NumberInput(forms.TextInput):
-  input_type = 'number'
-
-def make_entry_form(resolution=0.5):
-  class WeightEntryForm(forms.Form):
-    date = DateSelectField()
-    weight = FloatField(
-        max_length=7,
-        widget=NumberInput(attrs={
-          'step': resolution}))
-  return WeightEntryForm
-
-class CSVFileForm(forms.Form):
-  csvdata = CSVWeightField(widget=forms.FileInput)
-
-class CSVTextForm(forms.Form):
-  csvdata = CSVWeightField(widget=forms.Textarea(attrs=dict(rows=8, cols=30)))
-
-class SettingsForm(forms.Form):
-  scale_resolution = FloatSelectField(
-    initial=.5,
-    floatfmt='%0.02f',
-    float_choices=[.1, .2, .25, .5, 1.],
-  )
-  gamma = FloatSelectField(
-    initial=.9,
-    floatfmt='%0.02f',
-    float_choices=(.7, .75, .8, .85, .9, .95, 1.),
-    label="Decay weight",
-  )
+  def compute():
+    with spans.span('sample_smooth'):
+      rows = list(weight_data.smoothed_weight_iter(start, end, samples, gamma,
+                                                   model))
+    with spans.span('chart_encode'):
+      return chartserver_weight_url(cw, ch, rows)
+  key = ('chart', weight_data.version_key(), start, end, cw, ch, gamma,
+         model)
+  return _flights.do(key, compute)
 
 ##############################################################################
 # Handlers
 ##############################################################################
-class Graph(RequestHandler):
+class BaseHandler(RequestHandler):
+  """Base for all of the application's page handlers.
+
+  webapp2 creates a new handler for every request, so anything stored on the
+  handler is request-scoped.
+  """
+  @webapp2.cached_property
+  def context(self):
+    """The UserContext shared by everything that serves this request."""
+    return UserContext(self.request.cookies)
+
+  def dispatch(self):
+    route = self.__class__.__name__
+    spans.begin_request(route)
+    rpcstats.begin_request(route)
+    try:
+      super(BaseHandler, self).dispatch()
+      # If the user's settings had to be read from the datastore, hand out a
+      # cookie so that the next request doesn't need to.
+      cookie = self.context.settings_cookie()
+      if cookie:
+        self.response.set_cookie(SETTINGS_COOKIE_NAME, cookie,
+                                 max_age=SETTINGS_COOKIE_MAX_AGE,
+                                 path='/',
+                                 secure=self.request.scheme == 'https',
+                                 httponly=True)
+    finally:
+      rpcstats.end_request()
+      spans.end_request(self.response.status_int)
+
+class Graph(BaseHandler):
   _default_graph_width = DEFAULT_GRAPH_WIDTH
   _default_graph_height = DEFAULT_GRAPH_HEIGHT
   _default_form_style = 'text'
@@ -149,7 +256,7 @@ class Graph(RequestHandler):
     else:
       return 'list'
 
-  def _render(self, user_info, form=None):
+  def _render(self, settings, form=None):
     today = datetime.date.today()
 
     start = self.request.get('s', DEFAULT_GRAPH_DURATION)
@@ -167,7 +274,9 @@ class Graph(RequestHandler):
       ('h', ParamSanitizer.Integer, self._default_graph_height),
       default_on_error=True)
 
-    weight_data = WeightData(user_info)
+    weight_data = self.context.weight_data
+    # Look for the latest entry while the chart's blocks are being fetched.
+    recent = weight_data.most_recent_entry_async()
     img_width = sanitizer.params['w']
     img_height = sanitizer.params['h']
 
@@ -180,11 +289,12 @@ class Graph(RequestHandler):
                          img_height,
                          sdate,
                          edate,
-                         user_info.gamma)
+                         settings.gamma,
+                         settings.trend_model)
         }
     logging.debug("Graph Chart URL: %s", img['url'])
 
-    recent_entry = weight_data.most_recent_entry()
+    recent_entry = recent.get_result()
     recent_weight = None
     if recent_entry:
       recent_weight = recent_entry[1]
@@ -195,9 +305,9 @@ class Graph(RequestHandler):
     afs = self._alternate_form_style()
 
     # Output to the template
-    template_values = Context({
+    template_values = {
         'img': img,
-        'user': users.get_current_user(),
+        'user': self.context.user,
         'form': form,
         'durations': DEFAULT_DURATIONS,
         'alternate_form_style': {
@@ -205,10 +315,10 @@ class Graph(RequestHandler):
           'name': afs,
           },
         XSRF_TOKEN_NAME: self._xsrf_token,
-        })
+        }
 
-    t = loader.get_template(self._template_path())
-    return self.response.write(str(t.render(template_values)))
+    return self.response.write(
+        render_template(self._template_path(), template_values))
 
   def _template_path(self):
     return template_path('index.html')
@@ -217,41 +327,41 @@ class Graph(RequestHandler):
     return self.redirect("/graph")
 
   def _make_weight_form(self, *args, **kargs):
+    import weightforms
     form_style = self._form_style()
-    user_info = kargs.get('user_info')
-    if not user_info:
-      user_info = get_current_user_info()
+    settings = self.context.settings
     if form_style == 'list':
-      form = make_choice_form(user_info.scale_resolution)(*args, **kargs)
+      form_class = weightforms.make_choice_form(settings.scale_resolution)
+      form = form_class(*args, **kargs)
     elif form_style == 'text':
-      form = make_entry_form(user_info.scale_resolution)(*args, **kargs)
+      form_class = weightforms.make_entry_form(settings.scale_resolution)
+      form = form_class(*args, **kargs)
     else:
       raise ValueError("Invalid form style specified: %s" % form_style)
 
     return form
 
-  @xsrf_aware('update_weight', get_current_user_info)
+  @xsrf_aware('update_weight', handler_settings)
   def get(self):
     # Get the settings and info for this user
-    user_info = get_current_user_info()
-    self._render(user_info)
+    self._render(self.context.settings)
 
-  @xsrf_aware('update_weight', get_current_user_info)
+  @xsrf_aware('update_weight', handler_settings)
   def post(self):
     """Updates a single weight entry."""
-    user_info = get_current_user_info()
-    weight_data = WeightData(user_info)
+    settings = self.context.settings
+    weight_data = self.context.weight_data
 
     form = self._make_weight_form(self.request.POST)
     logging.debug("POST data: %r", self.request.POST)
     if not form.is_valid():
       logging.debug("Invalid form")
-      return self._render(user_info, form)
+      return self._render(settings, form)
     else:
       logging.debug("valid form")
       date = form.cleaned_data['date']
       weight = form.cleaned_data['weight']
-      weight_data.update(date, weight)
+      writebehind.update(weight_data, date, weight)
       return self._on_success()
 
 class MobileGraph(Graph):
@@ -265,27 +375,28 @@ class MobileGraph(Graph):
   def _on_success(self):
     return self.redirect("/m/graph")
 
-class MobileData(RequestHandler):
+class MobileData(BaseHandler):
   def get(self):
     today = datetime.date.today()
     start = self.request.get('s', DEFAULT_GRAPH_DURATION)
     end = self.request.get('e', '')
     sdate, edate = dates_from_args(start, end, today)
-    user_info = get_current_user_info()
-    weight_data = WeightData(user_info)
-    smoothed_iter = weight_data.smoothed_weight_iter(sdate,
-                                                     edate,
-                                                     gamma=user_info.gamma)
-    template_values = Context({
-      'user': users.get_current_user(),
-      'user_info': user_info,
-      'entries': list(smoothed_iter),
+    settings = self.context.settings
+    weight_data = self.context.weight_data
+    smoothed_iter = weight_data.smoothed_weight_iter(
+        sdate, edate, gamma=settings.gamma, model=settings.trend_model)
+    with spans.span('sample_smooth'):
+      entries = list(smoothed_iter)
+    template_values = {
+      'user': self.context.user,
+      'user_info': settings,
+      'entries': entries,
       'durations': DEFAULT_DURATIONS,
-    })
-    t = loader.get_template('mobile_data.html')
-    return self.response.write(str(t.render(template_values)))
+    }
+    return self.response.write(
+        render_template('mobile_data.html', template_values))
 
-class ApiChartData(RequestHandler):
+class ApiChartData(BaseHandler):
   def get(self):
     today = datetime.date.today()
     start = self.request.get('s', DEFAULT_GRAPH_DURATION)
@@ -301,55 +412,430 @@ class ApiChartData(RequestHandler):
     if samples <= 0:
       samples = None
     sdate, edate = dates_from_args(start, end, today)
-    user_info = get_current_user_info()
-    weight_data = WeightData(user_info)
-    smoothed_iter = weight_data.smoothed_weight_iter(sdate,
-                                                     edate,
-                                                     samples,
-                                                     gamma=user_info.gamma)
+    settings = self.context.settings
+    weight_data = self.context.weight_data
+    def compute():
+      smoothed_iter = weight_data.smoothed_weight_iter(
+          sdate, edate, samples, gamma=settings.gamma,
+          model=settings.trend_model)
+      with spans.span('sample_smooth'):
+        return [(str(d), w, s) for d, w, s in smoothed_iter]
+    key = ('chartdata', weight_data.version_key(), sdate, edate, samples,
+           settings.gamma, settings.trend_model)
+    rows = _flights.do(key, compute)
     self.response.headers['Content-Type'] = 'application/json'
     obj = {
       'data': {
         'columns': ['Date', 'Weight', 'Smoothed'],
-        'rows': list((str(d), w, s) for d, w, s in smoothed_iter),
+        'rows': rows,
       }
     }
-    return self.response.write(json.dumps(obj))
+    with spans.span('encode'):
+      return self.response.write(json.dumps(obj))
+
+class ApiCompare(BaseHandler):
+  """Several date ranges' smoothed series at once, for overlaying periods.
+
+  Each range is given as an r parameter, either "<s>" or "<s>:<e>", where s
+  and e are what the other pages take as their s and e parameters, e.g.,
+  r=2w&r=4w:2w compares the last two weeks with the two before.  The samples
+  parameter is as for /api/chartdata.  All of the ranges are read from the
+  datastore together.
+  """
+  def get(self):
+    today = datetime.date.today()
+    self.response.headers['Content-Type'] = 'application/json'
+    specs = self.request.get_all('r')
+    if not 0 < len(specs) <= MAX_COMPARE_RANGES:
+      self.response.set_status(400)
+      return self.response.write(json.dumps({
+          'error': "Give 1 to %d ranges as r parameters" % MAX_COMPARE_RANGES}))
+    ranges = []
+    try:
+      for spec in specs:
+        start, _, end = spec.partition(':')
+        sdate, edate = dates_from_args(start, end, today)
+        if not sdate < edate:
+          raise ValueError(spec)
+        ranges.append((sdate, edate))
+    except ValueError:
+      self.response.set_status(400)
+      return self.response.write(json.dumps({'error': "Invalid range %r" %
+                                                      spec}))
+    samples = self.request.get('samples', '')
+    try:
+      samples = int(samples) if samples else None
+    except ValueError:
+      samples = None
+    if samples is not None and samples <= 0:
+      samples = None
+
+    settings = self.context.settings
+    weight_data = self.context.weight_data
+    smoothed_iters = weight_data.smoothed_weight_iters(
+        ranges, samples, gamma=settings.gamma, model=settings.trend_model)
+    with spans.span('sample_smooth'):
+      series = [{
+          'start': str(sdate),
+          'end': str(edate),
+          'rows': [(str(d), w, s) for d, w, s in smoothed_iter],
+        } for (sdate, edate), smoothed_iter in zip(ranges, smoothed_iters)]
+    with spans.span('encode'):
+      return self.response.write(json.dumps({
+          'columns': ['Date', 'Weight', 'Smoothed'],
+          'series': series,
+        }))
+
+class ApiStats(BaseHandler):
+  """Statistics for the user's weights over a date range, as JSON.
+
+  Takes the same s and e parameters as the other pages.  Returns the count,
+  mean, min and max of the entries in the range and the trend at its start
+  and end (see WeightData.stats).
+  """
+  def get(self):
+    today = datetime.date.today()
+    start = self.request.get('s', DEFAULT_GRAPH_DURATION)
+    end = self.request.get('e', '')
+    self.response.headers['Content-Type'] = 'application/json'
+    try:
+      sdate, edate = dates_from_args(start, end, today)
+      if sdate > edate:
+        raise ValueError(start, end)
+    except ValueError:
+      self.response.set_status(400)
+      return self.response.write(json.dumps({'error': "Invalid date range"}))
+    settings = self.context.settings
+    weight_data = self.context.weight_data
+    stats = weight_data.stats(sdate, edate, gamma=settings.gamma,
+                              model=settings.trend_model)
+    stats.update({'start': str(sdate), 'end': str(edate)})
+    with spans.span('encode'):
+      return self.response.write(json.dumps(stats, sort_keys=True))
+
+class ApiAggregate(BaseHandler):
+  """Weekly, monthly or yearly summaries of the user's weights, as JSON.
+
+  Takes the same s and e parameters as the other pages, plus bucket ('week',
+  'month' or 'year', default 'month') and trend (default 1; 0 leaves out the
+  closing trend of each bucket, which makes long ranges cheaper).
+  """
+  def get(self):
+    today = datetime.date.today()
+    start = self.request.get('s', DEFAULT_GRAPH_DURATION)
+    end = self.request.get('e', '')
+    bucket = self.request.get('bucket', 'month')
+    trend = self.request.get('trend', '1') != '0'
+    self.response.headers['Content-Type'] = 'application/json'
+    try:
+      sdate, edate = dates_from_args(start, end, today)
+      if sdate > edate:
+        raise ValueError(start, end)
+    except ValueError:
+      self.response.set_status(400)
+      return self.response.write(json.dumps({'error': "Invalid date range"}))
+    if bucket not in BUCKETS:
+      self.response.set_status(400)
+      return self.response.write(json.dumps({
+          'error': "bucket must be one of %s" % ', '.join(sorted(BUCKETS))}))
+    settings = self.context.settings
+    weight_data = self.context.weight_data
+    buckets = weight_data.aggregate(sdate, edate, bucket, trend=trend,
+                                    gamma=settings.gamma,
+                                    model=settings.trend_model)
+    with spans.span('encode'):
+      return self.response.write(json.dumps({
+          'bucket': bucket,
+          'buckets': buckets,
+        }, sort_keys=True))
+
+class ApiProjection(BaseHandler):
+  """The current rate of loss or gain, and when the goal will be reached.
+
+  For each of PROJECTION_WINDOWS, the trend over that many recent days is fit
+  with a line (see projection.project).  The goal is the user's goal weight,
+  unless another one is given in the goal parameter.  Dates are null when the
+  goal is never reached at the corresponding rate.
+  """
+  def get(self):
+    self.response.headers['Content-Type'] = 'application/json'
+    settings = self.context.settings
+    goal = settings.goal_weight
+    if self.request.get('goal'):
+      try:
+        goal = float(self.request.get('goal'))
+        # Also rules out nan, which no comparison holds for.
+        if not 0 < goal < float('inf'):
+          raise ValueError(goal)
+      except ValueError:
+        self.response.set_status(400)
+        return self.response.write(json.dumps({'error': "Invalid goal"}))
+
+    today = datetime.date.today()
+    weight_data = self.context.weight_data
+    def compute():
+      start = today - datetime.timedelta(days=max(PROJECTION_WINDOWS))
+      smoothed_iter = weight_data.smoothed_weight_iter(
+          start, today, gamma=settings.gamma, model=settings.trend_model)
+      with spans.span('sample_smooth'):
+        trend = [(d, s) for d, w, s in smoothed_iter]
+      with spans.span('projection'):
+        return project(trend, goal, PROJECTION_WINDOWS, today)
+    key = ('projection', weight_data.version_key(), today, goal,
+           settings.gamma, settings.trend_model)
+    projections = _flights.do(key, compute)
+
+    with spans.span('encode'):
+      return self.response.write(json.dumps({
+          'goal': goal,
+          'projections': projections,
+        }, default=str, sort_keys=True))
+
+class ApiEntries(BaseHandler):
+  """Bulk import of weight entries as JSON, for scales and syncing devices.
+
+  The body is a list of [date, weight] pairs (see json_entries), or an object
+  with that list as "entries" and an optional "idempotency_key".  The key can
+  also be sent in an Idempotency-Key header.  A request repeating a key that
+  has already been imported gets the original response back, without anything
+  being written.  Blocks that already hold the given weights aren't rewritten
+  either, so replaying a sync is cheap even without a key.
+
+  The body must be sent as application/json, which browsers won't send to
+  another site without a CORS preflight, so no XSRF token is needed.
+  """
+  def _error(self, status, message):
+    self.response.set_status(status)
+    self.response.headers['Content-Type'] = 'application/json'
+    return self.response.write(json.dumps({'error': message}))
+
+  def post(self):
+    content_type = self.request.headers.get('Content-Type', '')
+    if content_type.split(';')[0].strip().lower() != 'application/json':
+      return self._error(415, "Expected application/json")
+    try:
+      body = json.loads(self.request.body)
+    except ValueError:
+      return self._error(400, "Invalid JSON")
+
+    idempotency_key = self.request.headers.get('Idempotency-Key')
+    if isinstance(body, dict):
+      idempotency_key = body.get('idempotency_key', idempotency_key)
+      body = body.get('entries')
+    if not isinstance(body, list) or not body:
+      return self._error(400, "Expected a non-empty list of entries")
+    if len(body) > MAX_API_ENTRIES:
+      return self._error(413, "At most %d entries per request" %
+                         MAX_API_ENTRIES)
+    if idempotency_key is not None and (
+        not isinstance(idempotency_key, basestring) or
+        not 0 < len(idempotency_key) <= MAX_IDEMPOTENCY_KEY_LENGTH):
+      return self._error(400, "Invalid idempotency key")
+    try:
+      entries = json_entries(body)
+    except ValueError, e:
+      return self._error(400, str(e))
+
+    weight_data = self.context.weight_data
+    receipt_key = None
+    if idempotency_key is not None:
+      receipt_key = ImportReceipt.key_for(weight_data.user_key(),
+                                          idempotency_key)
+      with rpcstats.operation('ImportReceipt.get', idempotency_key):
+        receipt = db.get(receipt_key)
+      if receipt is not None:
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.headers['Idempotent-Replayed'] = 'true'
+        return self.response.write(receipt.result)
+
+    report = weight_data.batch_update(entries, skip_unchanged=True)
+    result = json.dumps({
+      'entries': report['entries'],
+      'blocks': report['block_results'],
+      'written': report['written'],
+      'transactions': report['transactions'],
+      'retries': report['retries'],
+    }, sort_keys=True)
+    if receipt_key is not None:
+      with rpcstats.operation('ImportReceipt.put', idempotency_key):
+        ImportReceipt(key=receipt_key, result=result).put()
+
+    self.response.headers['Content-Type'] = 'application/json'
+    return self.response.write(result)
+
+class ApiReadings(BaseHandler):
+  """Several weight readings a day, for users who have turned them on in their
+  settings.
+
+  GET takes the same s and e parameters as the other pages, and returns the
+  user's intraday_mode and their readings in the range as [time, weight]
+  pairs.
+
+  POST takes a list of [time, weight] pairs (see json_readings), or an object
+  with that list as "readings", as application/json like /api/entries.  The
+  weight of each day with a changed reading is set to the representative of
+  all of the day's readings (see readings.py).
+  """
+  def _error(self, status, message):
+    self.response.set_status(status)
+    self.response.headers['Content-Type'] = 'application/json'
+    return self.response.write(json.dumps({'error': message}))
+
+  def get(self):
+    today = datetime.date.today()
+    start = self.request.get('s', DEFAULT_GRAPH_DURATION)
+    end = self.request.get('e', '')
+    try:
+      sdate, edate = dates_from_args(start, end, today)
+    except ValueError:
+      return self._error(400, "Invalid date range")
+    weight_data = self.context.weight_data
+    results = weight_data.readings_between(sdate, edate)
+    self.response.headers['Content-Type'] = 'application/json'
+    with spans.span('encode'):
+      return self.response.write(json.dumps({
+          'mode': self.context.settings.intraday_mode,
+          'start': str(sdate),
+          'end': str(edate),
+          'readings': [(when.strftime('%Y-%m-%dT%H:%M'), weight)
+                       for when, weight in results],
+        }, sort_keys=True))
+
+  def post(self):
+    mode = self.context.settings.intraday_mode
+    if not mode:
+      return self._error(400, "Several readings a day are turned off in the "
+                         "settings")
+    content_type = self.request.headers.get('Content-Type', '')
+    if content_type.split(';')[0].strip().lower() != 'application/json':
+      return self._error(415, "Expected application/json")
+    try:
+      body = json.loads(self.request.body)
+    except ValueError:
+      return self._error(400, "Invalid JSON")
+
+    if isinstance(body, dict):
+      body = body.get('readings')
+    if not isinstance(body, list) or not body:
+      return self._error(400, "Expected a non-empty list of readings")
+    if len(body) > MAX_API_ENTRIES:
+      return self._error(413, "At most %d readings per request" %
+                         MAX_API_ENTRIES)
+    try:
+      changes = json_readings(body)
+    except ValueError, e:
+      return self._error(400, str(e))
+
+    report = self.context.weight_data.add_readings(changes, mode)
+    self.response.headers['Content-Type'] = 'application/json'
+    return self.response.write(json.dumps(report, sort_keys=True))
+
+class ApiChanges(BaseHandler):
+  """Changes to the user's weights since a data version, for clients that
+  keep their own copy.
+
+  GET /api/changes?since=<version> returns a JSON object with:
+
+    version: the version to ask for changes since next time
+    more: true if there were too many changes for one response; ask again
+    blocks: the changed blocks, each with its start date, version and the
+        weights for the days from the start date that the block holds (35,
+        for the original block layout; null for no entry)
+    smoothed: [date, smoothed weight] pairs from the first changed day until
+        the change has decayed out of the trend (or today)
+
+  Without since, only the current version is returned, for a client to start
+  from after downloading everything (e.g., from /csv).
+  """
+  def get(self):
+    self.response.headers['Content-Type'] = 'application/json'
+    weight_data = self.context.weight_data
+    since = self.request.get('since', '')
+    if not since:
+      return self.response.write(json.dumps({
+          'version': weight_data.data_version(),
+          'more': False,
+          'blocks': [],
+          'smoothed': [],
+        }))
+    try:
+      since = int(since)
+      if since < 0:
+        raise ValueError(since)
+    except ValueError:
+      self.response.set_status(400)
+      return self.response.write(json.dumps({'error': "Invalid since"}))
+
+    blocks, more, version = weight_data.changed_blocks(since)
+
+    smoothed = []
+    if blocks:
+      first_day = min(block.day_zero for block in blocks)
+      last_day = max(block.day_zero + layout_of(block).days - 1
+                     for block in blocks)
+      start = datetime.date.fromordinal(first_day)
+      end = min(datetime.date.today(),
+                datetime.date.fromordinal(last_day + TREND_PATCH_DAYS))
+      if start < end:
+        settings = self.context.settings
+        smoothed_iter = weight_data.smoothed_weight_iter(
+            start, end, gamma=settings.gamma, model=settings.trend_model)
+        with spans.span('sample_smooth'):
+          smoothed = [(str(d), s) for d, w, s in smoothed_iter]
+
+    obj = {
+      'version': version,
+      'more': more,
+      'blocks': [{
+          'start': str(datetime.date.fromordinal(block.day_zero)),
+          'version': block.version,
+          'weights': [w if w >= 0.0 else None
+                      for w in block.dense_entries()],
+        } for block in sorted(blocks, key=lambda b: b.day_zero)],
+      'smoothed': smoothed,
+    }
+    with spans.span('encode'):
+      return self.response.write(json.dumps(obj))
 
-class Data(RequestHandler):
+class Data(BaseHandler):
   def _render(self, fileform=None, textform=None, successful_command=None):
+    import weightforms
     if fileform is None:
       # TODO: kill this. It doesn't work anymore. Uploads will have to be handled differently.
-      fileform = CSVFileForm()
+      fileform = weightforms.CSVFileForm()
     if textform is None:
-      textform = CSVTextForm()
+      textform = weightforms.CSVTextForm()
 
     today = datetime.date.today()
     start = self.request.get('s', DEFAULT_GRAPH_DURATION)
     end = self.request.get('e', '')
     sdate, edate = dates_from_args(start, end, today)
-    user_info = get_current_user_info()
-    weight_data = WeightData(user_info)
-    smoothed_iter = weight_data.smoothed_weight_iter(sdate,
-                                                     edate,
-                                                     gamma=user_info.gamma)
-    template_values = Context({
-      'user': users.get_current_user(),
+    settings = self.context.settings
+    weight_data = self.context.weight_data
+    smoothed_iter = weight_data.smoothed_weight_iter(
+        sdate, edate, gamma=settings.gamma, model=settings.trend_model)
+    with spans.span('sample_smooth'):
+      entries = list(smoothed_iter)
+    template_values = {
+      'user': self.context.user,
       'fileform': fileform,
       'textform': textform,
       'success': bool(successful_command),
-      'entries': list(smoothed_iter),
+      'entries': entries,
       'durations': DEFAULT_DURATIONS,
       XSRF_TOKEN_NAME: self._xsrf_token,
-    })
-    t = loader.get_template('data.html')
-    return self.response.write(str(t.render(template_values)))
+    }
+    return self.response.write(
+        render_template('data.html', template_values))
 
   def _add(self):
+    # Only imports are handled here, so only load the CSV parsing and form
+    # machinery when someone actually submits data.
+    import weightforms
+    from util import forms as my_forms
     submit_type = self.request.get('type')
     if submit_type == 'file':
-      user_info = get_current_user_info()
-      weight_data = WeightData(user_info)
+      weight_data = self.context.weight_data
       # NOTE: we can't use Django form validation anymore because it doesn't do
       # file uploads properly without a database. That's total overkill for us.
       csvdata = self.request.POST['csvdata']
@@ -359,26 +845,25 @@ class Data(RequestHandler):
         if entries:
           weight_data.batch_update(entries)
         else:
-          raise forms.ValidationError("No valid entries specified")
-      except forms.ValidationError, e:
+          raise weightforms.ValidationError("No valid entries specified")
+      except weightforms.ValidationError, e:
         fileform.errors['csvdata'] = e.messages
         return self._render(fileform=fileform, textform=textform)
     elif submit_type == 'text':
       # POST a textarea
-      fileform = CSVFileForm()  # for template output
-      textform = CSVTextForm(self.request)
+      fileform = weightforms.CSVFileForm()  # for template output
+      textform = weightforms.CSVTextForm(self.request)
       if not textform.is_valid():
         return self._render(fileform=fileform, textform=textform)
       # Cleaned data is a date,weight pair iterator
-      user_info = get_current_user_info()
-      weight_data = WeightData(user_info)
+      weight_data = self.context.weight_data
       try:
         entries = list(textform.cleaned_data['csvdata'])
         if entries:
           weight_data.batch_update(entries)
         else:
-          raise forms.ValidationError("No valid entries specified")
-      except forms.ValidationError, e:
+          raise weightforms.ValidationError("No valid entries specified")
+      except weightforms.ValidationError, e:
         textform.errors['csvdata'] = e.messages
         return self._render(fileform=fileform, textform=textform)
     else:
@@ -392,7 +877,7 @@ class Data(RequestHandler):
     # TODO: implement deletion of all data
     return self.redirect("/data")
 
-  @xsrf_aware('data', get_current_user_info)
+  @xsrf_aware('data', handler_settings)
   def post(self):
     cmd = self.request.get('cmd')
     if cmd == 'add':
@@ -404,22 +889,22 @@ class Data(RequestHandler):
       logging.error("Invalid post command: %r", cmd)
       return self.redirect("/data")
 
-  @xsrf_aware('data', get_current_user_info)
+  @xsrf_aware('data', handler_settings)
   def get(self):
     return self._render()
 
-class MobileSettings(webapp2.RequestHandler):
-  def _render(self, user_info, form):
-    template_values = Context({
-      'user': users.get_current_user(),
+class MobileSettings(BaseHandler):
+  def _render(self, form):
+    template_values = {
+      'user': self.context.user,
       'index_url': '/index',
       'data_url': '/data',
       'form': form,
       XSRF_TOKEN_NAME: self._xsrf_token,
-    })
+    }
 
-    t = loader.get_template(self._template_path())
-    return self.response.write(str(t.render(template_values)))
+    return self.response.write(
+        render_template(self._template_path(), template_values))
 
   def _template_path(self):
     return template_path('mobile_settings.html')
@@ -427,30 +912,46 @@ class MobileSettings(webapp2.RequestHandler):
   def _on_success(self):
     return self.redirect("/m/graph")
 
-  @xsrf_aware('data', get_current_user_info)
+  @xsrf_aware('data', handler_settings)
   def post(self):
-    user_info = get_current_user_info()
-    form = SettingsForm(self.request.POST)
+    import weightforms
+    form = weightforms.SettingsForm(self.request.POST)
     if not form.is_valid():
       # Errors?  Just render the form: the POST didn't do anything, so a
       # refresh would be expected to "retry"
-      return self._render(user_info, form)
+      return self._render(form)
     else:
       # No errors, store the data
+      user_info = self.context.user_info
       user_info.scale_resolution = form.cleaned_data['scale_resolution']
       user_info.gamma = form.cleaned_data['gamma']
+      user_info.trend_model = form.cleaned_data['trend_model']
+      user_info.goal_weight = form.cleaned_data['goal_weight']
+      intraday_mode = form.cleaned_data['intraday_mode'] or None
+      mode_changed = intraday_mode != user_info.intraday_mode
+      user_info.intraday_mode = intraday_mode
+      user_info.settings_version += 1
       user_info.put()
+      # Replace this browser's settings cookie right away.
+      self.context.settings_changed(user_info)
+      if mode_changed and intraday_mode:
+        # The days with readings now have a different representative.
+        self.context.weight_data.recompute_readings(intraday_mode)
 
       # Send the user to the default front page after settings are altered.
       return self._on_success()
 
-  @xsrf_aware('data', get_current_user_info)
+  @xsrf_aware('data', handler_settings)
   def get(self):
-    user_info = get_current_user_info()
-    form = SettingsForm(initial={'gamma': user_info.gamma,
-                                 'scale_resolution': user_info.scale_resolution,
+    import weightforms
+    settings = self.context.settings
+    form = weightforms.SettingsForm(initial={'gamma': settings.gamma,
+                                 'scale_resolution': settings.scale_resolution,
+                                 'trend_model': settings.trend_model,
+                                 'goal_weight': settings.goal_weight,
+                                 'intraday_mode': settings.intraday_mode or '',
                                 })
-    return self._render(user_info, form)
+    return self._render(form)
 
 class Settings(MobileSettings):
   def _template_path(self):
@@ -459,10 +960,10 @@ class Settings(MobileSettings):
   def _on_success(self):
     return self.redirect("/graph")
 
-class CsvDownload(RequestHandler):
+class CsvDownload(BaseHandler):
   def get(self):
-    user_info = get_current_user_info()
-    weight_data = WeightData(user_info)
+    import csv
+    weight_data = self.context.weight_data
 
     today = datetime.date.today()
 
@@ -497,20 +998,191 @@ class DefaultRoot(RequestHandler):
   def get(self):
     self.redirect("/graph")
 
+class DebugStats(RequestHandler):
+  """Reports this instance's timing histograms, by route and stage, its
+  datastore usage, by route, and how many chart computations were shared, as
+  JSON.
+
+  Only administrators may see this (app.yaml also requires it).
+  """
+  def get(self):
+    if not users.is_current_user_admin():
+      return self.abort(403)
+    self.response.headers['Content-Type'] = 'application/json'
+    return self.response.write(json.dumps({
+        'spans': spans.snapshot(),
+        'datastore': rpcstats.snapshot(),
+        'singleflight': _flights.stats(),
+      }, indent=2, sort_keys=True))
+
+class AdminTrends(RequestHandler):
+  """Several users' smoothed series over the same date range, as JSON.
+
+  The users are given by email address as a comma-separated users parameter;
+  s, e and samples are as for /api/chartdata.  Each user's own gamma and
+  trend model are used, and all of their weights are read together (see
+  datamodel.read_users).
+
+  Only administrators may see this (app.yaml also requires it).
+  """
+  def get(self):
+    if not users.is_current_user_admin():
+      return self.abort(403)
+    self.response.headers['Content-Type'] = 'application/json'
+    emails = [email.strip() for email in self.request.get('users').split(',')
+              if email.strip()]
+    if not 0 < len(emails) <= MAX_ADMIN_TREND_USERS:
+      self.response.set_status(400)
+      return self.response.write(json.dumps({
+          'error': "Give 1 to %d users" % MAX_ADMIN_TREND_USERS}))
+    try:
+      start, end = dates_from_args(self.request.get('s'),
+                                   self.request.get('e'),
+                                   datetime.date.today())
+      if not start < end:
+        raise ValueError(start)
+    except ValueError:
+      self.response.set_status(400)
+      return self.response.write(json.dumps({'error': "Invalid range"}))
+    samples = self.request.get('samples', '')
+    try:
+      samples = int(samples) if samples else None
+    except ValueError:
+      samples = None
+    if samples is not None and samples <= 0:
+      samples = None
+
+    with rpcstats.operation('AdminTrends.users', '%d users' % len(emails)):
+      user_infos = db.get([
+          db.Key.from_path('UserInfo', user_info_key_name(users.User(email)))
+          for email in emails])
+    found = [(email, user_info) for email, user_info in zip(emails, user_infos)
+             if user_info is not None]
+    columns = read_users([user_info for email, user_info in found],
+                         start, end, samples)
+    with spans.span('encode'):
+      series = {}
+      for (email, user_info), user_columns in zip(found, columns):
+        user_columns['dates'] = [str(d) for d in user_columns['dates']]
+        series[email] = user_columns
+      return self.response.write(json.dumps({
+          'start': str(start),
+          'end': str(end),
+          'users': series,
+          'missing': [email for email, user_info in zip(emails, user_infos)
+                      if user_info is None],
+        }))
+
+class Warmup(webapp2.RequestHandler):
+  """Prepares a fresh instance before App Engine sends it user traffic.
+
+  Everything that would otherwise make the first real request on an instance
+  slow happens here instead: compiling templates, importing the modules that
+  are only loaded on demand, and running the pure code paths once so that
+  their lazily built tables (strptime, regular expressions, Django settings)
+  are initialized.
+  """
+  def get(self):
+    start = time.time()
+
+    import csv
+    import weightforms
+    from util import forms as my_forms
+    from util import templates
+
+    num_compiled = templates.preload(PAGE_TEMPLATES)
+
+    today = datetime.date.today()
+    for duration in DEFAULT_DURATIONS:
+      dates_from_args(duration, '', today)
+
+    # Rendering the forms pulls in the widget and field code.
+    for form in (weightforms.make_choice_form()(),
+                 weightforms.make_entry_form()(),
+                 weightforms.SettingsForm()):
+      form.as_table()
+
+    entries = [(today - datetime.timedelta(days=i), 150.0 + (i % 7) * 0.5)
+               for i in xrange(DEFAULT_SELECT_DAYS, -1, -1)]
+    chartserver_weight_url(DEFAULT_GRAPH_WIDTH, DEFAULT_GRAPH_HEIGHT,
+                           decaying_average_iter(iter(entries)))
+    list(my_forms.csv_row_iter(['%s,150.0' % today]))
+
+    logging.info("Warmup compiled %d templates in %.3fs",
+                 num_compiled, time.time() - start)
+    self.response.write('ok')
+
+class FlushWeights(BaseHandler):
+  """Writes a user's buffered entries; run from the write-behind flush queue.
+
+  Only administrators (which includes the task queue) may run this.
+  """
+  def post(self):
+    user_key = self.request.get('user')
+    if not user_key:
+      return self.abort(400)
+    written = writebehind.flush(user_key)
+    self.response.write('%d' % written)
+
+class MigrateLayout(BaseHandler):
+  """Moves users' weights to another block layout; run from the migration
+  queue (see migration.py), or by an administrator to start a run.
+
+  Only administrators (which includes the task queue) may run this.
+  """
+  def post(self):
+    import migration
+    step = self.request.get('step')
+    try:
+      layout = int(self.request.get('layout'))
+      min_blocks = int(self.request.get('min_blocks', 0))
+    except ValueError:
+      return self.abort(400)
+    if layout not in LAYOUTS:
+      return self.abort(400)
+    run = self.request.get('run')
+    if step == 'walk' and not run:
+      run = migration.start(layout, min_blocks)
+      return self.response.write(run)
+    if not run:
+      return self.abort(400)
+    if step == 'walk':
+      migration.walk(run, layout, min_blocks,
+                     int(self.request.get('page', 0)),
+                     self.request.get('cursor') or None)
+      return self.response.write(run)
+    if step == 'user':
+      result = migration.migrate_user(run, db.Key(self.request.get('user')),
+                                      layout, min_blocks)
+      return self.response.write(result)
+    return self.abort(400)
+
 # This needs to be in the global scope, as the application is now run by the appengine runtime, not called as a CGI script.
 app = webapp2.WSGIApplication(
     routes=[
+      (r'/_ah/warmup', Warmup),
       (r'/m/graph', MobileGraph),
       (r'/m/data', MobileData),
       (r'/m/settings', MobileSettings),
       (r'/m/logout', MobileLogout),
       (r'/m/?', MobileDefaultRoot),
       (r'/api/chartdata', ApiChartData),
+      (r'/api/entries', ApiEntries),
+      (r'/api/changes', ApiChanges),
+      (r'/api/readings', ApiReadings),
+      (r'/api/stats', ApiStats),
+      (r'/api/compare', ApiCompare),
+      (r'/api/aggregate', ApiAggregate),
+      (r'/api/projection', ApiProjection),
       (r'/graph', Graph),
       (r'/data', Data),
       (r'/csv', CsvDownload),
       (r'/settings', Settings),
       (r'/logout', Logout),
+      (r'/debug/stats', DebugStats),
+      (r'/admin/trends', AdminTrends),
+      (r'/tasks/flush_weights', FlushWeights),
+      (r'/tasks/migrate_layout', MigrateLayout),
       (r'/?', DefaultRoot),
       # TODO: add a default handler - 404
     ],
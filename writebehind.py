@@ -0,0 +1,187 @@
+"""Optional write-behind buffering of single weight entries.
+
+Every single-entry update is a read-modify-write of the entry's WeightBlock,
+so a user correcting a few entries, or a scale posting several readings in a
+row, rewrites the same block over and over.  When write-behind is enabled,
+update() instead:
+
+  - adds the entry to a pull queue (PULL_QUEUE), tagged with the user, which
+    is where it is durably kept until it is written;
+  - schedules a flush task for the user, named after the current
+    FLUSH_DELAY_SECONDS window so that all of the updates made in that window
+    share one task;
+  - remembers the entry in this instance, so that the pages it serves next
+    show it even before it has been written (read-your-writes).
+
+The flush task (see flush()) leases all of the user's queued entries, keeps
+the latest value for each date and writes them with a single batch_update.
+A date that was written directly (by an import, say) after its entry was
+buffered keeps the direct write: every direct write records its dates and
+time in the user's DataVersion, and the flush leaves those entries out.  A
+direct write also drops this instance's entries for its dates.
+Entries are only deleted from the queue once they are written; a failed
+flush releases its leases, so that its retry finds them again.
+
+Other instances don't see an entry until it has been flushed.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+from datamodel import WeightData, add_direct_write_listener
+
+PULL_QUEUE = 'weight-writes'
+FLUSH_QUEUE = 'weight-flush'
+FLUSH_URL = '/tasks/flush_weights'
+
+# Most tasks leased from the pull queue at a time, and for how long.
+LEASE_MAX_TASKS = 1000
+LEASE_SECONDS = 60
+
+_enabled = False
+_flush_delay_seconds = 10
+_overlay_seconds = 60
+
+# {str(user key): {date: (weight, expiry time)}} of entries accepted here.
+_overlay = {}
+_lock = threading.Lock()
+
+def configure(enabled=None, flush_delay_seconds=None, overlay_seconds=None):
+  """Turns write-behind on or off for this instance and sets its timing.
+
+  Params:
+    enabled - whether update() buffers entries or writes them right away
+    flush_delay_seconds - how long an entry can wait before it is written
+    overlay_seconds - how long this instance shows an entry it accepted in
+        place of the stored value; should comfortably exceed the flush delay
+  """
+  global _enabled, _flush_delay_seconds, _overlay_seconds
+  if enabled is not None:
+    _enabled = enabled
+  if flush_delay_seconds is not None:
+    _flush_delay_seconds = flush_delay_seconds
+  if overlay_seconds is not None:
+    _overlay_seconds = overlay_seconds
+
+def enabled():
+  return _enabled
+
+def update(weight_data, date, weight):
+  """Updates the weight for a date, buffered if write-behind is enabled."""
+  if not _enabled:
+    return weight_data.update(date, weight)
+
+  user_key = str(weight_data.user_key())
+  now = time.time()
+  payload = json.dumps({'d': date.isoformat(), 'w': weight, 't': now})
+  taskqueue.Queue(PULL_QUEUE).add(
+      taskqueue.Task(payload=payload, method='PULL', tag=user_key))
+  _schedule_flush(user_key, now)
+
+  with _lock:
+    _overlay.setdefault(user_key, {})[date] = (weight, now + _overlay_seconds)
+  weight_data.data_changed()
+
+def _schedule_flush(user_key, now):
+  window = int(now // _flush_delay_seconds)
+  name = 'flush-%s-%d' % (hashlib.sha1(user_key).hexdigest()[:20], window)
+  try:
+    taskqueue.add(queue_name=FLUSH_QUEUE,
+                  url=FLUSH_URL,
+                  params={'user': user_key},
+                  name=name,
+                  countdown=_flush_delay_seconds)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    # Someone already scheduled the flush for this window.
+    pass
+
+def _forget(user_key, dates):
+  """Drops this instance's entries for dates that were just written directly,
+  which supersede them."""
+  with _lock:
+    entries = _overlay.get(user_key)
+    if not entries:
+      return
+    for date in dates:
+      entries.pop(date, None)
+    if not entries:
+      del _overlay[user_key]
+
+add_direct_write_listener(_forget)
+
+def pending(user_key):
+  """Returns {date: weight} of this instance's unexpired entries for a user."""
+  user_key = str(user_key)
+  now = time.time()
+  with _lock:
+    entries = _overlay.get(user_key)
+    if not entries:
+      return {}
+    for date, (weight, expires) in entries.items():
+      if expires <= now:
+        del entries[date]
+    if not entries:
+      del _overlay[user_key]
+      return {}
+    return dict((date, weight) for date, (weight, expires)
+                in entries.iteritems())
+
+def _release(queue, tasks):
+  for task in tasks:
+    try:
+      queue.modify_task_lease(task, 0)
+    except Exception:
+      # The lease will still run out by itself; don't hide the real error.
+      logging.exception("Couldn't release the lease on %s", task.name)
+
+def flush(user_key):
+  """Writes all of a user's queued entries.
+
+  Params:
+    user_key - the user's UserInfo key, as a string
+
+  Returns:
+    the number of queued entries that were written
+  """
+  queue = taskqueue.Queue(PULL_QUEUE)
+  weight_data = WeightData(db.Key(user_key))
+  written = 0
+  while True:
+    tasks = queue.lease_tasks_by_tag(LEASE_SECONDS, LEASE_MAX_TASKS,
+                                     tag=user_key)
+    if not tasks:
+      break
+
+    # Only the latest value for each date matters.
+    latest = {}
+    for task in tasks:
+      values = json.loads(task.payload)
+      date = datetime.datetime.strptime(values['d'], '%Y-%m-%d').date()
+      if date not in latest or values['t'] >= latest[date][0]:
+        latest[date] = (values['t'], values['w'])
+    try:
+      # Dates written directly since an entry was buffered keep that newer
+      # weight.
+      weight_data.batch_update(
+          [(date, weight) for date, (t, weight) in latest.iteritems()],
+          buffered_at=dict((date, t) for date, (t, weight)
+                           in latest.iteritems()))
+    except:
+      # Give the entries back right away, or the retry of this flush would
+      # find them still leased, lease nothing and succeed without them.
+      _release(queue, tasks)
+      raise
+    queue.delete_tasks(tasks)
+    written += len(tasks)
+    logging.info("Flushed %d queued entries (%d dates) for %s",
+                 len(tasks), len(latest), user_key)
+    if len(tasks) < LEASE_MAX_TASKS:
+      break
+  return written